@@ -0,0 +1,395 @@
+# Copyright (c) 2010-2017, Emmanuel Blot <emmanuel.blot@free.fr>
+# Copyright (c) 2016, Emmanuel Bouaziz <ebouaziz@free.fr>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the Neotion nor the names of its contributors may
+#       be used to endorse or promote products derived from this software
+#       without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL NEOTION BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""asyncio API of the SPI and I2C controllers.
+
+   The coroutines of the asyncio controllers queue their requests, which a
+   worker thread executes on the underlying blocking controller. Requests
+   that are queued while the worker is busy with the USB transfers of the
+   previous ones are coalesced: SPI exchanges are sent as a single
+   :py:class:`pyftdi.spi.SpiBatch`, and I2C requests as a single
+   :py:class:`pyftdi.i2c.I2cTransaction`. Concurrent requests to different
+   ports therefore share USB round-trips.
+
+   Requests are executed in the order they have been issued.
+"""
+
+import asyncio
+from collections import deque
+from logging import getLogger
+from pyftdi.i2c import I2cController, I2cNackError
+from pyftdi.spi import SpiController
+from threading import Event, Lock, Thread
+
+__all__ = ['AsyncSpiController', 'AsyncSpiPort', 'AsyncI2cController',
+           'AsyncI2cPort']
+
+
+class AsyncController(object):
+    """Base class of the asyncio controllers.
+
+       Sub-classes implement :py:meth:`_execute`, which executes a batch of
+       coalesced requests.
+
+       :param controller: the blocking controller
+       :param max_batch: the maximum count of requests coalesced together
+    """
+
+    MAX_BATCH = 64
+
+    def __init__(self, controller, max_batch=None):
+        self.log = getLogger('pyftdi.aio')
+        self._ctrl = controller
+        self._max_batch = max_batch or self.MAX_BATCH
+        self._queue = deque()
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._thread = None
+
+    @property
+    def controller(self):
+        """Return the underlying blocking controller"""
+        return self._ctrl
+
+    async def configure(self, url, **kwargs):
+        """Configure the controller, see the blocking controller for the
+           arguments"""
+        await self._call(self._ctrl.configure, url, **kwargs)
+
+    async def terminate(self):
+        """Close the FTDI interface, once the queued requests have been
+           executed, and stop the worker thread"""
+        await self._call(self._ctrl.terminate)
+        with self._lock:
+            thread, self._thread = self._thread, None
+            if thread:
+                self._queue.append(None)
+                self._wakeup.set()
+        if thread:
+            await asyncio.get_event_loop().run_in_executor(None, thread.join)
+
+    def _submit(self, request):
+        """Queue a request, to be executed from the worker thread.
+
+           :return: an asyncio future of the request result
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        with self._lock:
+            self._queue.append((loop, future, request))
+            if not self._thread:
+                self._thread = Thread(target=self._run,
+                                      name=self.__class__.__name__)
+                self._thread.daemon = True
+                self._thread.start()
+        self._wakeup.set()
+        return future
+
+    def _call(self, func, *args, **kwargs):
+        """Run a function alone, from the worker thread"""
+        return self._submit((None, func, args, kwargs))
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            with self._lock:
+                if not self._queue:
+                    self._wakeup.clear()
+                    continue
+                items = []
+                while self._queue and len(items) < self._max_batch:
+                    if not self._queue[0]:
+                        # terminated, once the previous requests complete
+                        if not items:
+                            return
+                        break
+                    if self._queue[0][2][0] is None:
+                        # functions are not coalesced with other requests
+                        if not items:
+                            items.append(self._queue.popleft())
+                        break
+                    items.append(self._queue.popleft())
+            if items[0][2][0] is None:
+                _, func, args, kwargs = items[0][2]
+                try:
+                    outcomes = [(None, func(*args, **kwargs))]
+                except Exception as ex:
+                    outcomes = [(ex, None)]
+            else:
+                outcomes = self._execute([item[2] for item in items])
+            for (loop, future, _), (error, result) in zip(items, outcomes):
+                try:
+                    loop.call_soon_threadsafe(self._complete, future, error,
+                                              result)
+                except RuntimeError:
+                    # the event loop is closed
+                    pass
+
+    def _execute(self, requests):
+        """Execute coalesced requests, from the worker thread.
+
+           :param requests: the requests to execute, in order
+           :return: an (exception, result) pair per request
+        """
+        raise NotImplementedError('Controller does not execute requests')
+
+    @staticmethod
+    def _complete(future, error, result):
+        if future.cancelled():
+            return
+        if error:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+
+class AsyncSpiPort(object):
+    """asyncio SPI port
+
+       An asyncio SPI port is never instanciated directly.
+
+       Use AsyncSpiController.get_port() method to obtain a port.
+
+       Only complete transactions are supported: the /CS line is always
+       activated at the beginning of an exchange, and released at its end.
+    """
+
+    def __init__(self, controller, port):
+        self._controller = controller
+        self._port = port
+
+    @property
+    def port(self):
+        """Return the underlying blocking SPI port"""
+        return self._port
+
+    async def exchange(self, out=b'', readlen=0):
+        """Perform a half-duplex exchange with the SPI slave, see
+           :py:meth:`pyftdi.spi.SpiPort.exchange`"""
+        return await self._controller._submit(
+            (self._port, 'exchange', (out, readlen)))
+
+    async def exchange_duplex(self, out):
+        """Perform a full-duplex exchange with the SPI slave, see
+           :py:meth:`pyftdi.spi.SpiPort.exchange_duplex`"""
+        return await self._controller._submit(
+            (self._port, 'exchange_duplex', (out,)))
+
+    async def read(self, readlen=0):
+        """Read out bytes from the SPI slave"""
+        return await self.exchange(b'', readlen)
+
+    async def write(self, out):
+        """Write bytes to the SPI slave"""
+        return await self.exchange(out, 0)
+
+
+class AsyncSpiController(AsyncController):
+    """asyncio SPI master.
+
+       :param max_batch: the maximum count of coalesced exchanges
+       :param kwargs: see :py:class:`pyftdi.spi.SpiController`
+    """
+
+    def __init__(self, max_batch=None, **kwargs):
+        super(AsyncSpiController, self).__init__(SpiController(**kwargs),
+                                                 max_batch)
+        self._ports = {}
+
+    async def get_port(self, cs, freq=None, mode=0):
+        """Obtain an asyncio SPI port to drive a SPI device selected by cs,
+           see :py:meth:`pyftdi.spi.SpiController.get_port`
+
+           :rtype: AsyncSpiPort
+        """
+        port = await self._call(self._ctrl.get_port, cs, freq, mode)
+        if port not in self._ports:
+            self._ports[port] = AsyncSpiPort(self, port)
+        return self._ports[port]
+
+    def _execute(self, requests):
+        outcomes = []
+        futures = []
+        try:
+            with self._ctrl.batch():
+                for port, method, args in requests:
+                    try:
+                        futures.append(getattr(port, method)(*args))
+                        outcomes.append(None)
+                    except Exception as ex:
+                        futures.append(None)
+                        outcomes.append((ex, None))
+        except Exception as ex:
+            self.log.error('SPI batch failed: %s', ex)
+            error = ex
+        else:
+            error = None
+        for pos, future in enumerate(futures):
+            if future:
+                if future.done():
+                    exc = future.exception()
+                    outcomes[pos] = (exc, None if exc else future.result())
+                else:
+                    outcomes[pos] = (error, None)
+        # requests not reached when the batch failed to start
+        outcomes.extend([(error, None)] * (len(requests)-len(outcomes)))
+        return outcomes
+
+
+class AsyncI2cPort(object):
+    """asyncio I2C port
+
+       An asyncio I2C port is never instanciated directly.
+
+       Use AsyncI2cController.get_port() method to obtain a port.
+
+       The register format and the address shift are configured on the
+       underlying blocking port, see :py:attr:`port`.
+    """
+
+    def __init__(self, controller, port):
+        self._controller = controller
+        self._port = port
+
+    @property
+    def port(self):
+        """Return the underlying blocking I2C port"""
+        return self._port
+
+    @property
+    def address(self):
+        """Return the current address of the slave on the I2C bus"""
+        return self._port.address
+
+    async def read(self, readlen=1):
+        """Read one or more bytes from the slave"""
+        return await self._submit('read', (('read', readlen),))
+
+    async def write(self, out):
+        """Write one or more bytes to the slave"""
+        await self._submit('write', (('write', out),))
+
+    async def read_from(self, regaddr, readlen=1):
+        """Read one or more bytes from a slave register"""
+        return await self.exchange(self._port.make_buffer(regaddr), readlen)
+
+    async def write_to(self, regaddr, out):
+        """Write one or more bytes to a slave register"""
+        await self.write(self._port.make_buffer(regaddr, out))
+
+    async def exchange(self, out, readlen=1):
+        """Write bytes to the slave, then read bytes from it, with a
+           repeated START condition in-between"""
+        return await self._submit('exchange', (('write', out),
+                                               ('read', readlen)))
+
+    def _submit(self, name, steps):
+        address = self.address
+        return self._controller._submit(
+            (name, [(method, address, arg) for method, arg in steps]))
+
+
+class AsyncI2cController(AsyncController):
+    """asyncio I2C master.
+
+       Coalesced requests are executed in a single sequence, which is not
+       aborted when a slave does not acknowledge a request: the other
+       requests complete, and only the requests that have not been
+       acknowledged are executed again on their own. The execution within
+       the sequence counts as the first of the I2cController.RETRY_COUNT
+       attempts.
+
+       :param max_batch: the maximum count of coalesced requests
+    """
+
+    def __init__(self, max_batch=None):
+        super(AsyncI2cController, self).__init__(I2cController(), max_batch)
+        self._ports = {}
+
+    async def get_port(self, address):
+        """Obtain an asyncio I2C port to drive an I2C slave, see
+           :py:meth:`pyftdi.i2c.I2cController.get_port`
+
+           :rtype: AsyncI2cPort
+        """
+        port = await self._call(self._ctrl.get_port, address)
+        if port not in self._ports:
+            self._ports[port] = AsyncI2cPort(self, port)
+        return self._ports[port]
+
+    def _execute(self, requests):
+        outcomes = [None] * len(requests)
+        transactions = []
+        batch = self._ctrl.transaction()
+        for pos, (_, steps) in enumerate(requests):
+            transaction = self._ctrl.transaction()
+            try:
+                for method, address, arg in steps:
+                    getattr(transaction, method)(address, arg)
+            except Exception as ex:
+                outcomes[pos] = (ex, None)
+                continue
+            for method, address, arg in steps:
+                getattr(batch, method)(address, arg)
+            transactions.append((pos, transaction))
+        attempts = self._ctrl.RETRY_COUNT
+        if len(transactions) > 1:
+            nacks = {}
+            try:
+                results = batch.execute(nacks)
+            except Exception as ex:
+                for pos, _ in transactions:
+                    outcomes[pos] = (ex, None)
+                return outcomes
+            # each coalesced request has been executed once: the ones that
+            # have been acknowledged are complete, and should not be
+            # executed again as writes and reads may have side effects
+            failed = []
+            index = 0
+            for pos, transaction in transactions:
+                steps = requests[pos][1]
+                data = [results.pop(0) for step in steps if step[0] == 'read']
+                errors = [nacks[index+step] for step in range(len(steps))
+                          if index+step in nacks]
+                if errors:
+                    if attempts > 1:
+                        failed.append((pos, transaction))
+                    else:
+                        outcomes[pos] = (I2cNackError(errors[0]), None)
+                else:
+                    outcomes[pos] = (None, data[0] if data else None)
+                index += len(steps)
+            transactions = failed
+            # the execution within the batch counts as a first attempt
+            attempts -= 1
+        for pos, transaction in transactions:
+            try:
+                results = self._ctrl.execute_transaction(transaction,
+                                                         attempts)
+                outcomes[pos] = (None, results[0] if results else None)
+            except Exception as ex:
+                outcomes[pos] = (ex, None)
+        return outcomes
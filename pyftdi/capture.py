@@ -0,0 +1,644 @@
+# Copyright (c) 2010-2017, Emmanuel Blot <emmanuel.blot@free.fr>
+# Copyright (c) 2016, Emmanuel Bouaziz <ebouaziz@free.fr>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the Neotion nor the names of its contributors may
+#       be used to endorse or promote products derived from this software
+#       without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL NEOTION BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Binary capture of the USB traffic of FTDI devices, and offline decoder.
+
+   A :py:class:`CaptureWriter` is attached to a :py:class:`pyftdi.ftdi.Ftdi`
+   instance as a tracer, and records every bulk and control transfer into a
+   compact binary file, from a background thread.
+
+   Capture files are decoded offline, e.g.::
+
+       python3 -m pyftdi.capture -p spi capture.bin
+
+   The MPSSE command stream is rebuilt from the bulk transfers, each command
+   being matched with its reply. SPI, I2C and JTAG transactions are then
+   rebuilt from the MPSSE commands.
+
+   File format (all values little endian):
+
+   * header: magic (8 bytes), version (16 bits), reserved (16 bits),
+     capture start time as a POSIX timestamp (double)
+   * records: timestamp since capture start in nanoseconds (64 bits),
+     transfer kind (8 bits, see :py:class:`pyftdi.trace.UsbTracer`),
+     endpoint (8 bits), length (32 bits), then the transfer content.
+     The content of a control transfer starts with its 8-byte setup packet.
+"""
+
+from argparse import ArgumentParser
+from collections import deque
+from logging import getLogger
+from pyftdi.ftdi import Ftdi
+from pyftdi.jtag import JtagStateMachine
+from pyftdi.misc import hexline
+from pyftdi.trace import UsbTracer
+from queue import Queue
+from struct import Struct
+from sys import stderr
+from threading import Lock, Thread
+from time import perf_counter, time as now
+
+__all__ = ['CaptureWriter', 'CaptureReader', 'MpsseDecoder', 'SpiDecoder',
+           'I2cDecoder', 'JtagDecoder']
+
+
+class CaptureError(IOError):
+    """Invalid capture file"""
+
+
+class CaptureFormat(object):
+    """Capture file layout"""
+
+    MAGIC = b'PYFTDCAP'
+    VERSION = 1
+    HEADER = Struct('<8sHHd')
+    RECORD = Struct('<QBBI')
+    SETUP = Struct('<BBHHH')
+
+
+class CaptureWriter(CaptureFormat):
+    """Tracer that records the USB transfers into a binary capture file.
+
+       Records are accumulated into a buffer, which is written to the file
+       by a background thread once full, so that capturing does not stall
+       the USB transfers on file I/Os.
+
+       :param out: the path of the capture file, or a writable binary stream
+       :param buffer_size: the size of the buffers handed over to the writer
+                           thread
+       :param depth: the count of buffers the writer thread may lag behind
+                     before tracing blocks
+    """
+
+    def __init__(self, out, buffer_size=1 << 20, depth=16):
+        self.log = getLogger('pyftdi.capture')
+        if isinstance(out, str):
+            self._out = open(out, 'wb')
+            self._owned = True
+        else:
+            self._out = out
+            self._owned = False
+        self._buffer_size = buffer_size
+        self._start = perf_counter()
+        self._buffer = bytearray(self.HEADER.pack(self.MAGIC, self.VERSION,
+                                                  0, now()))
+        self._lock = Lock()
+        self._error = None
+        self._queue = Queue(depth)
+        self._thread = Thread(target=self._write_loop, name='FtdiCapture')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def trace(self, kind, endpoint, data):
+        """Record a USB transfer, see :py:class:`pyftdi.trace.UsbTracer`"""
+        stamp = int((perf_counter()-self._start)*1E9)
+        with self._lock:
+            if not self._thread:
+                return
+            self._buffer.extend(self.RECORD.pack(stamp, ord(kind), endpoint,
+                                                 len(data)))
+            self._buffer.extend(data)
+            if len(self._buffer) >= self._buffer_size:
+                self._queue.put(self._buffer)
+                self._buffer = bytearray()
+
+    def flush(self):
+        """Hand over the pending records to the writer thread"""
+        with self._lock:
+            if self._buffer:
+                self._queue.put(self._buffer)
+                self._buffer = bytearray()
+
+    def close(self):
+        """Write the pending records and close the capture.
+
+           Further transfers are not recorded.
+        """
+        with self._lock:
+            if not self._thread:
+                return
+            if self._buffer:
+                self._queue.put(self._buffer)
+                self._buffer = bytearray()
+            self._queue.put(None)
+            thread, self._thread = self._thread, None
+        thread.join()
+        if self._owned:
+            self._out.close()
+        else:
+            self._out.flush()
+        if self._error:
+            raise self._error
+
+    def _write_loop(self):
+        while True:
+            buf = self._queue.get()
+            if buf is None:
+                break
+            if self._error:
+                continue
+            try:
+                self._out.write(buf)
+            except Exception as e:
+                self.log.error('Capture stopped: %s', e)
+                self._error = e
+
+
+class CaptureRecord(object):
+    """A captured USB transfer"""
+
+    __slots__ = ('timestamp', 'kind', 'endpoint', 'data')
+
+    def __init__(self, timestamp, kind, endpoint, data):
+        self.timestamp = timestamp
+        self.kind = kind
+        self.endpoint = endpoint
+        self.data = data
+
+    def __repr__(self):
+        return '%12.6f %s 0x%02x %s' % (self.timestamp, self.kind,
+                                        self.endpoint, hexline(self.data))
+
+
+class CaptureReader(CaptureFormat):
+    """Iterate over the records of a capture file.
+
+       :param src: the path of the capture file, or a readable binary stream
+    """
+
+    def __init__(self, src):
+        if isinstance(src, str):
+            self._in = open(src, 'rb')
+        else:
+            self._in = src
+        header = self._in.read(self.HEADER.size)
+        if len(header) < self.HEADER.size:
+            raise CaptureError('Not a capture file')
+        magic, version, _, self.start_time = self.HEADER.unpack(header)
+        if magic != self.MAGIC:
+            raise CaptureError('Not a capture file')
+        if version != self.VERSION:
+            raise CaptureError('Unsupported capture version %d' % version)
+
+    def __iter__(self):
+        read = self._in.read
+        size = self.RECORD.size
+        unpack = self.RECORD.unpack
+        while True:
+            header = read(size)
+            if len(header) < size:
+                # a truncated record may end an interrupted capture
+                break
+            stamp, kind, endpoint, length = unpack(header)
+            data = read(length)
+            if len(data) < length:
+                break
+            yield CaptureRecord(stamp/1E9, chr(kind), endpoint, data)
+
+    def close(self):
+        self._in.close()
+
+
+class MpsseCommand(object):
+    """A MPSSE command, with its reply"""
+
+    __slots__ = ('timestamp', 'opcode', 'args', 'out', 'length', 'reply')
+
+    # Command names, by opcode
+    NAMES = {}
+
+    def __init__(self, timestamp, opcode, args, out, length):
+        self.timestamp = timestamp
+        self.opcode = opcode
+        self.args = args
+        self.out = out
+        self.length = length
+        self.reply = b''
+
+    @property
+    def name(self):
+        return self.NAMES.get(self.opcode, 'BAD_COMMAND_%02X' % self.opcode)
+
+    @property
+    def complete(self):
+        return len(self.reply) >= self.length
+
+    def __repr__(self):
+        text = '%12.6f %s' % (self.timestamp, self.name)
+        if self.args:
+            text += ' %s' % self.args.hex()
+        if self.out:
+            text += ' > %s' % self.out.hex()
+        if self.length:
+            text += ' < %s' % self.reply.hex()
+        return text
+
+
+for _name, _value in Ftdi.__dict__.items():
+    if (isinstance(_value, int) and 0 <= _value < 0x100 and
+            _name.split('_')[0] in ('WRITE', 'READ', 'RW', 'SET', 'GET',
+                                    'LOOPBACK', 'TCK', 'SEND', 'WAIT',
+                                    'ENABLE', 'DISABLE', 'CLK', 'DRIVE')):
+        MpsseCommand.NAMES.setdefault(_value, _name)
+
+
+class MpsseDecoder(object):
+    """Rebuild the MPSSE commands and their replies from USB transfers.
+
+       :param packet_size: the USB packet size of the device, required to
+                           strip the modem status bytes of the replies
+       :param mpsse: whether the device is known to be in MPSSE mode when
+                     the capture starts
+    """
+
+    # (opcode: (command size, reply size)) of the non-data commands
+    CONTROLS = {
+        Ftdi.SET_BITS_LOW: (3, 0),
+        Ftdi.SET_BITS_HIGH: (3, 0),
+        Ftdi.GET_BITS_LOW: (1, 1),
+        Ftdi.GET_BITS_HIGH: (1, 1),
+        Ftdi.TCK_DIVISOR: (3, 0),
+        Ftdi.CLK_BITS_NO_DATA: (2, 0),
+        Ftdi.CLK_BYTES_NO_DATA: (3, 0),
+        Ftdi.CLK_COUNT_WAIT_ON_HIGH: (3, 0),
+        Ftdi.CLK_COUNT_WAIT_ON_LOW: (3, 0),
+        Ftdi.DRIVE_ZERO: (3, 0),
+        Ftdi.READ_SHORT: (2, 1),
+        Ftdi.READ_EXTENDED: (3, 1),
+        Ftdi.WRITE_SHORT: (3, 0),
+        Ftdi.WRITE_EXTENDED: (4, 0)}
+
+    def __init__(self, packet_size=512, mpsse=True):
+        self._packet_size = packet_size
+        self._mpsse = mpsse
+        self._pending = bytearray()
+        self._waiting = deque()
+
+    def decode(self, records):
+        """Decode captured USB transfers.
+
+           :param records: an iterable of :py:class:`CaptureRecord`
+           :return: a generator of :py:class:`MpsseCommand`, in the order of
+                    execution
+        """
+        for record in records:
+            if record.kind == UsbTracer.CTRL_OUT:
+                yield from self._control(record.data)
+            elif not self._mpsse:
+                continue
+            elif record.kind == UsbTracer.BULK_OUT:
+                self._pending.extend(record.data)
+                self._parse(record.timestamp)
+            elif record.kind == UsbTracer.BULK_IN:
+                self._reply(record.data)
+            yield from self._flush()
+        # commands whose reply has not been captured
+        yield from self._waiting
+        self._waiting.clear()
+
+    def _control(self, data):
+        _, request, value, _, _ = CaptureFormat.SETUP.unpack(data[:8])
+        if request == Ftdi.SIO_SET_BITMODE:
+            self._mpsse = (value >> 8) == Ftdi.BITMODE_MPSSE
+        elif request != Ftdi.SIO_RESET:
+            return
+        # pending commands and replies are discarded by the device
+        yield from self._waiting
+        self._waiting.clear()
+        self._pending = bytearray()
+
+    def _flush(self):
+        while self._waiting and self._waiting[0].complete:
+            yield self._waiting.popleft()
+
+    def _parse(self, timestamp):
+        data = self._pending
+        pos = 0
+        while pos < len(data):
+            opcode = data[pos]
+            if opcode & 0x80:
+                size, length = self.CONTROLS.get(opcode, (1, 0))
+                if opcode not in self.CONTROLS and \
+                        opcode not in MpsseCommand.NAMES:
+                    length = 2
+                if pos+size > len(data):
+                    break
+                command = MpsseCommand(timestamp, opcode,
+                                       bytes(data[pos+1:pos+size]), b'',
+                                       length)
+            elif opcode & 0x02:
+                # bit command: length, then a data byte unless read only
+                write = bool(opcode & 0x50)
+                size = 3 if write else 2
+                if pos+size > len(data):
+                    break
+                command = MpsseCommand(timestamp, opcode,
+                                       bytes(data[pos+1:pos+2]),
+                                       bytes(data[pos+2:pos+size]),
+                                       int(bool(opcode & 0x20)))
+            else:
+                if pos+3 > len(data):
+                    break
+                count = (data[pos+1] | (data[pos+2] << 8))+1
+                write = bool(opcode & 0x10)
+                size = 3 + (count if write else 0)
+                if pos+size > len(data):
+                    break
+                command = MpsseCommand(timestamp, opcode,
+                                       bytes(data[pos+1:pos+3]),
+                                       bytes(data[pos+3:pos+size]),
+                                       count if opcode & 0x20 else 0)
+            self._waiting.append(command)
+            pos += size
+        del data[:pos]
+
+    def _reply(self, data):
+        packet_size = self._packet_size
+        payload = b''.join(data[pos+2:pos+packet_size]
+                           for pos in range(0, len(data), packet_size))
+        for command in self._waiting:
+            if not payload:
+                break
+            missing = command.length-len(command.reply)
+            if missing > 0:
+                command.reply += payload[:missing]
+                payload = payload[missing:]
+
+
+class SpiTransaction(object):
+    """A SPI transaction: the bytes exchanged while a /CS line is active"""
+
+    __slots__ = ('timestamp', 'cs', 'out', 'reply')
+
+    def __init__(self, timestamp, cs):
+        self.timestamp = timestamp
+        self.cs = cs
+        self.out = bytearray()
+        self.reply = bytearray()
+
+    def __repr__(self):
+        return '%12.6f CS%d > %s < %s' % (self.timestamp, self.cs,
+                                          self.out.hex(), self.reply.hex())
+
+
+class SpiDecoder(object):
+    """Rebuild the SPI transactions from MPSSE commands.
+
+       Written and read bytes are reported in distinct sequences, in the
+       order they are shifted on the bus.
+    """
+
+    CS_BIT = 0x08
+    CS_COUNT = 5
+
+    def decode(self, commands):
+        """Decode MPSSE commands.
+
+           :param commands: an iterable of :py:class:`MpsseCommand`
+           :return: a generator of :py:class:`SpiTransaction`
+        """
+        current = None
+        for command in commands:
+            if command.opcode == Ftdi.SET_BITS_LOW:
+                pins, direction = command.args
+                active = [cs for cs in range(self.CS_COUNT)
+                          if (direction & (self.CS_BIT << cs)) and
+                          not (pins & (self.CS_BIT << cs))]
+                if current and current.cs not in active:
+                    yield current
+                    current = None
+                if active and not current:
+                    current = SpiTransaction(command.timestamp, active[0])
+            elif current and command.opcode < 0x80 and \
+                    not command.opcode & 0x42:
+                current.out.extend(command.out)
+                current.reply.extend(command.reply)
+        if current:
+            yield current
+
+
+class I2cTransaction(object):
+    """An I2C transaction, from a START to a STOP or repeated START
+       condition"""
+
+    __slots__ = ('timestamp', 'address', 'read', 'data', 'nack')
+
+    def __init__(self, timestamp):
+        self.timestamp = timestamp
+        self.address = None
+        self.read = False
+        self.data = bytearray()
+        self.nack = None
+
+    def __repr__(self):
+        if self.address is None:
+            return '%12.6f START STOP' % self.timestamp
+        text = '%12.6f 0x%02x %s %s' % (self.timestamp, self.address,
+                                        self.read and 'R' or 'W',
+                                        self.data.hex())
+        if self.nack is not None:
+            text += ' NACK@%d' % self.nack
+        return text
+
+
+class I2cDecoder(object):
+    """Rebuild the I2C transactions from MPSSE commands"""
+
+    SCL_BIT = 0x01
+    SDA_O_BIT = 0x02
+
+    def decode(self, commands):
+        """Decode MPSSE commands.
+
+           :param commands: an iterable of :py:class:`MpsseCommand`
+           :return: a generator of :py:class:`I2cTransaction`
+        """
+        lines = self.SCL_BIT | self.SDA_O_BIT
+        current = None
+        written = None
+        for command in commands:
+            opcode = command.opcode
+            if opcode == Ftdi.SET_BITS_LOW:
+                pins, direction = command.args
+                # released lines are pulled up
+                levels = (pins | ~direction) & (self.SCL_BIT | self.SDA_O_BIT)
+                if (lines & levels & self.SCL_BIT) and \
+                        (lines ^ levels) & self.SDA_O_BIT:
+                    if current:
+                        yield current
+                        current = None
+                    if not levels & self.SDA_O_BIT:
+                        # START: SDA falls while SCL is high
+                        current = I2cTransaction(command.timestamp)
+                lines = levels
+            elif not current or opcode & 0x80:
+                continue
+            elif opcode & 0x02:
+                if written is not None and opcode & 0x20 and command.reply:
+                    # slave acknowledge of the last written byte
+                    if command.reply[0] & 0x01 and current.nack is None:
+                        current.nack = len(current.data)
+                    written = None
+            elif opcode & 0x10:
+                for byte in command.out:
+                    if current.address is None:
+                        current.address = byte >> 1
+                        current.read = bool(byte & 0x01)
+                    else:
+                        current.data.append(byte)
+                written = command.out
+            elif opcode & 0x20:
+                current.data.extend(command.reply)
+        if current:
+            yield current
+
+
+class JtagScan(object):
+    """A JTAG register scan"""
+
+    __slots__ = ('timestamp', 'register', 'length', 'out', 'reply')
+
+    def __init__(self, timestamp, register):
+        self.timestamp = timestamp
+        self.register = register
+        self.length = 0
+        self.out = 0
+        self.reply = 0
+
+    def shift(self, tdi, tdo):
+        self.out |= tdi << self.length
+        self.reply |= tdo << self.length
+        self.length += 1
+
+    def __repr__(self):
+        digits = (self.length+3)//4
+        return '%12.6f %s[%d] > %0*x < %0*x' % (
+            self.timestamp, self.register.upper(), self.length, digits,
+            self.out, digits, self.reply)
+
+
+class JtagDecoder(object):
+    """Rebuild the JTAG register scans from MPSSE commands.
+
+       The TAP controller state is tracked from the TMS commands, and the
+       bits shifted while in the Shift-IR or Shift-DR states are reported
+       as a single scan, with the first shifted bit as LSB.
+    """
+
+    def decode(self, commands):
+        """Decode MPSSE commands.
+
+           :param commands: an iterable of :py:class:`MpsseCommand`
+           :return: a generator of :py:class:`JtagScan`
+        """
+        fsm = JtagStateMachine()
+        scan = None
+        for command in commands:
+            opcode = command.opcode
+            if opcode & 0x80:
+                continue
+            if opcode & 0x02:
+                count = command.args[0]+1
+                out = command.out and command.out[0] or 0
+                reply = command.reply and command.reply[0] or 0
+                if opcode & 0x08 or opcode & 0x40:
+                    # bits are shifted in from the MSB
+                    tdo = [(reply >> (8-count+pos)) & 1
+                           for pos in range(count)]
+                else:
+                    tdo = [(reply >> (count-1-pos)) & 1
+                           for pos in range(count)]
+            else:
+                count = 8*len(command.reply or command.out or b'')
+                if not count:
+                    count = 8*((command.args[0] | command.args[1] << 8)+1)
+                out = int.from_bytes(command.out or bytes(count//8),
+                                     'little')
+                reply = int.from_bytes(command.reply or bytes(count//8),
+                                       'little')
+                tdo = [(reply >> pos) & 1 for pos in range(count)]
+            for pos in range(count):
+                if opcode & 0x40:
+                    tms = (out >> pos) & 1
+                    tdi = (out >> 7) & 1
+                elif opcode & 0x02:
+                    tms = 0
+                    tdi = (out >> (pos if opcode & 0x08 else 7-pos)) & 1
+                else:
+                    tms = 0
+                    tdi = (out >> pos) & 1
+                state = fsm.state()
+                if state.is_of('shift') and not state.is_of('capture'):
+                    register = state.is_of('ir') and 'ir' or 'dr'
+                    if not scan:
+                        scan = JtagScan(command.timestamp, register)
+                    scan.shift(tdi, tdo[pos])
+                fsm.handle_events((tms, ))
+                if scan and not fsm.state().is_of('shift'):
+                    yield scan
+                    scan = None
+        if scan:
+            yield scan
+
+
+def main():
+    """Decode a capture file"""
+    decoders = {'spi': SpiDecoder, 'i2c': I2cDecoder, 'jtag': JtagDecoder}
+    argparser = ArgumentParser(description=main.__doc__)
+    argparser.add_argument('capture', help='capture file')
+    argparser.add_argument('-p', '--protocol', default='mpsse',
+                           choices=('usb', 'mpsse') + tuple(decoders),
+                           help='decoding level (default: mpsse)')
+    argparser.add_argument('-s', '--packet-size', type=int, default=512,
+                           help='USB packet size of the device, 64 for '
+                                'full speed devices (default: 512)')
+    args = argparser.parse_args()
+    try:
+        reader = CaptureReader(args.capture)
+    except IOError as e:
+        argparser.error(str(e))
+    try:
+        items = iter(reader)
+        if args.protocol != 'usb':
+            items = MpsseDecoder(args.packet_size).decode(items)
+        if args.protocol in decoders:
+            items = decoders[args.protocol]().decode(items)
+        for item in items:
+            print(item)
+    except (BrokenPipeError, KeyboardInterrupt):
+        print('', file=stderr)
+    finally:
+        reader.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -27,17 +27,25 @@ Require: pyusb
 
 from array import array as Array
 from binascii import hexlify
-from errno import ENODEV
-from logging import getLogger
+from collections import namedtuple
+from concurrent.futures import Future
+from errno import ENODEV, ETIMEDOUT
+from logging import DEBUG, getLogger
+from pyftdi.latency import LatencyController, ThresholdPolicy
+from pyftdi.stats import FtdiStatistics
+from pyftdi.trace import UsbTracer
 from pyftdi.usbtools import UsbTools
-from struct import unpack as sunpack
+from queue import Empty, Full, Queue
+from struct import pack as spack, unpack as sunpack
 from sys import platform
+from threading import Event, Lock, Thread
+from time import perf_counter
 
 import usb.core
 import usb.util
 
 
-__all__ = ['Ftdi', 'FtdiError']
+__all__ = ['Ftdi', 'FtdiError', 'FtdiPortDescriptor']
 
 
 class FtdiError(IOError):
@@ -52,6 +60,23 @@ class FtdiFeatureError(FtdiError):
     """Requested feature is not available on FTDI device"""
 
 
+class FtdiPortDescriptor(namedtuple('FtdiPortDescriptor',
+                                    'device interface')):
+    """Picklable descriptor of a FTDI port, which may be used in place of
+       an URL to open the port.
+
+       Opening a port from its descriptor does not require to enumerate the
+       USB devices, so descriptors are the cheap way to hand over devices to
+       worker processes.
+
+       :param device: the :py:class:`pyftdi.usbtools.UsbDeviceDescriptor` of
+                      the FTDI device
+       :param interface: the port of the device, starting from 1
+    """
+
+    __slots__ = ()
+
+
 class Ftdi(object):
     """FTDI device driver"""
 
@@ -99,6 +124,14 @@ class Ftdi(object):
     READ_BYTES_NVE_LSB = 0x2c
     READ_BITS_PVE_LSB = 0x2a
     READ_BITS_NVE_LSB = 0x2e
+    RW_BYTES_PVE_PVE_MSB = 0x30
+    RW_BYTES_PVE_NVE_MSB = 0x31
+    RW_BYTES_NVE_PVE_MSB = 0x34
+    RW_BYTES_NVE_NVE_MSB = 0x35
+    RW_BITS_PVE_PVE_MSB = 0x32
+    RW_BITS_PVE_NVE_MSB = 0x33
+    RW_BITS_NVE_PVE_MSB = 0x36
+    RW_BITS_NVE_NVE_MSB = 0x37
     RW_BYTES_PVE_PVE_LSB = 0x38
     RW_BYTES_PVE_NVE_LSB = 0x39
     RW_BYTES_NVE_PVE_LSB = 0x3c
@@ -261,10 +294,9 @@ class Ftdi(object):
         self.usb_read_timeout = 5000
         self.usb_write_timeout = 5000
         self.baudrate = -1
-        self.readbuffer = Array('B')
-        self.readoffset = 0
         self.readbuffer_chunksize = 4 << 10  # 4KiB
         self.writebuffer_chunksize = 4 << 10  # 4KiB
+        self._alloc_read_buffers()
         self.max_packet_size = 0
         self.interface = None
         self.index = None
@@ -272,11 +304,21 @@ class Ftdi(object):
         self.out_ep = None
         self.bitmode = Ftdi.BITMODE_RESET
         self.latency = 0
-        self.latency_count = 0
         self.latency_min = self.LATENCY_MIN
         self.latency_max = self.LATENCY_MAX
         self.latency_threshold = None  # disable dynamic latency
+        self._latency_ctrl = None
         self.lineprop = 0
+        self._stream_thread = None
+        self._stream_queue = None
+        self._stream_stop = Event()
+        self._stream_error = None
+        self._write_thread = None
+        self._write_queue = None
+        self._write_lock = Lock()
+        self._write_pending = 0
+        self._stats = None
+        self._tracer = None
 
     # --- Public API -------------------------------------------------------
 
@@ -298,6 +340,34 @@ class Ftdi(object):
             cls.SCHEME, cls.VENDOR_IDS, cls.PRODUCT_IDS, cls.DEFAULT_VENDOR)
         return ids
 
+    @classmethod
+    def get_descriptor(cls, url):
+        """Locate the port of a FTDI device from its URL, so that it can be
+           open again without enumerating the USB devices.
+
+            :param url: input URL to parse
+            :return: the :py:class:`FtdiPortDescriptor` of the port
+        """
+        vendor, product, index, serial, interface = cls.get_identifiers(url)
+        devices = [desc for desc, _ in
+                   UsbTools.find_all([(vendor, product)], descriptors=True)
+                   if not serial or desc.sn == serial]
+        try:
+            device = devices[index]
+        except IndexError:
+            raise FtdiError('No such FTDI device: %s' % url)
+        return FtdiPortDescriptor(device, interface)
+
+    @classmethod
+    def _resolve(cls, url):
+        """Return the arguments of the open methods from an URL or from
+           a port descriptor."""
+        if isinstance(url, FtdiPortDescriptor):
+            dev = url.device
+            return (dev.vid, dev.pid, dev.index, dev.sn, url.interface,
+                    dev.bus, dev.address)
+        return cls.get_identifiers(url) + (None, None)
+
     @classmethod
     def add_custom_vendor(cls, vid, vidname=''):
         """Add a custom USB vendor identifier.
@@ -330,12 +400,18 @@ class Ftdi(object):
         return UsbTools.find_all(vps, nocache)
 
     def open_from_url(self, url):
-        vendor, product, index, serial, interface = self.get_identifiers(url)
-        return self.open(vendor, product, index, serial, interface)
-
-    def open(self, vendor, product, index=0, serial=None, interface=1):
+        """Open a new interface from its URL, or from its
+           :py:class:`FtdiPortDescriptor`"""
+        vendor, product, index, serial, interface, bus, address = \
+            self._resolve(url)
+        return self.open(vendor, product, index, serial, interface, bus,
+                         address)
+
+    def open(self, vendor, product, index=0, serial=None, interface=1,
+             bus=None, address=None):
         """Open a new interface to the specified FTDI device"""
-        self.usb_dev = UsbTools.get_device(vendor, product, index, serial)
+        self.usb_dev = UsbTools.get_device(vendor, product, index, serial,
+                                           bus=bus, address=address)
         try:
             self.usb_dev.set_configuration()
         except usb.core.USBError:
@@ -353,20 +429,25 @@ class Ftdi(object):
 
     def close(self):
         """Close the FTDI interface"""
+        self.stop_stream()
+        self.stop_write_pipeline()
         self.set_latency_timer(self.LATENCY_MAX)
         UsbTools.release_device(self.usb_dev)
 
     def open_mpsse_from_url(self, url, direction=0x0, initial=0x0,
                             frequency=6.0E6, latency=16):
-        vendor, product, index, serial, interface = self.get_identifiers(url)
+        vendor, product, index, serial, interface, bus, address = \
+            self._resolve(url)
         return self.open_mpsse(vendor, product, index, serial, interface,
-                               direction, initial, frequency, latency)
+                               direction, initial, frequency, latency,
+                               bus, address)
 
     def open_mpsse(self, vendor, product, index=0, serial=None, interface=1,
-                   direction=0x0, initial=0x0, frequency=6.0E6, latency=16):
+                   direction=0x0, initial=0x0, frequency=6.0E6, latency=16,
+                   bus=None, address=None):
         """Configure the interface for MPSSE mode"""
         # Open an FTDI interface
-        self.open(vendor, product, index, serial, interface)
+        self.open(vendor, product, index, serial, interface, bus, address)
         if not self.has_mpsse:
             self.close()
             raise FtdiMpsseError('This device does not support MPSSE')
@@ -394,15 +475,16 @@ class Ftdi(object):
 
     def open_bitbang_from_url(self, url, direction=0x0, initial=0x0,
                               latency=16):
-        vendor, product, index, serial, interface = self.get_identifiers(url)
+        vendor, product, index, serial, interface, bus, address = \
+            self._resolve(url)
         return self.open_bitbang(vendor, product, index, serial, interface,
-                                 direction, latency)
+                                 direction, latency, bus, address)
 
     def open_bitbang(self, vendor, product, index=0, serial=None, interface=1,
-                     direction=0x0, latency=16):
+                     direction=0x0, latency=16, bus=None, address=None):
         """Configure the interface for BITBANG mode"""
         # Open an FTDI interface
-        self.open(vendor, product, index, serial, interface)
+        self.open(vendor, product, index, serial, interface, bus, address)
         # Set latency timer
         self.set_latency_timer(latency)
         # Set chunk size
@@ -505,6 +587,11 @@ class Ftdi(object):
             raise ValueError('Baudrate tolerance exceeded: %.02f%% '
                              '(wanted %d, achievable %d)' %
                              (delta, baudrate, actual))
+        if self._stats:
+            self._stats.add('ctrl_out')
+        if self._tracer:
+            self._trace_ctrl(UsbTracer.CTRL_OUT, Ftdi.SIO_SET_BAUDRATE, value,
+                             index)
         try:
             if self.usb_dev.ctrl_transfer(
                 Ftdi.REQ_OUT, Ftdi.SIO_SET_BAUDRATE, value, index, Array('B'),
@@ -523,7 +610,7 @@ class Ftdi(object):
             raise FtdiError('Unable to flush RX buffer')
         # Invalidate data in the readbuffer
         self.readoffset = 0
-        self.readbuffer = Array('B')
+        del self.readbuffer[:]
 
     def purge_tx_buffer(self):
         """Clear the write buffer on the chip."""
@@ -545,14 +632,12 @@ class Ftdi(object):
 
     def read_data_set_chunksize(self, chunksize):
         """Configure read buffer chunk size."""
-        # Invalidate all remaining data
-        self.readoffset = 0
-        self.readbuffer = Array('B')
         if platform == 'linux':
             if chunksize > 16384:
                 chunksize = 16384
-        self.readbuffer = []
         self.readbuffer_chunksize = chunksize
+        # Invalidate all remaining data
+        self._alloc_read_buffers()
 
     def read_data_get_chunksize(self):
         """Get read buffer chunk size."""
@@ -582,6 +667,9 @@ class Ftdi(object):
             raise ValueError("Latency out of range")
         if self._ctrl_transfer_out(Ftdi.SIO_SET_LATENCY_TIMER, latency):
             raise FtdiError('Unable to latency timer')
+        self.latency = latency
+        if self._stats:
+            self._stats.add('latency_changes')
 
     def get_latency_timer(self):
         """Get latency timer"""
@@ -619,6 +707,11 @@ class Ftdi(object):
                 'sw': Ftdi.SIO_XON_XOFF_HS,
                 '': Ftdi.SIO_DISABLE_FLOW_CTRL}
         value = ctrl[flowctrl] | self.index
+        if self._stats:
+            self._stats.add('ctrl_out')
+        if self._tracer:
+            self._trace_ctrl(UsbTracer.CTRL_OUT, Ftdi.SIO_SET_FLOW_CTRL, 0,
+                             value)
         try:
             if self.usb_dev.ctrl_transfer(
                 Ftdi.REQ_OUT, Ftdi.SIO_SET_FLOW_CTRL, 0, value, Array('B'),
@@ -739,108 +832,238 @@ class Ftdi(object):
 
     def write_data(self, data):
         """Write data in chunks to the chip"""
-        offset = 0
-        size = len(data)
-        try:
-            while offset < size:
-                write_size = self.writebuffer_chunksize
-                if offset + write_size > size:
-                    write_size = size - offset
-                length = self._write(data[offset:offset+write_size])
-                if length <= 0:
-                    raise FtdiError("Usb bulk write error")
-                offset += length
-            return offset
-        except usb.core.USBError as e:
-            raise FtdiError('UsbError: %s' % str(e))
+        if self._write_thread:
+            # keep ordering with the data already queued in the pipeline
+            return self.write_data_async(data).result()
+        if self._latency_ctrl:
+            self._latency_ctrl.on_write(len(data))
+        return self._write_data(data)
+
+    def start_write_pipeline(self, depth=4):
+        """Start a background writer, so that the caller may prepare the
+           next buffers while the previous ones are sent over USB.
+
+           While the pipeline is active, write_data() goes through it and
+           waits for its own completion.
+
+           Buffers smaller than the write chunk size are sent right away by
+           the caller when the pipeline is idle, as handing them over to the
+           background writer would cost more than the USB transfer itself.
+
+           :param depth: the maximum count of queued buffers.
+                         write_data_async() blocks when the queue is full
+        """
+        if self._write_thread:
+            raise FtdiError("Write pipeline is already active")
+        self._write_pending = 0
+        self._write_queue = Queue(depth)
+        self._write_thread = Thread(target=self._write_loop,
+                                    name='FtdiWriter')
+        self._write_thread.daemon = True
+        self._write_thread.start()
+
+    def stop_write_pipeline(self):
+        """Send all queued buffers, then stop the background writer, if
+           any."""
+        if not self._write_thread:
+            return
+        self._write_queue.put(None)
+        self._write_thread.join()
+        self._write_thread = None
+        self._write_queue = None
+
+    def write_data_async(self, data):
+        """Queue data to be written to the chip.
+
+           :param data: the bytes to write, which are copied so that the
+                        caller may reuse its buffer
+           :return: a Future whose result is the count of written bytes
+        """
+        if not self._write_thread:
+            raise FtdiError("Write pipeline is not active")
+        if self._latency_ctrl:
+            self._latency_ctrl.on_write(len(data))
+        future = Future()
+        with self._write_lock:
+            if not self._write_pending and \
+                    len(data) < self.writebuffer_chunksize:
+                # nothing in flight: the lock keeps the buffers queued by
+                # other threads behind this one
+                future.set_running_or_notify_cancel()
+                try:
+                    future.set_result(self._write_data(data))
+                except Exception as e:
+                    future.set_exception(e)
+                return future
+            self._write_pending += len(data)
+        self._write_queue.put((future, bytes(data)))
+        return future
+
+    def cancel_pending_writes(self):
+        """Discard the queued buffers the background writer has not started
+           to send yet. Their futures are cancelled.
+
+           The buffer being sent, if any, is not interrupted.
+
+           :return: the count of discarded bytes
+        """
+        if not self._write_thread:
+            return 0
+        count = 0
+        stopped = False
+        while True:
+            try:
+                item = self._write_queue.get_nowait()
+            except Empty:
+                break
+            if item is None:
+                # the pipeline is being stopped
+                stopped = True
+                continue
+            future, data = item
+            future.cancel()
+            with self._write_lock:
+                self._write_pending -= len(data)
+            count += len(data)
+        if stopped:
+            self._write_queue.put(None)
+        return count
+
+    @property
+    def write_pending(self):
+        """Return the count of queued bytes not yet sent to the chip"""
+        return self._write_pending
+
+    @property
+    def is_write_pipelined(self):
+        """Tell whether the background writer is active"""
+        return bool(self._write_thread)
+
+    def enable_statistics(self, enable=True):
+        """Enable or disable the collection of USB traffic statistics.
+
+           Statistics are not collected by default, so that they do not
+           slow down the USB transfers.
+
+           :param enable: whether to collect statistics. Re-enabling the
+                          statistics resets them
+        """
+        self._stats = enable and FtdiStatistics() or None
+
+    @property
+    def statistics(self):
+        """Return the live statistics, or None if not enabled
+
+           :rtype: pyftdi.stats.FtdiStatistics
+        """
+        return self._stats
+
+    def get_statistics(self):
+        """Return a snapshot of the statistics as a dictionary, which is
+           empty if statistics are not enabled"""
+        return self._stats and self._stats.snapshot() or {}
+
+    def set_tracer(self, tracer):
+        """Trace the raw content of the USB transfers.
+
+           :param tracer: an object with a ``trace(kind, endpoint, data)``
+                          method such as :py:class:`pyftdi.trace.UsbTracer`,
+                          or None to stop tracing
+        """
+        self._tracer = tracer
+
+    @property
+    def tracer(self):
+        """Return the current tracer, if any"""
+        return self._tracer
 
     def read_data_bytes(self, size, attempt=1):
         """Read data in chunks from the chip.
            Automatically strips the two modem status bytes transfered during
-           every read."""
+           every read.
+
+           Received payload is stripped in place into a reused buffer, so
+           that no intermediate buffer is built for each USB transfer."""
         # Packet size sanity check
         if not self.max_packet_size:
             raise FtdiError("max_packet_size is bogus")
-        packet_size = self.max_packet_size
-        length = 1  # initial condition to enter the usb_read loop
+        if self._stream_thread:
+            raise FtdiError("Stream reader is active")
         data = Array('B')
+        available = len(self.readbuffer)-self.readoffset
         # everything we want is still in the cache?
-        if size <= len(self.readbuffer)-self.readoffset:
+        if size <= available:
             data = self.readbuffer[self.readoffset:self.readoffset+size]
             self.readoffset += size
             return data
         # something still in the cache, but not enough to satisfy 'size'?
-        if len(self.readbuffer)-self.readoffset != 0:
+        if available:
             data = self.readbuffer[self.readoffset:]
             # end of readbuffer reached
             self.readoffset = len(self.readbuffer)
         # read from USB, filling in the local cache as it is empty
         try:
-            while (len(data) < size) and (length > 0):
-                while True:
-                    tempbuf = self._read()
-                    attempt -= 1
-                    length = len(tempbuf)
-                    # the received buffer contains at least one useful databyte
-                    # (first 2 bytes in each packet represent the current modem
-                    # status)
-                    if length > 2:
-                        if self.latency_threshold:
-                            self.latency_count = 0
-                            if self.latency != self.latency_min:
-                                self.set_latency_timer(self.latency_min)
-                                self.latency = self.latency_min
-                        # skip the status bytes
-                        chunks = (length+packet_size-1) // packet_size
-                        count = packet_size - 2
-                        self.readbuffer = Array('B')
-                        self.readoffset = 0
-                        srcoff = 2
-                        for i in range(chunks):
-                            self.readbuffer += tempbuf[srcoff:srcoff+count]
-                            srcoff += packet_size
-                        length = len(self.readbuffer)
-                        break
-                    else:
-                        # received buffer only contains the modem status bytes
-                        # no data received, may be late, try again
-                        if attempt > 0:
-                            continue
-                        # no actual data
-                        self.readbuffer = Array('B')
-                        self.readoffset = 0
-                        if self.latency_threshold:
-                            self.latency_count += 1
-                            if self.latency != self.latency_max:
-                                if self.latency_count > self.latency_threshold:
-                                    self.set_latency_timer(self.latency_max)
-                                    self.latency = self.latency_max
-                        # no more data to read?
-                        return data
-                if length > 0:
-                    # data still fits in buf?
-                    if (len(data) + length) <= size:
-                        data += self.readbuffer[self.readoffset:
-                                                self.readoffset+length]
-                        self.readoffset += length
-                        # did we read exactly the right amount of bytes?
-                        if len(data) == size:
-                            return data
+            while len(data) < size:
+                tempbuf = self._read()
+                attempt -= 1
+                # the received buffer contains at least one useful databyte
+                # (first 2 bytes in each packet represent the current modem
+                # status)
+                if len(tempbuf) > 2:
+                    length = self._strip_status(tempbuf, self.readbuffer)
+                    if self._latency_ctrl:
+                        self._latency_ctrl.on_read(length)
+                    self.readoffset = 0
+                    # copy what fits in the request, keep the remaining
+                    # bytes in the local cache
+                    part_size = min(size-len(data), length)
+                    if data:
+                        data.extend(self.readbuffer[:part_size])
                     else:
-                        # partial copy, not enough bytes in the local cache to
-                        # fulfill the request
-                        part_size = min(size-len(data),
-                                        len(self.readbuffer)-self.readoffset)
-                        if part_size < 0:
-                            raise FtdiError("Internal Error")
-                        data += self.readbuffer[self.readoffset:
-                                                self.readoffset+part_size]
-                        self.readoffset += part_size
-                        return data
+                        data = self.readbuffer[:part_size]
+                    self.readoffset = part_size
+                    continue
+                # received buffer only contains the modem status bytes
+                # no data received, may be late, try again
+                if attempt > 0:
+                    if self._stats:
+                        self._stats.add('read_retries')
+                    continue
+                # no actual data
+                self.readoffset = 0
+                del self.readbuffer[:]
+                if self._latency_ctrl:
+                    self._latency_ctrl.on_read(0)
+                # no more data to read?
+                break
+            return data
         except usb.core.USBError as e:
             raise FtdiError('UsbError: %s' % str(e))
-        # never reached
-        raise FtdiError("Internal error")
+
+    def read_data_chunk(self):
+        """Return the payload already received, or the payload of a single
+           USB transfer, which may be empty.
+
+           Unlike read_data_bytes(), this method never waits for more than
+           one USB transfer, so that a single thread may service several
+           devices in turn."""
+        if not self.max_packet_size:
+            raise FtdiError("max_packet_size is bogus")
+        if self._stream_thread:
+            raise FtdiError("Stream reader is active")
+        if self.readoffset < len(self.readbuffer):
+            data = self.readbuffer[self.readoffset:]
+            self.readoffset = len(self.readbuffer)
+            return data
+        try:
+            tempbuf = self._read()
+        except usb.core.USBError as e:
+            raise FtdiError('UsbError: %s' % str(e))
+        length = self._strip_status(tempbuf, self.readbuffer)
+        self.readoffset = length
+        if self._latency_ctrl:
+            self._latency_ctrl.on_read(length)
+        return self.readbuffer[:length]
 
     def read_data(self, size):
         """Read data in chunks from the chip.
@@ -848,6 +1071,83 @@ class Ftdi(object):
            every read."""
         return self.read_data_bytes(size).tobytes()
 
+    def start_stream(self, callback=None, depth=16, chunksize=0):
+        """Start a background reader that continuously drains the device,
+           so that the device FIFO does not overrun between two reads.
+
+           While the stream reader is active, received data can only be
+           retrieved with read_stream() or the callback.
+
+           :param callback: optional callable, invoked from the reader
+                            thread with each chunk of received payload.
+                            If not defined, payload chunks are queued
+           :param depth: the maximum count of queued chunks. The reader
+                         stops draining the device when the queue is full
+           :param chunksize: the size of each USB transfer, default to the
+                             read chunk size. Large transfers let the USB
+                             host receive several packets in a row
+        """
+        if self._stream_thread:
+            raise FtdiError("Stream reader is already active")
+        if not self.max_packet_size:
+            raise FtdiError("max_packet_size is bogus")
+        self._stream_stop.clear()
+        self._stream_error = None
+        self._stream_queue = Queue(depth)
+        chunksize = chunksize or self.readbuffer_chunksize
+        self._stream_thread = Thread(target=self._stream_loop,
+                                     args=(callback, chunksize),
+                                     name='FtdiStream')
+        self._stream_thread.daemon = True
+        self._stream_thread.start()
+
+    def stop_stream(self):
+        """Stop the background reader, if any.
+
+           Queued data are discarded.
+        """
+        if not self._stream_thread:
+            return
+        self._stream_stop.set()
+        self._stream_thread.join()
+        self._stream_thread = None
+        self._stream_queue = None
+
+    @property
+    def is_streaming(self):
+        """Tell whether the background reader is active"""
+        return bool(self._stream_thread)
+
+    @property
+    def stream_error(self):
+        """Return the error which stopped the background reader, if any"""
+        return self._stream_error
+
+    def read_stream(self, timeout=None):
+        """Retrieve the next chunk of payload received by the background
+           reader.
+
+           :param timeout: how long to wait for data, in seconds. None waits
+                           forever
+           :return: a chunk of received bytes, empty if timeout expired
+        """
+        if not self._stream_thread:
+            raise FtdiError("Stream reader is not active")
+        remaining = timeout
+        while True:
+            # wake up on a regular basis, to detect a dead reader
+            step = 0.1 if remaining is None else min(remaining, 0.1)
+            try:
+                return self._stream_queue.get(timeout=step)
+            except Empty:
+                if self._stream_error:
+                    raise FtdiError('Stream reader stopped: %s' %
+                                    self._stream_error)
+                if remaining is not None:
+                    remaining -= step
+                    if remaining <= 0:
+                        return b''
+
     def get_cts(self):
         """Read terminal status line: Clear To Send"""
         status = self.poll_modem_status()
@@ -869,19 +1169,55 @@ class Ftdi(object):
         return (status & self.MODEM_RLSD) and True or False
 
     def set_dynamic_latency(self, lmin, lmax, threshold):
-        """Set up or disable latency values"""
+        """Set up or disable latency values.
+
+           The lmin latency is used as soon as data are received, the lmax
+           latency once more than threshold reads have returned no data.
+           This is a shortcut for a :py:class:`ThresholdPolicy`."""
         if not threshold:
-            self.latency_count = 0
             self.latency_threshold = None
+            self.set_latency_policy(None)
         else:
-            for lat in (lmin, lmax):
-                if not (0 < lat < 256):
-                    raise ValueError("Latency out of range: %d")
+            policy = ThresholdPolicy(lmin, lmax, threshold)
             self.latency_min = lmin
             self.latency_max = lmax
             self.latency_threshold = threshold
-            self.latency = lmax
-            self.set_latency_timer(self.latency)
+            self.set_latency_timer(lmax)
+            self.set_latency_policy(policy, 0)
+
+    def set_latency_policy(self, policy, holdoff=0.05):
+        """Adapt the latency timer to the observed traffic.
+
+           The policy is fed with the outcome of the writes and reads, and
+           selects the latency timer value, see :py:mod:`pyftdi.latency`.
+
+           :param policy: a :py:class:`pyftdi.latency.LatencyPolicy`, or
+                          None to keep the current latency timer
+           :param holdoff: the minimum delay between two latency timer
+                           changes, in seconds
+        """
+        if policy is None:
+            self._latency_ctrl = None
+        else:
+            self._latency_ctrl = LatencyController(self, policy, holdoff)
+
+    @property
+    def latency_policy(self):
+        """Return the current latency policy, if any"""
+        if not self._latency_ctrl:
+            return None
+        return self._latency_ctrl.policy
+
+    @property
+    def latency_count(self):
+        """Return the count of reads in a row that have returned no data,
+           as tracked by the current latency policy.
+
+           Kept for compatibility, see :py:meth:`set_latency_policy`.
+        """
+        if not self._latency_ctrl:
+            return 0
+        return self._latency_ctrl.policy.empty_reads
 
     def validate_mpsse(self):
         # only useful in MPSSE mode
@@ -912,10 +1248,24 @@ class Ftdi(object):
             raise FtdiError('Unable to reset FTDI device')
         # Invalidate data in the readbuffer
         self.readoffset = 0
+        del self.readbuffer[:]
+
+    def _alloc_read_buffers(self):
+        """Allocate the USB transfer buffer and the payload buffer.
+
+           Both buffers are reused for every USB transfer, the payload buffer
+           is only refilled once all its data have been consumed."""
+        self.rawbuffer = Array('B', bytes(self.readbuffer_chunksize))
         self.readbuffer = Array('B')
+        self.readoffset = 0
 
     def _ctrl_transfer_out(self, reqtype, value, data=b''):
         """Send a control message to the device"""
+        if self._stats:
+            self._stats.add('ctrl_out')
+        if self._tracer:
+            self._trace_ctrl(UsbTracer.CTRL_OUT, reqtype, value, self.index,
+                             data)
         try:
             return self.usb_dev.ctrl_transfer(
                 Ftdi.REQ_OUT, reqtype, value, self.index,
@@ -925,26 +1275,171 @@ class Ftdi(object):
 
     def _ctrl_transfer_in(self, reqtype, length):
         """Request for a control message from the device"""
+        if self._stats:
+            self._stats.add('ctrl_in')
         try:
-            return self.usb_dev.ctrl_transfer(
+            data = self.usb_dev.ctrl_transfer(
                 Ftdi.REQ_IN, reqtype, 0, self.index, length,
                 self.usb_read_timeout)
         except usb.core.USBError as e:
             raise FtdiError('UsbError: %s' % str(e))
+        if self._tracer:
+            self._trace_ctrl(UsbTracer.CTRL_IN, reqtype, 0, self.index, data,
+                             length)
+        return data
+
+    def _trace_ctrl(self, kind, request, value, index, data=b'', length=0):
+        """Trace a control transfer, as its setup packet followed by the
+           transferred data"""
+        reqtype = kind == UsbTracer.CTRL_IN and Ftdi.REQ_IN or Ftdi.REQ_OUT
+        setup = spack('<BBHHH', reqtype, request, value, index,
+                      length or len(data))
+        self._tracer.trace(kind, 0, setup + bytes(data))
+
+    def _write_data(self, data):
+        """Write data in chunks to the chip, from the calling thread"""
+        offset = 0
+        size = len(data)
+        try:
+            while offset < size:
+                write_size = self.writebuffer_chunksize
+                if offset + write_size > size:
+                    write_size = size - offset
+                length = self._write(data[offset:offset+write_size])
+                if length <= 0:
+                    raise FtdiError("Usb bulk write error")
+                offset += length
+            return offset
+        except usb.core.USBError as e:
+            raise FtdiError('UsbError: %s' % str(e))
 
     def _write(self, data):
         """Write to FTDI, using the API introduced with pyusb 1.0.0b2"""
-        self.log.debug('> %s', hexlify(data).decode())
-        return self.usb_dev.write(self.in_ep, data, self.usb_write_timeout)
+        if self.log.isEnabledFor(DEBUG):
+            self.log.debug('> %s', hexlify(data).decode())
+        if self._tracer:
+            self._tracer.trace(UsbTracer.BULK_OUT, self.in_ep, data)
+        stats = self._stats
+        if not stats:
+            return self.usb_dev.write(self.in_ep, data, self.usb_write_timeout)
+        start = perf_counter()
+        length = self.usb_dev.write(self.in_ep, data, self.usb_write_timeout)
+        stats.record_write(length, perf_counter()-start)
+        return length
 
     def _read(self):
-        """Read from FTDI, using the API introduced with pyusb 1.0.0b2"""
-        data = self.usb_dev.read(self.out_ep, self.readbuffer_chunksize,
-                                 self.usb_read_timeout)
-        if data:
+        """Read from FTDI, using the API introduced with pyusb 1.0.0b2
+
+           :return: a view on the raw USB transfer buffer, only valid up to
+                    the next call
+        """
+        stats = self._stats
+        if stats:
+            start = perf_counter()
+        length = self.usb_dev.read(self.out_ep, self.rawbuffer,
+                                   self.usb_read_timeout)
+        if stats:
+            stats.record_read(length, perf_counter()-start)
+        data = memoryview(self.rawbuffer)[:length]
+        if self._tracer:
+            self._tracer.trace(UsbTracer.BULK_IN, self.out_ep, data)
+        if length and self.log.isEnabledFor(DEBUG):
             self.log.debug('< %s', hexlify(data).decode())
         return data
 
+    def _strip_status(self, rawbuf, payload):
+        """Copy the payload of a raw USB transfer into a buffer,
+           skipping the two modem status bytes leading every packet.
+
+           :param rawbuf: a view on the raw USB transfer
+           :param payload: the array to fill in, previous content is lost
+           :return: the count of payload bytes now available in the buffer
+        """
+        packet_size = self.max_packet_size
+        del payload[:]
+        payload.frombytes(rawbuf)
+        # drop the first status byte of each packet, then the second one,
+        # which has been shifted by one byte per preceding packet
+        del payload[0::packet_size]
+        del payload[0::packet_size-1]
+        return len(payload)
+
+    def _stream_loop(self, callback, chunksize):
+        """Reader thread: drain the device into the stream queue or the
+           stream callback, until the stream is stopped"""
+        rawbuffer = Array('B', bytes(chunksize))
+        rawview = memoryview(rawbuffer)
+        payload = Array('B')
+        stats = self._stats
+        try:
+            while not self._stream_stop.is_set():
+                start = stats and perf_counter()
+                try:
+                    length = self.usb_dev.read(self.out_ep, rawbuffer,
+                                               self.usb_read_timeout)
+                except usb.core.USBError as e:
+                    if e.errno == ETIMEDOUT:
+                        continue
+                    raise
+                if stats:
+                    stats.record_read(length, perf_counter()-start)
+                if self._tracer:
+                    self._tracer.trace(UsbTracer.BULK_IN, self.out_ep,
+                                       rawview[:length])
+                if length <= 2:
+                    # status-only packet, nothing received yet
+                    if self._latency_ctrl:
+                        self._latency_ctrl.on_read(0)
+                    continue
+                self._strip_status(rawview[:length], payload)
+                if self._latency_ctrl:
+                    self._latency_ctrl.on_read(len(payload))
+                chunk = payload.tobytes()
+                if callback:
+                    callback(chunk)
+                    continue
+                while not self._stream_stop.is_set():
+                    try:
+                        # block the reader when the consumer lags behind
+                        self._stream_queue.put(chunk, timeout=0.1)
+                        break
+                    except Full:
+                        continue
+        except Exception as e:
+            self.log.error('Stream reader stopped: %s', e)
+            self._stream_error = e
+
+    def _write_loop(self):
+        """Writer thread: send queued buffers in order, until stopped"""
+        while True:
+            item = self._write_queue.get()
+            if item is None:
+                break
+            future, data = item
+            if not future.set_running_or_notify_cancel():
+                with self._write_lock:
+                    self._write_pending -= len(data)
+                continue
+            offset = 0
+            size = len(data)
+            try:
+                while offset < size:
+                    length = self._write(
+                        data[offset:offset+self.writebuffer_chunksize])
+                    if length <= 0:
+                        raise FtdiError("Usb bulk write error")
+                    offset += length
+                    with self._write_lock:
+                        self._write_pending -= length
+            except Exception as e:
+                with self._write_lock:
+                    self._write_pending -= size-offset
+                if isinstance(e, usb.core.USBError):
+                    e = FtdiError('UsbError: %s' % str(e))
+                future.set_exception(e)
+            else:
+                future.set_result(offset)
+
     def _get_max_packet_size(self):
         """Retrieve the maximum length of a data packet"""
         if not self.usb_dev:
@@ -1046,8 +1541,13 @@ class Ftdi(object):
             index |= 1 << 9  # use hispeed mode
         return (best_baud, value, index)
 
-    def _set_frequency(self, frequency):
-        """Convert a frequency value into a TCK divisor setting"""
+    def build_frequency_command(self, frequency):
+        """Build the MPSSE command sequence that sets the clock frequency,
+           without sending it.
+
+           :param frequency: the requested frequency, in Hz
+           :return: a (command, actual frequency) tuple
+        """
         if frequency > self.frequency_max:
             raise FtdiFeatureError("Unsupported frequency: %f" % frequency)
         if frequency <= Ftdi.BUS_CLOCK_BASE:
@@ -1068,6 +1568,11 @@ class Ftdi(object):
         else:
             cmd = Array('B')
         cmd.extend((Ftdi.TCK_DIVISOR, divisor & 0xff, (divisor >> 8) & 0xff))
+        return cmd, actual_freq
+
+    def _set_frequency(self, frequency):
+        """Convert a frequency value into a TCK divisor setting"""
+        cmd, actual_freq = self.build_frequency_command(frequency)
         self.write_data(cmd)
         self.validate_mpsse()
         # Drain input buffer
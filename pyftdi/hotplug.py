@@ -0,0 +1,295 @@
+# Copyright (c) 2010-2017, Emmanuel Blot <emmanuel.blot@free.fr>
+# Copyright (c) 2016, Emmanuel Bouaziz <ebouaziz@free.fr>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the Neotion nor the names of its contributors may
+#       be used to endorse or promote products derived from this software
+#       without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL NEOTION BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Track the USB devices as they are connected and disconnected.
+
+   :Example:
+
+        def notify(event, device):
+            print(event, device.sn)
+
+        monitor = HotplugMonitor.get_default()
+        monitor.subscribe(notify)
+
+   While a :py:class:`HotplugMonitor` runs, the cache of the enumerated
+   devices of :py:class:`pyftdi.usbtools.UsbTools` is kept up to date, so
+   that URLs are resolved against the devices actually connected, without
+   flushing the cache.
+
+   pyusb does not expose the hotplug API of libusb. With the libusb 1.x
+   backend, the monitor registers a hotplug callback with the backend
+   libusb context, and only enumerates the devices when libusb reports an
+   event. With other backends, or if libusb does not support hotplug on the
+   host, the monitor enumerates the devices periodically.
+"""
+
+from ctypes import (CFUNCTYPE, POINTER, Structure, byref, c_int, c_long,
+                    c_uint32, c_void_p)
+from logging import getLogger
+from pyftdi.ftdi import Ftdi
+from pyftdi.usbtools import UsbTools
+from threading import Event, Lock, Thread
+
+__all__ = ['HotplugMonitor']
+
+
+class _Timeval(Structure):
+    _fields_ = [('tv_sec', c_long), ('tv_usec', c_long)]
+
+
+_HotplugCallback = CFUNCTYPE(c_int, c_void_p, c_void_p, c_int, c_void_p)
+
+
+class _LibUsbHotplug(object):
+    """Hotplug callback registered with the libusb context of a pyusb
+       libusb 1.x backend.
+
+       The callback is only used to wake up the monitor: libusb does not
+       allow to issue USB requests from a hotplug callback.
+    """
+
+    CAP_HAS_HOTPLUG = 0x0001
+    EVENT_DEVICE_ARRIVED = 0x01
+    EVENT_DEVICE_LEFT = 0x02
+    MATCH_ANY = -1
+
+    def __init__(self, backend, notify):
+        self._lib = backend.lib
+        self._ctx = backend.ctx
+        self._handle = c_int()
+        # keep a reference on the ctypes callback, or it would be collected
+        self._callback = _HotplugCallback(self._on_event)
+        self._notify = notify
+        rc = self._lib.libusb_hotplug_register_callback(
+            self._ctx, self.EVENT_DEVICE_ARRIVED | self.EVENT_DEVICE_LEFT,
+            0, self.MATCH_ANY, self.MATCH_ANY, self.MATCH_ANY,
+            self._callback, None, byref(self._handle))
+        if rc:
+            raise OSError('Cannot register hotplug callback: %d' % rc)
+
+    @staticmethod
+    def _declare(lib):
+        """Declare the prototypes of the libusb functions, so that pointers
+           and structures are not truncated to C int arguments.
+        """
+        lib.libusb_has_capability.argtypes = [c_uint32]
+        lib.libusb_has_capability.restype = c_int
+        lib.libusb_hotplug_register_callback.argtypes = [
+            c_void_p, c_int, c_int, c_int, c_int, c_int, _HotplugCallback,
+            c_void_p, POINTER(c_int)]
+        lib.libusb_hotplug_register_callback.restype = c_int
+        lib.libusb_hotplug_deregister_callback.argtypes = [c_void_p, c_int]
+        lib.libusb_hotplug_deregister_callback.restype = None
+        lib.libusb_handle_events_timeout_completed.argtypes = [
+            c_void_p, POINTER(_Timeval), POINTER(c_int)]
+        lib.libusb_handle_events_timeout_completed.restype = c_int
+
+    @classmethod
+    def create(cls, backend, notify):
+        """Register a hotplug callback if the backend supports it
+
+           :return: the registered callback, or None
+        """
+        lib = getattr(backend, 'lib', None)
+        if not getattr(backend, 'ctx', None) or \
+                not hasattr(lib, 'libusb_hotplug_register_callback'):
+            return None
+        try:
+            cls._declare(lib)
+            if not lib.libusb_has_capability(cls.CAP_HAS_HOTPLUG):
+                return None
+            return cls(backend, notify)
+        except (AttributeError, OSError):
+            return None
+
+    def wait(self, timeout):
+        """Handle the libusb events, calling back on hotplug events"""
+        tv = _Timeval(int(timeout), int((timeout % 1)*1E6))
+        self._lib.libusb_handle_events_timeout_completed(
+            self._ctx, byref(tv), None)
+
+    def close(self):
+        self._lib.libusb_hotplug_deregister_callback(self._ctx, self._handle)
+
+    def _on_event(self, ctx, device, event, user_data):
+        self._notify()
+        return 0
+
+
+class HotplugMonitor(object):
+    """Notify the subscribers of the USB devices that are connected or
+       disconnected, and keep the cache of the enumerated devices up to date.
+
+       :param vps: the (vendor, product) pairs of the devices to report,
+                   default to all the FTDI devices
+       :param period: the period of the device enumeration in seconds, when
+                      the USB backend does not support hotplug events
+    """
+
+    ARRIVED = 'arrived'
+    """Event of a device that has been connected"""
+
+    LEFT = 'left'
+    """Event of a device that has been disconnected"""
+
+    POLL_PERIOD = 1.0
+    """Default enumeration period, without hotplug support"""
+
+    _default = None
+    _default_lock = Lock()
+
+    def __init__(self, vps=None, period=None):
+        if vps is None:
+            vps = [(vendor, product) for vendor in Ftdi.PRODUCT_IDS
+                   for product in set(Ftdi.PRODUCT_IDS[vendor].values())]
+        self._vps = sorted(set(vps))
+        self._period = period or self.POLL_PERIOD
+        self._log = getLogger('pyftdi.hotplug')
+        self._lock = Lock()
+        self._subscribers = []
+        self._devices = {}
+        self._wakeup = Event()
+        self._stop = Event()
+        self._thread = None
+        self._hotplug = None
+
+    @classmethod
+    def get_default(cls):
+        """Return a shared monitor of the FTDI devices, started on first
+           use."""
+        with cls._default_lock:
+            if not cls._default:
+                cls._default = cls()
+                cls._default.start()
+            return cls._default
+
+    def subscribe(self, callback):
+        """Register a callable to be notified of the device events.
+
+           The callable receives the event, i.e. :py:attr:`ARRIVED` or
+           :py:attr:`LEFT`, and the
+           :py:class:`pyftdi.usbtools.UsbDeviceDescriptor` of the device. It
+           is called from the monitor thread.
+
+           :param callback: the callable to notify
+        """
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        """Unregister a callable registered with :py:meth:`subscribe`"""
+        with self._lock:
+            self._subscribers.remove(callback)
+
+    @property
+    def devices(self):
+        """Return the descriptors of the connected devices"""
+        with self._lock:
+            return list(self._devices.values())
+
+    @property
+    def is_event_driven(self):
+        """Tell whether the monitor relies on hotplug events rather than
+           on a periodic enumeration."""
+        return bool(self._hotplug)
+
+    @property
+    def is_running(self):
+        """Tell whether the monitor is started"""
+        return bool(self._thread)
+
+    def start(self):
+        """Start monitoring the USB devices.
+
+           The devices already connected are recorded, but not notified.
+        """
+        if self._thread:
+            return
+        self._hotplug = _LibUsbHotplug.create(UsbTools.get_backend(),
+                                              self._wakeup.set)
+        self._stop.clear()
+        self.scan(notify=False)
+        self._thread = Thread(target=self._run, name='HotplugMonitor')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop monitoring the USB devices"""
+        if not self._thread:
+            return
+        self._stop.set()
+        self._wakeup.set()
+        self._thread.join()
+        self._thread = None
+        if self._hotplug:
+            self._hotplug.close()
+            self._hotplug = None
+
+    def scan(self, notify=True):
+        """Enumerate the USB devices, update the device cache and notify
+           the changes.
+
+           This is the action the monitor performs on each hotplug event, or
+           periodically. It may also be called explicitly, to take a change
+           into account immediately.
+
+           :param notify: whether to notify the subscribers
+        """
+        UsbTools._refresh_devices()
+        devices = {}
+        for desc, _ in UsbTools.find_all(self._vps, descriptors=True):
+            devices[(desc.bus, desc.address, desc.vid, desc.pid)] = desc
+        with self._lock:
+            events = [(self.LEFT, desc) for location, desc
+                      in self._devices.items() if location not in devices]
+            events.extend((self.ARRIVED, desc) for location, desc
+                          in devices.items() if location not in self._devices)
+            self._devices = devices
+            subscribers = list(self._subscribers)
+        if not notify:
+            return
+        for event, desc in events:
+            for callback in subscribers:
+                try:
+                    callback(event, desc)
+                except Exception as ex:
+                    self._log.error('Hotplug subscriber error: %s', ex)
+
+    def _run(self):
+        while not self._stop.is_set():
+            if self._hotplug:
+                self._hotplug.wait(self._period)
+                if not self._wakeup.is_set():
+                    continue
+            else:
+                self._wakeup.wait(self._period)
+            self._wakeup.clear()
+            if self._stop.is_set():
+                break
+            try:
+                self.scan()
+            except Exception as ex:
+                self._log.error('Cannot enumerate USB devices: %s', ex)
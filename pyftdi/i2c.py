@@ -25,12 +25,12 @@
 
 from array import array as Array
 from binascii import hexlify
-from logging import getLogger
+from logging import DEBUG, getLogger
 from pyftdi.ftdi import Ftdi, FtdiFeatureError
 from struct import calcsize as scalc, pack as spack
 
 
-__all__ = ['I2cPort', 'I2cController']
+__all__ = ['I2cPort', 'I2cTransaction', 'I2cController']
 
 
 class I2cIOError(IOError):
@@ -91,7 +91,7 @@ class I2cPort(object):
            :param readlen: count of bytes to read out.
            :return: byte sequence of read out bytes
         """
-        return self._controller.read(self._address+self._shift,
+        return self._controller.read(self.address,
                                      readlen=readlen)
 
     def write(self, out):
@@ -99,7 +99,7 @@ class I2cPort(object):
 
            :param out: the byte buffer to send
         """
-        return self._controller.write(self._address+self._shift, out)
+        return self._controller.write(self.address, out)
 
     def read_from(self, regaddr, readlen=0):
         """Read one or more bytes from a remote slave
@@ -108,8 +108,8 @@ class I2cPort(object):
            :param readlen: count of bytes to read out.
            :return: byte sequence of read out bytes
         """
-        return self._controller.exchange(self._address+self._shift,
-                                         out=self._make_buffer(regaddr),
+        return self._controller.exchange(self.address,
+                                         out=self.make_buffer(regaddr),
                                          readlen=readlen)
 
     def write_to(self, regaddr, out):
@@ -118,8 +118,8 @@ class I2cPort(object):
            :param regaddr: slave register address to write to
            :param out: the byte buffer to send
         """
-        return self._controller.write(self._address+self._shift,
-                                      out=self._make_buffer(regaddr, out))
+        return self._controller.write(self.address,
+                                      out=self.make_buffer(regaddr, out))
 
     def exchange(self, out='', readlen=0):
         """Perform an exchange or a transaction with the I2c slave
@@ -131,7 +131,7 @@ class I2cPort(object):
            :return: byte sequence containing the data read out from the
                     slave
         """
-        return self._controller.exchange(self._address+self._shift, out,
+        return self._controller.exchange(self.address, out,
                                          readlen)
 
     def poll(self):
@@ -139,7 +139,7 @@ class I2cPort(object):
 
            :return: True if the slave acknowledged, False otherwise
         """
-        return self._controller.poll(self._address+self._shift)
+        return self._controller.poll(self.address)
 
     def flush(self):
         """Force the flush of the HW FIFOs.
@@ -152,7 +152,21 @@ class I2cPort(object):
         """
         return self._controller.frequency
 
-    def _make_buffer(self, regaddr, out=None):
+    @property
+    def address(self):
+        """Return the address of the slave on the I2C bus, including the
+           address shift"""
+        return self._address+self._shift
+
+    def make_buffer(self, regaddr, out=None):
+        """Build the byte buffer of a register access, i.e. the register
+           address encoded with the configured register format, followed
+           with the optional payload.
+
+           :param regaddr: slave register address
+           :param out: the optional byte buffer to append
+           :return: the byte buffer
+        """
         data = Array('B')
         data.extend(spack('%s%s' % (self._endian, self._format), regaddr))
         if out:
@@ -160,6 +174,80 @@ class I2cPort(object):
         return data.tobytes()
 
 
+class I2cTransaction(object):
+    """A sequence of I2C requests, executed as a whole.
+
+       An I2C transaction is never instanciated directly.
+
+       Use I2cController.transaction() method to obtain a transaction
+
+       Each request starts with a (repeated) START condition and the slave
+       address, the transaction ends with a single STOP condition. The whole
+       sequence is compiled into a single MPSSE command buffer, and the slave
+       acknowledgements and the read bytes are retrieved with a single USB
+       read, as long as the sequence fits into the FTDI FIFOs.
+
+       :Example:
+
+            trans = ctrl.transaction()
+            # select register 0x10, then read 4 bytes from it
+            trans.write(0x21, [0x10])
+            trans.read(0x21, 4)
+            data, = trans.execute()
+    """
+
+    def __init__(self, controller):
+        self._controller = controller
+        self._requests = []
+
+    def write(self, address, out):
+        """Append a write request to the transaction.
+
+           :param address: the address on the I2C bus
+           :param out: the byte buffer to send
+           :return: the transaction, so that requests can be chained
+        """
+        self._controller.validate_address(address)
+        if not out:
+            raise I2cIOError('Nothing to write')
+        i2caddress = (address << 1) & I2cController.HIGH
+        self._requests.append((i2caddress, bytes(out)))
+        return self
+
+    def read(self, address, readlen=1):
+        """Append a read request to the transaction.
+
+           :param address: the address on the I2C bus
+           :param readlen: count of bytes to read out.
+           :return: the transaction, so that requests can be chained
+        """
+        self._controller.validate_address(address)
+        if readlen < 1:
+            raise I2cIOError('Nothing to read')
+        i2caddress = (address << 1) & I2cController.HIGH
+        i2caddress |= I2cController.BIT0
+        self._requests.append((i2caddress, readlen))
+        return self
+
+    def execute(self, nacks=None):
+        """Execute the transaction.
+
+           If any byte is not acknowledged, an I2cNackError is raised once
+           the sequence has been executed. Its message tells the request
+           stage the NACK has been received from.
+
+           :param nacks: an optional dictionary. If defined, a NACK does
+                         not abort the sequence: the NACK message of each
+                         request which has not been acknowledged is stored
+                         into it, indexed by the rank of the request in the
+                         transaction, and no I2cNackError is raised
+           :return: a list with the received bytes of each read request
+        """
+        if not self._requests:
+            raise I2cIOError('Empty transaction')
+        return self._controller._do_transaction(self._requests, nacks)
+
+
 class I2cController(object):
     """I2c master.
     """
@@ -202,11 +290,13 @@ class I2cController(object):
         self._stop = clock_low_data_low*4 + data_low*4 + self._idle*4
         self._tx_size = 1
         self._rx_size = 1
+        self._batch = False
 
     def configure(self, url, **kwargs):
         """Configure the FTDI interface as a I2c master.
 
-           :param url: FTDI URL string, such as 'ftdi://ftdi:232h/1'
+           :param url: FTDI URL string, such as 'ftdi://ftdi:232h/1', or
+                       a :py:class:`pyftdi.ftdi.FtdiPortDescriptor`
            :param kwargs: options to configure the I2C bus
 
            Accepted options:
@@ -214,10 +304,15 @@ class I2cController(object):
            * ``frequency`` the I2C bus frequency in Hz
            * ``notristate`` drives the I2C SDA line actively high with FTDI
              devices that do not support drive-zero only mode.
+           * ``batch`` sends whole write sequences at once, and collects
+             all the slave acknowledgements with a single USB read. A NACK
+             is detected once the sequence completes, so bytes following
+             a NACK are still clocked out on the bus.
         """
         for k in ('direction', 'initial'):
             if k in kwargs:
                 del kwargs[k]
+        self._batch = bool(kwargs.pop('batch', False))
         if 'frequency' in kwargs:
             frequency = kwargs['frequency']
             del kwargs['frequency']
@@ -379,6 +474,35 @@ class I2cController(object):
             finally:
                 self._do_epilog()
 
+    def execute_transaction(self, transaction, attempts=None):
+        """Execute a transaction, and execute it again if a slave does not
+           acknowledge it, as read(), write() and exchange() do.
+
+           :param transaction: the I2cTransaction to execute
+           :param attempts: the maximum count of executions, default to
+                            RETRY_COUNT
+           :return: a list with the received bytes of each read request
+        """
+        attempts = self.RETRY_COUNT if attempts is None else attempts
+        while True:
+            try:
+                return transaction.execute()
+            except I2cNackError:
+                attempts -= 1
+                if attempts <= 0:
+                    raise
+                self.log.warning('Retry transaction')
+
+    def transaction(self):
+        """Create a new transaction, to combine several requests into a
+           single USB round-trip.
+
+           :return: an I2cTransaction instance
+        """
+        if not self._ftdi:
+            raise I2cIOError("FTDI controller not initialized")
+        return I2cTransaction(self)
+
     def poll(self, address):
         """Poll a remote slave, expect ACK or NACK.
 
@@ -463,7 +587,12 @@ class I2cController(object):
         return b''.join(chunks)
 
     def _do_write(self, out):
-        self.log.debug('- write %d bytes: %s', len(out), hexlify(out).decode())
+        if self.log.isEnabledFor(DEBUG):
+            self.log.debug('- write %d bytes: %s', len(out),
+                           hexlify(out).decode())
+        if self._batch:
+            self._do_batch_write(out)
+            return
         for byte in out:
             cmd = Array('B', self._write_byte)
             cmd.append(byte)
@@ -480,3 +609,121 @@ class I2cController(object):
                 msg = 'NACK from slave'
                 self.log.warning(msg)
                 raise I2cNackError(msg)
+
+    def _do_batch_write(self, out):
+        cmd_size = len(self._build_write([0]))
+        # limit the count of bytes to the count of I2C packable commands in
+        # the FTDI TX FIFO (minus one byte for the last 'send immediate'
+        # command), and to the count of ACK bits the RX FIFO can hold
+        chunk_size = min((self._tx_size-1) // cmd_size, self._rx_size-2)
+        for offset in range(0, len(out), chunk_size):
+            chunk = out[offset:offset+chunk_size]
+            cmd = self._build_write(chunk)
+            cmd.extend(self._immediate)
+            self._ftdi.write_data(cmd)
+            acks = self._ftdi.read_data_bytes(len(chunk), 4)
+            if len(acks) < len(chunk):
+                msg = 'No answer from FTDI'
+                self.log.critical(msg)
+                raise I2cIOError(msg)
+            for pos, ack in enumerate(acks):
+                if ack & self.BIT0:
+                    msg = 'NACK from slave on byte %d' % (offset+pos)
+                    self.log.warning(msg)
+                    raise I2cNackError(msg)
+
+    def _build_write(self, out):
+        # each byte is clocked out, then the slave ACK bit is sampled
+        write_suffix = self._clock_low_data_high + self._read_bit
+        cmd = Array('B')
+        for byte in out:
+            cmd.extend(self._write_byte)
+            cmd.append(byte)
+            cmd.extend(write_suffix)
+        return cmd
+
+    def _do_transaction(self, requests, nacks=None):
+        # when a nacks dictionary is given, the sequence is not aborted on
+        # a NACK: the first NACK message of each request is stored in it,
+        # by request index, so that the outcome of each request is known
+        self.log.debug('- transaction: %d requests', len(requests))
+        read_not_last = Array('B', self._read_byte)
+        read_not_last.extend(self._ack)
+        read_not_last.extend(self._clock_low_data_high)
+        read_last = Array('B', self._read_byte)
+        read_last.extend(self._nack)
+        read_last.extend(self._clock_low_data_high)
+        # each command unit is emitted along with the expected reply byte:
+        # either an ACK bit whose NACK message and request index are known,
+        # or a data byte to store in a result buffer
+        results = []
+        units = []
+        for index, (i2caddress, payload) in enumerate(requests):
+            cmd = Array('B', self._idle)
+            cmd.extend(self._start)
+            cmd.extend(self._build_write([i2caddress]))
+            units.append((cmd, ('NACK from slave on address 0x%02x' %
+                                (i2caddress >> 1), index)))
+            if i2caddress & self.BIT0:
+                result = Array('B')
+                results.append(result)
+                units.extend([(read_not_last, result)] * (payload-1))
+                units.append((read_last, result))
+            else:
+                # write payloads are built as with batched writes, one unit
+                # per byte so that the sequence may be split on any byte
+                for pos, byte in enumerate(payload):
+                    units.append((self._build_write([byte]),
+                                  ('NACK from slave on byte %d' % pos,
+                                   index)))
+        # limit each sequence to the FTDI TX FIFO (minus room for the STOP
+        # condition and the 'send immediate' command), and to the count of
+        # bytes the RX FIFO can hold
+        tx_size = self._tx_size-len(self._stop)
+        cmd = Array('B')
+        replies = []
+        stopped = False
+        try:
+            for unit, reply in units:
+                if ((len(cmd)+len(unit) >= tx_size) or
+                        (len(replies) >= self._rx_size-2)):
+                    self._do_sequence(cmd, replies, nacks)
+                    cmd = Array('B')
+                    replies = []
+                cmd.extend(unit)
+                replies.append(reply)
+            cmd.extend(self._stop)
+            stopped = True
+            self._do_sequence(cmd, replies, nacks)
+        except I2cNackError:
+            if not stopped:
+                self._ftdi.write_data(Array('B', self._stop))
+            raise
+        return [bytes(result) for result in results]
+
+    def _do_sequence(self, cmd, replies, nacks=None):
+        cmd.extend(self._immediate)
+        self._ftdi.write_data(cmd)
+        buf = Array('B')
+        while len(buf) < len(replies):
+            data = self._ftdi.read_data_bytes(len(replies)-len(buf), 4)
+            if not data:
+                msg = 'No answer from FTDI'
+                self.log.critical(msg)
+                raise I2cIOError(msg)
+            buf.extend(data)
+        nack = None
+        for byte, reply in zip(buf, replies):
+            if isinstance(reply, tuple):
+                if byte & self.BIT0:
+                    msg, index = reply
+                    if nacks is None:
+                        nack = nack or msg
+                    elif index not in nacks:
+                        self.log.warning(msg)
+                        nacks[index] = msg
+            else:
+                reply.append(byte)
+        if nack:
+            self.log.warning(nack)
+            raise I2cNackError(nack)
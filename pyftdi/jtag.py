@@ -420,10 +420,9 @@ class JtagEngine(object):
         self._sm = JtagStateMachine()
         self._seq = Array('B')
 
-    def configure(self, vendor=0x0403, product=0x6011, interface=0):
+    def configure(self, url):
         """Configure the FTDI interface as a JTAG controller"""
-        self._ctrl.configure(vendor=vendor, product=product,
-                             interface=interface)
+        self._ctrl.configure(url)
 
     def close(self):
         """Terminate a JTAG session/connection"""
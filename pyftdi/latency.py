@@ -0,0 +1,283 @@
+# Copyright (c) 2010-2017, Emmanuel Blot <emmanuel.blot@free.fr>
+# Copyright (c) 2016, Emmanuel Bouaziz <ebouaziz@free.fr>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the Neotion nor the names of its contributors may
+#       be used to endorse or promote products derived from this software
+#       without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL NEOTION BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Adaptive latency timer of FTDI devices.
+
+   The latency timer defines how long a FTDI device holds a partially
+   filled USB packet before sending it to the host. A short timer reduces
+   the delivery delay of sparse data, at the expense of more USB transfers,
+   i.e. more host wake-ups; a long timer does the opposite.
+
+   A :py:class:`LatencyPolicy` observes the traffic and tells which latency
+   timer value suits the current workload. A :py:class:`LatencyController`
+   applies the decisions of a policy to a device, and rate-limits the
+   control transfers this requires. Policies are installed with
+   :py:meth:`pyftdi.ftdi.Ftdi.set_latency_policy`.
+"""
+
+from threading import Lock
+from time import perf_counter
+
+__all__ = ['LatencyPolicy', 'ThresholdPolicy', 'InteractivePolicy',
+           'BulkPolicy', 'RequestResponsePolicy', 'LatencyController']
+
+
+class LatencyPolicy(object):
+    """Base class of latency policies, which tracks the traffic with
+       exponentially weighted moving averages (EWMA).
+
+       Sub-classes implement :py:meth:`choose`.
+
+       :param lmin: the lowest latency timer value, in milliseconds
+       :param lmax: the highest latency timer value, in milliseconds
+       :param alpha: the weight of the latest sample in the averages
+    """
+
+    LATENCY_MIN = 1
+    LATENCY_MAX = 255
+
+    def __init__(self, lmin=1, lmax=16, alpha=0.25):
+        for latency in (lmin, lmax):
+            if not (self.LATENCY_MIN <= latency <= self.LATENCY_MAX):
+                raise ValueError('Latency out of range: %d' % latency)
+        if lmin > lmax:
+            raise ValueError('Invalid latency range')
+        self.lmin = lmin
+        self.lmax = lmax
+        self.alpha = alpha
+        self.packet_size = 512
+        self.reset()
+
+    def reset(self, packet_size=None):
+        """Forget the observed traffic.
+
+           :param packet_size: the USB packet size of the device, if known
+        """
+        if packet_size:
+            self.packet_size = packet_size
+        self.gap = None
+        self.rate = None
+        self.last_data = None
+        self.last_write = None
+        self.empty_reads = 0
+
+    def on_read(self, now, length):
+        """Observe the outcome of a USB read.
+
+           :param now: the current time, in seconds
+           :param length: the count of received payload bytes
+           :return: the latency to use, or None to keep the current one
+        """
+        if length:
+            if self.last_data is not None:
+                delay = max(now-self.last_data, 1E-6)
+                self.gap = self._average(self.gap, delay)
+                self.rate = self._average(self.rate, length/delay)
+            self.last_data = now
+            self.empty_reads = 0
+        else:
+            self.empty_reads += 1
+        return self.choose(now, length)
+
+    def on_write(self, now, length):
+        """Observe a USB write.
+
+           :param now: the current time, in seconds
+           :param length: the count of written bytes
+           :return: the latency to use, or None to keep the current one
+        """
+        self.last_write = now
+        return None
+
+    def choose(self, now, length):
+        """Select the latency timer value after a read.
+
+           :return: the latency to use, or None to keep the current one
+        """
+        raise NotImplementedError('Policy does not choose')
+
+    def idle_time(self, now):
+        """Return the time elapsed since the last received data"""
+        if self.last_data is None:
+            return None
+        return now-self.last_data
+
+    def _average(self, average, sample):
+        if average is None:
+            return sample
+        return self.alpha*sample + (1-self.alpha)*average
+
+
+class ThresholdPolicy(LatencyPolicy):
+    """Two-level policy: the lowest latency is used as soon as data are
+       received, the highest one once more than ``threshold`` reads in a
+       row have returned no data.
+
+       :param threshold: the count of empty reads before switching to the
+                         highest latency
+    """
+
+    def __init__(self, lmin=2, lmax=200, threshold=400):
+        super(ThresholdPolicy, self).__init__(lmin, lmax)
+        self.threshold = threshold
+
+    def choose(self, now, length):
+        if length:
+            return self.lmin
+        if self.empty_reads > self.threshold:
+            return self.lmax
+        return None
+
+
+class InteractivePolicy(LatencyPolicy):
+    """Policy for interactive, low-volume traffic such as a console.
+
+       The lowest latency is used while data keep flowing, so that each
+       character is delivered right away. Once the line has been silent for
+       ``idle`` seconds, the highest latency is used to limit the host
+       wake-ups.
+
+       :param idle: the silence duration before relaxing the latency
+    """
+
+    def __init__(self, lmin=1, lmax=32, idle=0.5):
+        super(InteractivePolicy, self).__init__(lmin, lmax)
+        self.idle = idle
+
+    def choose(self, now, length):
+        if length:
+            return self.lmin
+        idle = self.idle_time(now)
+        if idle is None or idle > self.idle:
+            return self.lmax
+        return None
+
+
+class BulkPolicy(LatencyPolicy):
+    """Policy for a continuous stream, such as a UART data logger.
+
+       The latency timer is set close to the time the observed throughput
+       takes to fill a USB packet, so that most packets are sent full, while
+       the tail of a burst is not held longer than required. As an empty
+       read denotes a pause in the stream, the highest latency is used
+       until data flow again.
+
+       :param margin: the ratio applied to the packet fill time
+    """
+
+    def __init__(self, lmin=2, lmax=64, margin=1.5):
+        super(BulkPolicy, self).__init__(lmin, lmax)
+        self.margin = margin
+
+    def choose(self, now, length):
+        if not length or not self.rate:
+            return self.lmax
+        fill_time = (self.packet_size-2)/self.rate
+        latency = int(1000*self.margin*fill_time)+1
+        return max(self.lmin, min(self.lmax, latency))
+
+
+class RequestResponsePolicy(LatencyPolicy):
+    """Policy for request/response protocols, such as MPSSE.
+
+       Replies are expected right after each request, so the lowest latency
+       is selected whenever a request is sent after an idle period. Once no
+       request has been sent for ``idle`` seconds, the highest latency is
+       used to limit the host wake-ups of background reads.
+
+       :param idle: the inactivity duration before relaxing the latency
+    """
+
+    def __init__(self, lmin=1, lmax=16, idle=0.2):
+        super(RequestResponsePolicy, self).__init__(lmin, lmax)
+        self.idle = idle
+
+    def on_write(self, now, length):
+        super(RequestResponsePolicy, self).on_write(now, length)
+        return self.lmin
+
+    def choose(self, now, length):
+        if self.last_write is None or now-self.last_write > self.idle:
+            return self.lmax
+        return None
+
+
+class LatencyController(object):
+    """Apply the decisions of a latency policy to a FTDI device.
+
+       Changing the latency timer requires a control transfer, which is
+       costly. Changes are therefore not issued more often than once per
+       ``holdoff`` seconds; a change requested within this period is
+       deferred to the next observed transfer.
+
+       The controller may be fed from several threads, e.g. a background
+       reader and the writer.
+
+       :param ftdi: the FTDI device, or any object with a ``latency``
+                    attribute and a ``set_latency_timer()`` method
+       :param policy: the :py:class:`LatencyPolicy` to apply
+       :param holdoff: the minimum delay between two latency changes, in
+                       seconds
+       :param clock: the time source
+    """
+
+    def __init__(self, ftdi, policy, holdoff=0.05, clock=None):
+        self.ftdi = ftdi
+        self.policy = policy
+        self.holdoff = holdoff
+        self.changes = 0
+        self._clock = clock or perf_counter
+        self._last_change = None
+        self._pending = None
+        self._lock = Lock()
+        policy.reset(getattr(ftdi, 'max_packet_size', None))
+
+    def on_read(self, length):
+        """Report a USB read of length payload bytes"""
+        with self._lock:
+            now = self._clock()
+            self._apply(now, self.policy.on_read(now, length))
+
+    def on_write(self, length):
+        """Report a USB write of length bytes"""
+        with self._lock:
+            now = self._clock()
+            self._apply(now, self.policy.on_write(now, length))
+
+    def _apply(self, now, latency):
+        if latency is None:
+            latency = self._pending
+        if latency is None or latency == self.ftdi.latency:
+            self._pending = None
+            return
+        if self._last_change is not None and \
+                now-self._last_change < self.holdoff:
+            self._pending = latency
+            return
+        self._pending = None
+        self._last_change = now
+        self.changes += 1
+        self.ftdi.set_latency_timer(latency)
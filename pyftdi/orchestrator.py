@@ -0,0 +1,313 @@
+# Copyright (c) 2010-2017, Emmanuel Blot <emmanuel.blot@free.fr>
+# Copyright (c) 2016, Emmanuel Bouaziz <ebouaziz@free.fr>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the Neotion nor the names of its contributors may
+#       be used to endorse or promote products derived from this software
+#       without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL NEOTION BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Run the same job on many FTDI devices in parallel.
+
+   :Example:
+
+        def program(spi):
+            flash = spi.get_port(0)
+            ...
+            return checksum
+
+        orchestrator = Orchestrator(serials, 'ftdi://ftdi:2232h:{serial}/1',
+                                    interface='spi', device_bandwidth=4E6)
+        for result in orchestrator.run(program):
+            print(result.serial, result.ok, result.open_time,
+                  result.run_time)
+
+   Each job opens its own device, and is run from a thread pool, or from a
+   process pool for a complete isolation of the devices. Jobs are dispatched
+   so that the USB traffic they are expected to generate does not exceed the
+   bandwidth of the USB bus their device is connected to: the count of
+   concurrent jobs is bounded per bus, not by the count of CPUs.
+"""
+
+from collections import deque
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
+from multiprocessing import get_context
+from pyftdi.ftdi import Ftdi, FtdiPortDescriptor
+from pyftdi.misc import to_int
+from pyftdi.usbtools import UsbTools
+from time import perf_counter
+from traceback import format_exc
+from urllib.parse import urlsplit
+
+__all__ = ['DeviceResult', 'Orchestrator']
+
+
+class DeviceResult(object):
+    """Outcome of a job on a device.
+
+       :param serial: the serial number of the device
+       :param url: the URL of the device port
+       :param bus: the USB bus of the device, if known
+    """
+
+    def __init__(self, serial, url, bus=None):
+        self.serial = serial
+        self.url = url
+        self.bus = bus
+        self.result = None
+        self.error = None
+        self.traceback = None
+        self.open_time = None
+        self.run_time = None
+
+    def __repr__(self):
+        return '<%s %s %s>' % (self.__class__.__name__, self.serial,
+                               'ok' if self.ok else repr(self.error))
+
+    @property
+    def ok(self):
+        """Tell whether the job has completed without error"""
+        return self.error is None
+
+
+def open_interface(interface, url, options):
+    """Open the controller of a device port.
+
+       :param interface: one of :py:attr:`Orchestrator.INTERFACES`
+       :param url: the URL or the :py:class:`pyftdi.ftdi.FtdiPortDescriptor`
+                   of the device port
+       :param options: the keyword arguments of the controller
+       :return: the controller
+    """
+    if interface == 'ftdi':
+        ftdi = Ftdi()
+        ftdi.open_from_url(url)
+        return ftdi
+    if interface == 'spi':
+        from pyftdi.spi import SpiController
+        ctrl = SpiController(**options)
+        ctrl.configure(url)
+        return ctrl
+    if interface == 'i2c':
+        from pyftdi.i2c import I2cController
+        ctrl = I2cController()
+        ctrl.configure(url, **options)
+        return ctrl
+    if interface == 'jtag':
+        from pyftdi.jtag import JtagEngine
+        ctrl = JtagEngine(**options)
+        ctrl.configure(url)
+        return ctrl
+    if interface == 'gpio':
+        from pyftdi.gpio import GpioController
+        ctrl = GpioController()
+        ctrl.open_from_url(url, **options)
+        return ctrl
+    raise ValueError('Unsupported interface: %s' % interface)
+
+
+def close_interface(interface, ctrl):
+    """Close a controller opened with :py:func:`open_interface`"""
+    if interface in ('spi', 'i2c'):
+        ctrl.terminate()
+    else:
+        ctrl.close()
+
+
+def run_job(job, args, result, target, interface, options):
+    """Open a device, run a job on it, then close it.
+
+       This function is called from the worker threads or processes.
+
+       :param target: the URL or the port descriptor of the device
+       :return: the completed :py:class:`DeviceResult`
+    """
+    start = perf_counter()
+    try:
+        ctrl = open_interface(interface, target, options)
+        opened = perf_counter()
+        result.open_time = opened-start
+        try:
+            result.result = job(ctrl, *args)
+        finally:
+            result.run_time = perf_counter()-opened
+            close_interface(interface, ctrl)
+    except Exception as ex:
+        result.error = ex
+        result.traceback = format_exc()
+    return result
+
+
+class Orchestrator(object):
+    """Run the same job on several FTDI devices, in parallel.
+
+       The job is a callable, which receives the open controller of the
+       device port, followed with the extra arguments of :py:meth:`run`.
+       With worker processes, the job and its arguments should be picklable,
+       e.g. a module-level function.
+
+       :param serials: the serial numbers of the devices
+       :param url: the URL of the port to open on each device, where
+                   ``{serial}`` is replaced with the serial number
+       :param interface: the controller of the port, see
+                         :py:attr:`INTERFACES`
+       :param options: the keyword arguments of the controller
+       :param processes: run the jobs from worker processes, rather than
+                         from threads
+       :param device_bandwidth: the USB throughput a job is expected to
+                                use, in bytes per second. If not defined,
+                                jobs are not limited per bus
+       :param bus_bandwidth: the usable USB throughput of a bus, in bytes
+                             per second
+       :param workers: the maximum count of concurrent jobs, default to the
+                       count the bus bandwidth allows
+    """
+
+    INTERFACES = ('ftdi', 'spi', 'i2c', 'jtag', 'gpio')
+    """Supported controllers"""
+
+    BUS_BANDWIDTH = 40E6
+    """Usable payload throughput of a USB 2.0 high-speed bus"""
+
+    def __init__(self, serials, url='ftdi://ftdi:2232h:{serial}/1',
+                 interface='ftdi', options=None, processes=False,
+                 device_bandwidth=None, bus_bandwidth=None, workers=None):
+        if interface not in self.INTERFACES:
+            raise ValueError('Unsupported interface: %s' % interface)
+        self.serials = list(serials)
+        self.url = url
+        self.interface = interface
+        self.options = dict(options or {})
+        self.processes = processes
+        self.device_bandwidth = device_bandwidth
+        self.bus_bandwidth = bus_bandwidth or self.BUS_BANDWIDTH
+        self.workers = workers
+        self._devices = None
+
+    def locate(self):
+        """Find out the USB bus of each device.
+
+           :return: a dictionary of serial numbers, whose values are the
+                    USB bus numbers, or None for the devices not found
+        """
+        return {serial: dev and dev.bus
+                for serial, dev in self._locate().items()}
+
+    def _locate(self):
+        if self._devices is None:
+            wanted = set(self.serials)
+            devices = {}
+            vendor = Ftdi.FTDI_VENDOR
+            vps = [(vendor, product) for product in
+                   sorted(set(Ftdi.PRODUCT_IDS[vendor].values()))]
+            for dev, _ in UsbTools.find_all(vps, descriptors=True):
+                if dev.sn in wanted:
+                    devices[dev.sn] = dev
+            self._devices = {serial: devices.get(serial)
+                             for serial in self.serials}
+        return self._devices
+
+    @property
+    def bus_limit(self):
+        """Return the maximum count of concurrent jobs on a USB bus, or
+           None if not limited"""
+        if not self.device_bandwidth:
+            return None
+        return max(1, int(self.bus_bandwidth // self.device_bandwidth))
+
+    def plan(self):
+        """Return the maximum count of concurrent jobs"""
+        limit = self.bus_limit
+        counts = {}
+        for bus in self.locate().values():
+            counts[bus] = counts.get(bus, 0)+1
+        workers = sum(count if limit is None or bus is None else
+                      min(count, limit) for bus, count in counts.items())
+        if self.workers:
+            workers = min(workers, self.workers)
+        return max(1, workers)
+
+    def run(self, job, *args):
+        """Run the job on each device.
+
+           Errors are reported per device, they do not stop the other jobs.
+
+           :return: a list of :py:class:`DeviceResult`, in serial number
+                    order
+        """
+        devices = self._locate()
+        limit = self.bus_limit
+        workers = self.plan()
+        try:
+            port = to_int(urlsplit(self.url).path.strip('/'))
+        except ValueError:
+            port = None
+        queues = {}
+        for pos, serial in enumerate(self.serials):
+            dev = devices[serial]
+            result = DeviceResult(serial, self.url.format(serial=serial),
+                                  dev and dev.bus)
+            # located devices are handed over to the workers with their
+            # descriptor, which spares a new enumeration in each worker
+            target = FtdiPortDescriptor(dev, port) if dev and port else \
+                result.url
+            queues.setdefault(result.bus, deque()).append(
+                (pos, result, target))
+        results = [None] * len(self.serials)
+        running = {}
+        busy = {bus: 0 for bus in queues}
+        with self._executor(workers) as executor:
+            while queues or running:
+                for bus in list(queues):
+                    queue = queues[bus]
+                    while queue and len(running) < workers and (
+                            limit is None or bus is None or
+                            busy[bus] < limit):
+                        pos, result, target = queue.popleft()
+                        future = executor.submit(run_job, job, args, result,
+                                                 target, self.interface,
+                                                 self.options)
+                        running[future] = (pos, result)
+                        busy[bus] += 1
+                    if not queue:
+                        del queues[bus]
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pos, result = running.pop(future)
+                    busy[result.bus] -= 1
+                    try:
+                        results[pos] = future.result()
+                    except Exception as ex:
+                        # the worker could not run the job at all, e.g. it
+                        # could not be pickled
+                        result.error = ex
+                        results[pos] = result
+        return results
+
+    def _executor(self, workers):
+        if not self.processes:
+            return ThreadPoolExecutor(workers)
+        try:
+            # do not inherit the USB context of the parent process
+            return ProcessPoolExecutor(workers,
+                                       mp_context=get_context('spawn'))
+        except TypeError:
+            return ProcessPoolExecutor(workers)
@@ -0,0 +1,376 @@
+# Copyright (c) 2010-2017, Emmanuel Blot <emmanuel.blot@free.fr>
+# Copyright (c) 2016, Emmanuel Bouaziz <ebouaziz@free.fr>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the Neotion nor the names of its contributors may
+#       be used to endorse or promote products derived from this software
+#       without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL NEOTION BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""asyncio support for FTDI serial ports.
+
+   Ports opened with :py:func:`create_serial_connection` or
+   :py:func:`open_serial_connection` do not own any thread: the USB
+   transfers of all the ports are performed by a single :py:class:`FtdiHub`
+   thread, which hands the received data over to the event loop.
+
+   pyusb does not expose the asynchronous transfers of libusb, so the hub
+   performs synchronous transfers, servicing the ports in turn. A read
+   returns at the latest when the latency timer of the device expires, so
+   the hub configures a short latency timer on its ports, and a sweep over
+   N idle ports still lasts up to N times this timer. The shared hubs
+   therefore service at most :py:attr:`FtdiHub.MAX_PORTS` ports each, and
+   ports that need a short response time may be given their own hub.
+"""
+
+import asyncio
+from collections import deque
+from pyftdi.ftdi import Ftdi
+from pyftdi.usbtools import UsbToolsError
+from serial import SerialException
+from threading import Event, Lock, Thread
+
+__all__ = ['FtdiHub', 'FtdiTransport', 'create_serial_connection',
+           'open_serial_connection']
+
+
+class FtdiHub(object):
+    """Perform the USB transfers of several FTDI serial ports from a single
+       thread.
+
+       The thread is started when the first port is attached, and stops
+       once the last one is detached. A shared hub is then also discarded.
+
+       :param latency: the latency timer of the ports, in milliseconds
+       :param max_ports: the count of ports a shared hub accepts, see
+                         :py:meth:`get_default`
+    """
+
+    LATENCY = 2
+    """Default latency timer of the ports"""
+
+    IDLE_WAIT = 0.1
+    """Longest wait when no port needs to be serviced"""
+
+    MAX_PORTS = 8
+    """Default count of ports serviced by a shared hub"""
+
+    _defaults = []
+    _default_lock = Lock()
+
+    def __init__(self, latency=None, max_ports=None):
+        self.latency = latency or self.LATENCY
+        self.max_ports = max_ports or self.MAX_PORTS
+        self._transports = []
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._thread = None
+
+    @classmethod
+    def get_default(cls):
+        """Return a hub shared by the ports opened without an explicit hub.
+
+           Each read of an idle port may last up to the latency timer, so a
+           shared hub only accepts max_ports ports: another hub, with its
+           own thread, is created once all the shared hubs are full.
+        """
+        with cls._default_lock:
+            for hub in cls._defaults:
+                if hub.ports < hub.max_ports:
+                    return hub
+            hub = cls()
+            cls._defaults.append(hub)
+            return hub
+
+    @property
+    def ports(self):
+        """Return the count of attached ports"""
+        with self._lock:
+            return len(self._transports)
+
+    def attach(self, transport):
+        """Service a transport from the hub thread"""
+        with self._lock:
+            self._transports.append(transport)
+            if not self._thread:
+                self._thread = Thread(target=self._run, name='FtdiHub')
+                self._thread.daemon = True
+                self._thread.start()
+        self._wakeup.set()
+
+    def detach(self, transport):
+        """Stop servicing a transport"""
+        with self._lock:
+            if transport in self._transports:
+                self._transports.remove(transport)
+            empty = not self._transports
+        if empty:
+            self._discard()
+        self._wakeup.set()
+
+    def wakeup(self):
+        """Tell the hub some transport has work to do"""
+        self._wakeup.set()
+
+    def _discard(self):
+        """Stop sharing an empty hub, so that the shared hubs do not pile up
+           as ports are opened and closed.
+        """
+        # a port that selected the hub just before it is discarded is still
+        # serviced, as with a private hub
+        cls = self.__class__
+        with cls._default_lock:
+            if self in cls._defaults and not self.ports:
+                cls._defaults.remove(self)
+
+    def _run(self):
+        while True:
+            self._wakeup.clear()
+            with self._lock:
+                transports = list(self._transports)
+                if not transports:
+                    self._thread = None
+                    return
+            busy = False
+            for transport in transports:
+                busy |= transport._service()
+            if not busy:
+                self._wakeup.wait(self.IDLE_WAIT)
+
+
+class FtdiTransport(asyncio.Transport):
+    """asyncio transport of a FTDI serial port.
+
+       The USB transfers are performed from the hub thread, whereas the
+       transport methods and the protocol callbacks are only called from
+       the event loop.
+
+       :param loop: the event loop
+       :param protocol: the protocol to feed with received data
+       :param ftdi: the open FTDI port
+       :param hub: the :py:class:`FtdiHub` to service the port
+    """
+
+    def __init__(self, loop, protocol, ftdi, hub):
+        super(FtdiTransport, self).__init__({'ftdi': ftdi})
+        self._loop = loop
+        self._protocol = protocol
+        self._ftdi = ftdi
+        self._hub = hub
+        self._lock = Lock()
+        self._tx_queue = deque()
+        self._tx_size = 0
+        self._high_water = 64 << 10
+        self._low_water = 16 << 10
+        self._writing_paused = False
+        self._reading = True
+        self._closing = False
+        self._aborting = False
+        self._closed = False
+        loop.call_soon(protocol.connection_made, self)
+        hub.attach(self)
+
+    # event loop side
+
+    def get_protocol(self):
+        return self._protocol
+
+    def set_protocol(self, protocol):
+        self._protocol = protocol
+
+    def is_closing(self):
+        return self._closing
+
+    def close(self):
+        """Close the transport once the buffered data have been sent"""
+        if self._closing:
+            return
+        self._closing = True
+        self._hub.wakeup()
+
+    def abort(self):
+        """Close the transport, discarding the buffered data"""
+        with self._lock:
+            self._tx_queue.clear()
+            self._tx_size = 0
+        self._aborting = True
+        self.close()
+
+    def is_reading(self):
+        return self._reading and not self._closing
+
+    def pause_reading(self):
+        self._reading = False
+
+    def resume_reading(self):
+        self._reading = True
+        self._hub.wakeup()
+
+    def write(self, data):
+        if self._closing or not data:
+            return
+        with self._lock:
+            self._tx_queue.append(bytes(data))
+            self._tx_size += len(data)
+            size = self._tx_size
+        self._hub.wakeup()
+        if not self._writing_paused and size > self._high_water:
+            self._writing_paused = True
+            self._protocol.pause_writing()
+
+    def can_write_eof(self):
+        return False
+
+    def get_write_buffer_size(self):
+        return self._tx_size
+
+    def get_write_buffer_limits(self):
+        return self._low_water, self._high_water
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        if high is None:
+            high = 64 << 10 if low is None else 4*low
+        if low is None:
+            low = high // 4
+        if not 0 <= low <= high:
+            raise ValueError('Invalid write buffer limits')
+        self._high_water = high
+        self._low_water = low
+
+    def _sent(self):
+        if self._writing_paused and self._tx_size <= self._low_water:
+            self._writing_paused = False
+            self._protocol.resume_writing()
+
+    def _lost(self, exc):
+        self._closing = True
+        self._protocol.connection_lost(exc)
+        self._protocol = None
+
+    # hub side
+
+    def _service(self):
+        """Perform the pending USB transfers, from the hub thread.
+
+           :return: whether some transfer has been performed
+        """
+        if self._closing and (self._aborting or not self._tx_queue):
+            self._finalize(None)
+            return False
+        busy = False
+        with self._lock:
+            data = self._tx_queue.popleft() if self._tx_queue else None
+            chunksize = self._ftdi.writebuffer_chunksize
+            if data and len(data) > chunksize:
+                # do not hold the hub for too long
+                self._tx_queue.appendleft(data[chunksize:])
+                data = data[:chunksize]
+        try:
+            if data:
+                busy = True
+                self._ftdi.write_data(data)
+                with self._lock:
+                    self._tx_size -= len(data)
+                self._post(self._sent)
+            if self._reading and not self._closing:
+                busy = True
+                data = self._ftdi.read_data_chunk()
+                if data:
+                    self._post(self._protocol.data_received, data.tobytes())
+        except Exception as ex:
+            self._finalize(ex)
+        return busy
+
+    def _post(self, callback, *args):
+        try:
+            self._loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:
+            # the event loop is closed, nobody is left to notify
+            self._closing = True
+            self._aborting = True
+
+    def _finalize(self, exc):
+        if self._closed:
+            return
+        self._closed = True
+        self._hub.detach(self)
+        try:
+            self._ftdi.close()
+        except Exception:
+            pass
+        self._post(self._lost, exc)
+
+
+async def create_serial_connection(loop, protocol_factory, url,
+                                   baudrate=115200, bytesize=8, parity='N',
+                                   stopbits=1, rtscts=False, xonxoff=False,
+                                   hub=None):
+    """Open a FTDI serial port as an asyncio transport.
+
+       The arguments follow the ones of :py:class:`serial.Serial`.
+
+       :param loop: the event loop
+       :param protocol_factory: a callable that returns the protocol
+       :param url: the FTDI URL of the port
+       :param hub: the :py:class:`FtdiHub` to service the port, default to
+                   a hub shared with other ports
+       :return: a (transport, protocol) pair
+    """
+    latency = hub.latency if hub else FtdiHub.LATENCY
+
+    def open_port():
+        ftdi = Ftdi.create_from_url(url)
+        try:
+            ftdi.set_latency_timer(latency)
+            ftdi.set_baudrate(baudrate)
+            ftdi.set_line_property(bytesize, stopbits, parity)
+            ftdi.set_flowctrl('hw' if rtscts else 'sw' if xonxoff else '')
+        except Exception:
+            ftdi.close()
+            raise
+        return ftdi
+    try:
+        # USB control transfers are blocking
+        ftdi = await loop.run_in_executor(None, open_port)
+    except (UsbToolsError, IOError, ValueError) as ex:
+        raise SerialException('Unable to open USB port %s: %s' %
+                              (url, str(ex)))
+    protocol = protocol_factory()
+    # the shared hub is only selected once the port is open, so that the
+    # ports opened concurrently are spread over the shared hubs
+    transport = FtdiTransport(loop, protocol, ftdi,
+                              hub or FtdiHub.get_default())
+    return transport, protocol
+
+
+async def open_serial_connection(url, limit=64 << 10, loop=None, **kwargs):
+    """Open a FTDI serial port as a (StreamReader, StreamWriter) pair.
+
+       :param url: the FTDI URL of the port
+       :param limit: the buffer limit of the StreamReader
+       :param kwargs: see :py:func:`create_serial_connection`
+    """
+    loop = loop or asyncio.get_event_loop()
+    reader = asyncio.StreamReader(limit=limit)
+    protocol = asyncio.StreamReaderProtocol(reader)
+    transport, _ = await create_serial_connection(loop, lambda: protocol,
+                                                  url, **kwargs)
+    writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+    return reader, writer
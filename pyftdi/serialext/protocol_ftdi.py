@@ -25,25 +25,101 @@
 # EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 from io import RawIOBase
+from concurrent.futures import (CancelledError,
+                                TimeoutError as FutureTimeoutError)
 from pyftdi.ftdi import Ftdi
 from pyftdi.usbtools import UsbToolsError
-from serial import SerialBase, SerialException, VERSION as pyserialver
-from time import sleep, time as now
+from serial import (SerialBase, SerialException, SerialTimeoutException,
+                    VERSION as pyserialver)
+from threading import Condition
+from time import monotonic as now
 
 __all__ = ['Serial']
 
 
+class RxRingBuffer(object):
+    """Fixed-size FIFO of received bytes.
+
+       The buffer is not thread-safe: callers are expected to serialize
+       their accesses.
+
+       :param size: the capacity of the buffer, in bytes
+    """
+
+    def __init__(self, size):
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._head = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def free(self):
+        """Return the count of bytes that may be pushed"""
+        return len(self._buffer)-self._count
+
+    def push(self, data):
+        """Append as many bytes as possible.
+
+           :return: the count of appended bytes
+        """
+        size = len(self._buffer)
+        length = min(len(data), size-self._count)
+        tail = (self._head+self._count) % size
+        first = min(length, size-tail)
+        self._view[tail:tail+first] = data[:first]
+        self._view[:length-first] = data[first:length]
+        self._count += length
+        return length
+
+    def pop(self, length):
+        """Remove and return up to length bytes."""
+        size = len(self._buffer)
+        length = min(length, self._count)
+        first = min(length, size-self._head)
+        data = self._buffer[self._head:self._head+first]
+        data += self._view[:length-first]
+        self._head = (self._head+length) % size
+        self._count -= length
+        return data
+
+    def clear(self):
+        """Discard the buffered bytes"""
+        self._head = 0
+        self._count = 0
+
+
 class FtdiSerial(SerialBase):
     """Base class for Serial port implementation compatible with pyserial API
        using a USB device.
+
+       A background reader drains the device into a receive buffer, so that
+       data are available as soon as they are received, and writes are sent
+       from a background writer.
+
+       write() waits for the data to be sent, up to the write timeout, as
+       with any pyserial port. When :py:attr:`async_write` is enabled,
+       write() only queues the data, and USB errors are reported by the
+       next write() or flush() call.
     """
 
+    RX_BUFFER_SIZE = 256 << 10
+    """Size of the receive buffer. When it is full, the device is no longer
+       drained, so that hardware flow control may throttle the sender."""
+
+    POLL_PERIOD = 0.1
+    """Period to check the health of the background reader while waiting"""
+
     BAUDRATES = sorted([9600 * (x+1) for x in range(6)] +
                        list(range(115200, 1000000, 115200)) +
                        list(range(1000000, 13000000, 100000)))
 
     PYSERIAL_VERSION = tuple([int(x) for x in pyserialver.split('.')])
 
+    _async_write = False
+
     def makeDeviceName(self, port):
         return port
 
@@ -57,50 +133,114 @@ class FtdiSerial(SerialBase):
             raise SerialException('Unable to open USB port %s: %s' %
                                   (self.portstr, str(ex)))
         self.udev = device
+        self._rx_buffer = RxRingBuffer(self.RX_BUFFER_SIZE)
+        self._rx_cond = Condition()
+        self._tx_future = None
+        self._tx_error = None
         self._set_open_state(True)
         self._reconfigure_port()
+        try:
+            self.udev.start_write_pipeline()
+            self.udev.start_stream(self._receive)
+        except IOError as ex:
+            self.close()
+            raise SerialException('Unable to start USB port %s: %s' %
+                                  (self.portstr, str(ex)))
 
     def close(self):
         """Close the open port"""
-        self._set_open_state(False)
+        if not self.is_open:
+            return
+        with self._rx_cond:
+            self._set_open_state(False)
+            # release the reader, if it waits for free space
+            self._rx_cond.notify_all()
         self.udev.close()
         self.udev = None
 
     def read(self, size=1):
         """Read size bytes from the serial port. If a timeout is set it may
-           return less characters as requested. With no timeout it will block
-           until the requested number of bytes is read."""
+           return less characters as requested, as soon as some data are
+           available. With no timeout it will block until the requested
+           number of bytes is read. A zero timeout only returns the
+           characters already received."""
         data = bytearray()
-        start = now()
-        while size > 0:
-            buf = self.udev.read_data(size)
-            data += buf
-            size -= len(buf)
-            if self._timeout > 0:
-                if buf:
-                    break
-                ms = now()-start
-                if ms > self._timeout:
+        timeout = self._timeout
+        deadline = None if timeout is None else now()+timeout
+        with self._rx_cond:
+            while True:
+                if self._rx_buffer:
+                    data += self._rx_buffer.pop(size-len(data))
+                    # let the reader resume if it waits for free space
+                    self._rx_cond.notify_all()
+                if len(data) >= size or (data and timeout):
                     break
-            sleep(0.01)
-        return data
+                error = self.udev.stream_error
+                if error:
+                    raise SerialException('USB read error: %s' % error)
+                if deadline is None:
+                    wait = self.POLL_PERIOD
+                else:
+                    wait = min(deadline-now(), self.POLL_PERIOD)
+                    if wait <= 0:
+                        break
+                self._rx_cond.wait(wait)
+        return bytes(data)
 
     def write(self, data):
-        """Output the given string over the serial port."""
-        self.udev.write_data(data)
+        """Output the given string over the serial port.
+
+           Wait until the data are sent, unless asynchronous writes are
+           enabled or the write timeout is zero, in which case the data are
+           queued to the background writer: use flush() to wait for their
+           completion."""
+        self._check_tx_error()
+        future = self.udev.write_data_async(data)
+        future.add_done_callback(self._sent)
+        self._tx_future = future
+        if self._async_write or self._write_timeout == 0:
+            return len(data)
+        try:
+            future.result(self._write_timeout)
+        except FutureTimeoutError:
+            # do not send the data later on, if they are still queued
+            future.cancel()
+            raise SerialTimeoutException('Write timeout')
+        except CancelledError:
+            # the output buffer has been reset meanwhile
+            pass
+        except IOError:
+            # reported below
+            pass
+        self._check_tx_error()
+        return len(data)
 
     def flush(self):
         """Flush of file like objects. In this case, wait until all data
            is written."""
-        pass
+        if self._tx_future:
+            try:
+                self._tx_future.result()
+            except IOError:
+                # reported below
+                pass
+        self._check_tx_error()
 
     def reset_input_buffer(self):
         """Clear input buffer, discarding all that is in the buffer."""
         self.udev.purge_rx_buffer()
+        with self._rx_cond:
+            self._rx_buffer.clear()
+            self._rx_cond.notify_all()
 
     def reset_output_buffer(self):
         """Clear output buffer, aborting the current output and
         discarding all that is in the buffer."""
+        # the data queued in the write pipeline would otherwise be sent
+        # once the chip FIFO has been purged
+        self.udev.cancel_pending_writes()
+        if self._tx_future and self._tx_future.cancelled():
+            self._tx_future = None
         self.udev.purge_tx_buffer()
 
     def send_break(self, duration=0.25):
@@ -138,16 +278,25 @@ class FtdiSerial(SerialBase):
         """Read terminal status line: Carrier Detect"""
         return self.udev.get_cd()
 
+    @property
+    def async_write(self):
+        """Tell whether write() returns as soon as the data are queued"""
+        return self._async_write
+
+    @async_write.setter
+    def async_write(self, enable):
+        self._async_write = bool(enable)
+
     @property
     def in_waiting(self):
         """Return the number of characters currently in the input buffer."""
-        # not implemented
-        return 0
+        with self._rx_cond:
+            return len(self._rx_buffer)
 
     @property
     def out_waiting(self):
         """Return the number of bytes currently in the output buffer."""
-        return 0
+        return self.udev.write_pending
 
     @property
     def fifoSizes(self):
@@ -178,6 +327,31 @@ class FtdiSerial(SerialBase):
     def _set_open_state(self, open_):
         self.is_open = bool(open_)
 
+    def _receive(self, data):
+        """Store received data, called from the background reader"""
+        with self._rx_cond:
+            while True:
+                count = self._rx_buffer.push(data)
+                if count:
+                    self._rx_cond.notify_all()
+                data = data[count:]
+                if not data or not self.is_open:
+                    return
+                # the buffer is full, hold the reader until some data are
+                # consumed
+                self._rx_cond.wait(self.POLL_PERIOD)
+
+    def _sent(self, future):
+        """Record the first write error, called on write completion"""
+        if not future.cancelled() and future.exception() and \
+                not self._tx_error:
+            self._tx_error = future.exception()
+
+    def _check_tx_error(self):
+        error, self._tx_error = self._tx_error, None
+        if error:
+            raise SerialException('USB write error: %s' % error)
+
 
 # assemble Serial class with the platform specific implementation and the base
 # for file-like behavior.
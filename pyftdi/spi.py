@@ -26,10 +26,15 @@
 
 import struct
 from array import array as Array
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from itertools import chain
 from pyftdi.ftdi import Ftdi
+from pyftdi.stats import Histogram
+from threading import Lock, RLock, get_ident
 
 
-__all__ = ['SpiPort', 'SpiController']
+__all__ = ['SpiPort', 'SpiBatch', 'SpiController']
 
 
 class SpiIOError(IOError):
@@ -58,6 +63,8 @@ class SpiPort(object):
             out.extend(spi.exchange([], 2, False, True))
     """
 
+    TEMPLATE_CACHE_SIZE = 64
+
     def __init__(self, controller, cs, cs_hold=3, spi_mode=0):
         self._controller = controller
         self._cpol = spi_mode & 0x1
@@ -76,15 +83,23 @@ class SpiPort(object):
                        [Ftdi.SET_BITS_LOW, cs_clock, controller.direction] *
                   int(cs_hold))
         self._frequency = self._controller.frequency
+        if self._cpol ^ self._cpha:
+            self._write_op = Ftdi.WRITE_BYTES_PVE_MSB
+            self._read_op = Ftdi.READ_BYTES_PVE_MSB
+            self._rw_op = Ftdi.RW_BYTES_PVE_PVE_MSB
+        else:
+            self._write_op = Ftdi.WRITE_BYTES_NVE_MSB
+            self._read_op = Ftdi.READ_BYTES_NVE_MSB
+            self._rw_op = Ftdi.RW_BYTES_NVE_NVE_MSB
+        self._templates = OrderedDict()
 
     def exchange(self, out='', readlen=0, start=True, stop=True):
         """Perform an exchange or a transaction with the SPI slave
 
            .. note:: Exchange is a dual half-duplex transmission: output bytes
                      are sent to the slave, then bytes are received from the
-                     slave. It is not possible to perform a full duplex
-                     exchange for now, although this feature could be easily
-                     implemented.
+                     slave. See exchange_duplex() for a full duplex
+                     exchange.
 
            :param out: an array of bytes to send to the SPI slave,
                        may be empty to only read out data from the slave
@@ -97,26 +112,119 @@ class SpiPort(object):
                        False if the transaction should complete with a further
                        call to exchange()
            :return: an array of bytes containing the data read out from the
-                    slave
+                    slave, or a Future of it if a batch is active
         """
         return self._controller._exchange(self._frequency, out, readlen,
                                           start and self._cs_cmd,
                                           stop and self._cs_release,
-                                          self._cpol, self._cpha)
+                                          self._cpol, self._cpha,
+                                          self._template(len(out), readlen,
+                                                         start, stop))
+
+    def exchange_duplex(self, out, start=True, stop=True):
+        """Perform a full duplex exchange with the SPI slave: each byte
+           sent to the slave clocks in a byte from the slave.
+
+           Payloads larger than the FTDI FIFOs are streamed in chunks,
+           without releasing the /CS line.
+
+           :param out: an array of bytes to send to the SPI slave
+           :param start: whether to start an SPI transaction, i.e. activate
+                         the /CS line for the slave. Use False to resume a
+                         previously started transaction
+           :param stop: whether to desactivete the /CS line for the slave. Use
+                       False if the transaction should complete with a further
+                       call to exchange()
+           :return: an array of bytes containing the data read out from the
+                    slave, as long as the output buffer, or a Future of it if
+                    a batch is active
+        """
+        return self._controller._exchange_duplex(self._frequency, out,
+                                                 start and self._cs_cmd,
+                                                 stop and self._cs_release,
+                                                 self._cpha, self._rw_op)
+
+    def read_stream(self, readlen, out=b'', start=True, stop=True):
+        """Read out a payload of any size from the SPI slave, as a sequence
+           of chunks, without releasing the /CS line in between.
+
+           The payload is not limited to PAYLOAD_MAX_LENGTH: chunks are sized
+           after the FTDI FIFO, and the next chunk is requested before the
+           current one is read back.
+
+           :param readlen: count of bytes to read out from the slave
+           :param out: an array of bytes to send to the SPI slave before the
+                       payload is read out, such as a read command
+           :param start: whether to start an SPI transaction
+           :param stop: whether to desactivete the /CS line once the whole
+                        payload has been read out, or the generator is closed
+           :return: a generator of byte arrays
+        """
+        if readlen < 1:
+            raise SpiIOError('Nothing to read')
+        return self._controller._read_stream(self._frequency, out, readlen,
+                                             start and self._cs_cmd,
+                                             stop and self._cs_release,
+                                             self._cpol, self._cpha)
+
+    def read_into(self, sink, readlen, out=b'', start=True, stop=True):
+        """Read out a payload of any size from the SPI slave into a
+           file-like object.
+
+           :param sink: an object with a write() method
+           :param readlen: count of bytes to read out from the slave
+           :param out: an array of bytes to send to the SPI slave before the
+                       payload is read out, such as a read command
+           :return: the count of read bytes
+        """
+        count = 0
+        for chunk in self.read_stream(readlen, out, start, stop):
+            sink.write(chunk.tobytes())
+            count += len(chunk)
+        return count
+
+    def write_stream(self, source, out=b'', start=True, stop=True):
+        """Write a payload of any size to the SPI slave, without releasing
+           the /CS line in between.
+
+           :param source: a bytes-like object, a file-like object with a
+                          read() method, or an iterable of byte buffers such
+                          as a generator
+           :param out: an array of bytes to send to the SPI slave before the
+                       payload, such as a write command
+           :param start: whether to start an SPI transaction
+           :param stop: whether to desactivete the /CS line once the whole
+                        payload has been sent
+           :return: the count of bytes written from the source
+        """
+        if out:
+            if len(out) > SpiController.PAYLOAD_MAX_LENGTH:
+                raise SpiIOError("Output payload is too large")
+            source = chain((bytes(out),), self._controller._iter_chunks(
+                source, SpiController.PAYLOAD_MAX_LENGTH))
+        count = self._controller._write_stream(self._frequency, source,
+                                               start and self._cs_cmd,
+                                               stop and self._cs_release,
+                                               self._cpol, self._cpha)
+        return count-len(out)
 
     def read(self, readlen=0, start=True, stop=True):
         """Read out bytes from the slave"""
         return self._controller._exchange(self._frequency, [], readlen,
                                           start and self._cs_cmd,
                                           stop and self._cs_release,
-                                          self._cpol, self._cpha)
+                                          self._cpol, self._cpha,
+                                          self._template(0, readlen,
+                                                         start, stop))
 
     def write(self, out, start=True, stop=True):
         """Write bytes to the slave"""
         return self._controller._exchange(self._frequency, out, 0,
                                           start and self._cs_cmd,
                                           stop and self._cs_release,
-                                          self._cpol, self._cpha)
+                                          self._cpol, self._cpha,
+                                          self._template(len(out), 0,
+                                                         start, stop))
 
     def flush(self):
         """Force the flush of the HW FIFOs"""
@@ -131,6 +239,180 @@ class SpiPort(object):
         """Return the current SPI bus block"""
         return self._frequency
 
+    def _template(self, writelen, readlen, start, stop):
+        """Return the MPSSE command sequences that surround the payload of
+           an exchange, i.e. /CS activation and write header as a prolog,
+           read header and /CS release as an epilog.
+
+           Templates are built once per transfer shape, so that an exchange
+           only needs to insert its payload between them. The most recently
+           used templates are kept, up to TEMPLATE_CACHE_SIZE.
+        """
+        # payload sizes should be validated before their length is encoded
+        if writelen > SpiController.PAYLOAD_MAX_LENGTH:
+            raise SpiIOError("Output payload is too large")
+        if readlen > SpiController.PAYLOAD_MAX_LENGTH:
+            raise SpiIOError("Input payload is too large")
+        key = (writelen, readlen, start, stop)
+        try:
+            template = self._templates[key]
+            self._templates.move_to_end(key)
+            return template
+        except KeyError:
+            pass
+        prolog = Array('B')
+        if start:
+            prolog.extend(self._cs_cmd)
+        if writelen:
+            prolog.frombytes(SpiController.HEADER.pack(self._write_op,
+                                                       writelen-1))
+        epilog = Array('B')
+        if readlen:
+            epilog.frombytes(SpiController.HEADER.pack(self._read_op,
+                                                       readlen-1))
+            epilog.append(Ftdi.SEND_IMMEDIATE)
+        if stop:
+            epilog.extend(self._cs_release)
+            epilog.extend(self._controller._cs_high)
+        template = (prolog.tobytes(), epilog.tobytes())
+        self._templates[key] = template
+        if len(self._templates) > self.TEMPLATE_CACHE_SIZE:
+            self._templates.popitem(last=False)
+        return template
+
+
+class SpiBatch(object):
+    """Deferred execution of SPI exchanges.
+
+       A SPI batch is never instanciated directly.
+
+       Use SpiController.batch() method to obtain a SPI batch
+
+       While a batch is active, exchanges on any port of the controller are
+       not executed right away: their MPSSE commands, including /CS and clock
+       changes, are accumulated and sent in as few USB transfers as possible
+       when the batch completes. Each exchange returns a Future, whose result
+       is the data read out from the slave. The data read out by a single
+       exchange should fit into the FTDI RX FIFO.
+
+       :Example:
+
+            with ctrl.batch() as batch:
+                jedec = flash.exchange([0x9f], 3)
+                flash.exchange([0x06])
+                status = flash.exchange([0x05], 1)
+            print(jedec.result(), status.result())
+            # or, in exchange order
+            print(batch.results)
+    """
+
+    def __init__(self, controller):
+        self._controller = controller
+        self._cmd = Array('B')
+        self._pending = []
+        self._readlen = 0
+        self._futures = []
+        self._state = None
+
+    def __enter__(self):
+        self._controller._start_batch(self)
+        self._state = self._controller._save_state()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.flush()
+            else:
+                self._cancel()
+        finally:
+            self._controller._stop_batch()
+
+    @property
+    def results(self):
+        """Return the data read out from each exchange, in order"""
+        return [future.result() for future in self._futures]
+
+    def flush(self):
+        """Send all accumulated commands and complete their futures"""
+        if not self._cmd:
+            return
+        ftdi = self._controller._ftdi
+        cmd = self._cmd
+        pending = self._pending
+        readlen = self._readlen
+        self._cmd = Array('B')
+        self._pending = []
+        self._readlen = 0
+        try:
+            if readlen:
+                cmd.append(Ftdi.SEND_IMMEDIATE)
+            ftdi.write_data(cmd)
+            data = Array('B')
+            while len(data) < readlen:
+                buf = ftdi.read_data_bytes(readlen-len(data), 4)
+                if not buf:
+                    raise SpiIOError('No answer from FTDI')
+                data.extend(buf)
+        except Exception as e:
+            for future, _ in pending:
+                future.set_exception(e)
+            raise
+        self._state = self._controller._save_state()
+        offset = 0
+        for future, length in pending:
+            future.set_result(data[offset:offset+length])
+            offset += length
+
+    def _append(self, cmd, readlen):
+        """Queue the command sequence of an exchange"""
+        # the replies of a segment should fit into the FTDI RX FIFO, as the
+        # device would otherwise stall on the commands still to be received
+        rx_size = self._controller._rx_size
+        if self._readlen and (self._readlen+readlen > rx_size):
+            self.flush()
+        future = Future()
+        future.set_running_or_notify_cancel()
+        self._cmd.extend(cmd)
+        self._pending.append((future, readlen))
+        self._futures.append(future)
+        self._readlen += readlen
+        if self._readlen >= rx_size:
+            self.flush()
+        return future
+
+    def _cancel(self):
+        """Discard the commands not yet sent"""
+        for future, _ in self._pending:
+            future.set_exception(SpiIOError('Batch aborted'))
+        self._cmd = Array('B')
+        self._pending = []
+        self._readlen = 0
+        # the clock settings of the discarded commands have not been applied
+        self._controller._restore_state(self._state)
+
+
+class SpiRequest(object):
+    """An exchange queued by a thread-safe SPI controller, waiting for a
+       thread to execute it"""
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.done = False
+        self.result = None
+        self.error = None
+
+    def complete(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.done = True
+
+    def outcome(self):
+        if self.error:
+            raise self.error
+        return self.result
+
 
 class SpiController(object):
     """SPI master.
@@ -139,6 +421,12 @@ class SpiController(object):
         :param int cs_count: is the number of /CS lines (one per device to
             drive on the SPI bus)
         :param boolean turbo: to be documented
+        :param boolean thread_safe: whether the ports may be used from
+            several threads. Each thread then owns the bus for a whole
+            transaction, i.e. until the /CS line is released, or for a whole
+            batch or stream. Small exchanges issued concurrently are merged
+            into a single USB transfer by whichever thread gets the bus
+            first. See get_queue_statistics()
     """
 
     SCK_BIT = 0x01
@@ -146,8 +434,10 @@ class SpiController(object):
     DI_BIT = 0x04
     CS_BIT = 0x08
     PAYLOAD_MAX_LENGTH = 0x10000  # 16 bits max
+    HEADER = struct.Struct('<BH')  # MPSSE opcode, length-1
 
-    def __init__(self, silent_clock=False, cs_count=4, turbo=True):
+    def __init__(self, silent_clock=False, cs_count=4, turbo=True,
+                 thread_safe=False):
         self._ftdi = Ftdi()
         self._cs_bits = (((SpiController.CS_BIT << cs_count) - 1) &
                          ~(SpiController.CS_BIT - 1))
@@ -165,6 +455,18 @@ class SpiController(object):
         self._immediate = Array('B', (Ftdi.SEND_IMMEDIATE,))
         self._frequency = 0.0
         self._clock_phase = False
+        self._tx_size = 0
+        self._rx_size = 0
+        self._batch = None
+        self._thread_safe = thread_safe
+        self._lock = RLock()
+        self._owner = None
+        self._holds = 0
+        self._in_transaction = False
+        self._queue = deque()
+        self._queue_lock = Lock()
+        self._queue_depth = Histogram()
+        self._batch_size = Histogram()
 
     @property
     def direction(self):
@@ -178,13 +480,18 @@ class SpiController(object):
         self._frequency = self._ftdi.open_mpsse_from_url(
             # /CS all high
             url, direction=self._direction, initial=self._cs_bits, **kwargs)
+        self._tx_size, self._rx_size = self._ftdi.fifo_sizes
         self._ftdi.enable_adaptive_clock(False)
 
     def terminate(self):
         """Close the FTDI interface"""
-        if self._ftdi:
-            self._ftdi.close()
-            self._ftdi = None
+        self._acquire()
+        try:
+            if self._ftdi:
+                self._ftdi.close()
+                self._ftdi = None
+        finally:
+            self._release()
 
     def get_port(self, cs, freq=None, mode=0):
         """Obtain a SPI port to drive a SPI device selected by cs
@@ -206,13 +513,52 @@ class SpiController(object):
         if mode == 2:
             raise SpiIOError("SPI mode 2 has no known workaround with FTDI "
                              "devices")
-        if not self._ports[cs]:
-            freq = min(freq or self.frequency_max, self.frequency_max)
-            hold = freq and (1+int(1E6/freq))
-            self._ports[cs] = SpiPort(self, cs, cs_hold=hold, spi_mode=mode)
-            self._ports[cs].set_frequency(freq)
-            self._flush()
-        return self._ports[cs]
+        if self._ports[cs]:
+            return self._ports[cs]
+        self._acquire()
+        try:
+            if not self._ports[cs]:
+                freq = min(freq or self.frequency_max, self.frequency_max)
+                hold = freq and (1+int(1E6/freq))
+                self._ports[cs] = SpiPort(self, cs, cs_hold=hold,
+                                          spi_mode=mode)
+                self._ports[cs].set_frequency(freq)
+                self._flush()
+            return self._ports[cs]
+        finally:
+            self._release()
+
+    def batch(self):
+        """Obtain a batch context, to defer the execution of exchanges
+           on any port until the batch completes.
+
+           :rtype: SpiBatch
+        """
+        if not self._ftdi:
+            raise SpiIOError("FTDI controller not initialized")
+        if self._batch and not self._thread_safe:
+            raise SpiIOError("A batch is already active")
+        return SpiBatch(self)
+
+    def get_queue_statistics(self):
+        """Return the statistics of the exchange queue of a thread-safe
+           controller, as a dictionary:
+
+           * ``queued``: the count of exchanges currently waiting,
+           * ``depth``: the summary of the queue depth seen by each queued
+             exchange,
+           * ``batch``: the summary of the count of exchanges merged into
+             each USB transfer.
+
+           :return: the statistics, or an empty dictionary if the controller
+                    is not thread-safe
+        """
+        if not self._thread_safe:
+            return {}
+        with self._queue_lock:
+            return {'queued': len(self._queue),
+                    'depth': self._queue_depth.snapshot(),
+                    'batch': self._batch_size.snapshot()}
 
     @property
     def frequency_max(self):
@@ -225,7 +571,17 @@ class SpiController(object):
         return self._frequency
 
     def _exchange(self, frequency, out, readlen, cs_cmd=None, cs_release=None,
-                  cpol=False, cpha=False):
+                  cpol=False, cpha=False, template=None):
+        if not self._thread_safe:
+            return self._do_exchange(frequency, out, readlen, cs_cmd,
+                                     cs_release, cpol, cpha, template)
+        return self._schedule(self._do_exchange,
+                              (frequency, out, readlen, cs_cmd, cs_release,
+                               cpol, cpha, template),
+                              cs_cmd, cs_release, len(out)+readlen)
+
+    def _do_exchange(self, frequency, out, readlen, cs_cmd=None,
+                     cs_release=None, cpol=False, cpha=False, template=None):
         """Perform a half-duplex exchange or transaction with the SPI slave
 
            :param frequency: SPI bus clock
@@ -239,8 +595,11 @@ class SpiController(object):
            :param cs_release: the epilog sequence to send to move the
                        /CS line back to the idle state. May be empty to if
                        another part of a transaction is expected
+           :param template: the precompiled prolog and epilog of the
+                       exchange, which supersede the /CS sequences and the
+                       transfer headers
            :return: an array of bytes containing the data read out from the
-                    slave
+                    slave, or a Future of it if a batch is active
         """
         if not self._ftdi:
             raise SpiIOError("FTDI controller not initialized")
@@ -255,10 +614,22 @@ class SpiController(object):
             # which implies the FTDI frequency should be fixed to match the
             # requested one.
             frequency = (3*frequency)//2
-        if self._frequency != frequency:
-            self._ftdi.set_frequency(frequency)
-            # store the requested value, not the actual one (best effort)
-            self._frequency = frequency
+        if self._batch:
+            # the replies of a batch are only read back once its commands
+            # have been sent, they should fit into the RX FIFO
+            if readlen > self._rx_size:
+                raise SpiIOError("Payload is too large for a batch")
+            transfer = self._transfer_command(out, readlen, cpol, cpha)
+            return self._batch_exchange(frequency, transfer, readlen, cs_cmd,
+                                        cs_release, cpha)
+        self._set_clock(frequency, cpha)
+        if template and self._turbo:
+            prolog, epilog = template
+            self._ftdi.write_data(b''.join((prolog, out and bytes(out) or b'',
+                                            epilog)))
+            if readlen:
+                return self._ftdi.read_data_bytes(readlen, 4)
+            return Array('B')
         cmd = cs_cmd and Array('B', cs_cmd) or Array('B')
         if cs_release:
             epilog = Array('B', cs_release)
@@ -266,20 +637,8 @@ class SpiController(object):
         else:
             epilog = None
         writelen = len(out)
-        if self._clock_phase != cpha:
-            self._ftdi.enable_3phase_clock(cpha)
-            self._clock_phase = cpha
-        if writelen:
-            wcmd = (cpol ^ cpha) and \
-                Ftdi.WRITE_BYTES_PVE_MSB or Ftdi.WRITE_BYTES_NVE_MSB
-            write_cmd = struct.pack('<BH', wcmd, writelen-1)
-            cmd.frombytes(write_cmd)
-            cmd.extend(out)
+        cmd.extend(self._transfer_command(out, readlen, cpol, cpha))
         if readlen:
-            rcmd = (cpol ^ cpha) and \
-                Ftdi.READ_BYTES_PVE_MSB or Ftdi.READ_BYTES_NVE_MSB
-            read_cmd = struct.pack('<BH', rcmd, readlen-1)
-            cmd.frombytes(read_cmd)
             cmd.extend(self._immediate)
             if self._turbo:
                 if epilog:
@@ -305,7 +664,402 @@ class SpiController(object):
             data = Array('B')
         return data
 
+    def _exchange_duplex(self, frequency, out, cs_cmd, cs_release, cpha,
+                         rw_op):
+        if not self._thread_safe:
+            return self._do_exchange_duplex(frequency, out, cs_cmd,
+                                            cs_release, cpha, rw_op)
+        return self._schedule(self._do_exchange_duplex,
+                              (frequency, out, cs_cmd, cs_release, cpha,
+                               rw_op),
+                              cs_cmd, cs_release, 2*len(out))
+
+    def _do_exchange_duplex(self, frequency, out, cs_cmd, cs_release, cpha,
+                            rw_op):
+        """Perform a full-duplex exchange or transaction with the SPI slave
+
+           :param frequency: SPI bus clock
+           :param out: an array of bytes to send to the SPI slave
+           :param cs_cmd: the prolog sequence to activate the /CS line on the
+                       SPI bus. May be empty to resume a previously started
+                       transaction
+           :param cs_release: the epilog sequence to send to move the
+                       /CS line back to the idle state. May be empty to if
+                       another part of a transaction is expected
+           :param rw_op: the MPSSE read/write opcode
+           :return: an array of bytes containing the data read out from the
+                    slave, or a Future of it if a batch is active
+        """
+        if not self._ftdi:
+            raise SpiIOError("FTDI controller not initialized")
+        if cpha:
+            # see _exchange()
+            frequency = (3*frequency)//2
+        # two chunks may be in flight: the one being shifted, and the one
+        # whose replies wait for the host in the RX FIFO
+        chunk_size = min(self._tx_size//2, self._rx_size//2,
+                         SpiController.PAYLOAD_MAX_LENGTH)
+        chunks = [out[pos:pos+chunk_size]
+                  for pos in range(0, len(out), chunk_size)]
+        if self._batch:
+            if len(out) > self._rx_size:
+                raise SpiIOError("Payload is too large for a batch")
+            transfer = Array('B')
+            for chunk in chunks:
+                transfer.frombytes(self.HEADER.pack(rw_op, len(chunk)-1))
+                transfer.extend(chunk)
+            return self._batch_exchange(frequency, transfer, len(out),
+                                        cs_cmd, cs_release, cpha)
+        self._set_clock(frequency, cpha)
+        data = Array('B')
+        pending = []
+        cmd = cs_cmd and Array('B', cs_cmd) or Array('B')
+        for pos, chunk in enumerate(chunks, 1):
+            cmd.frombytes(self.HEADER.pack(rw_op, len(chunk)-1))
+            cmd.extend(chunk)
+            cmd.extend(self._immediate)
+            if pos < len(chunks):
+                self._ftdi.write_data(cmd)
+                cmd = Array('B')
+            pending.append(len(chunk))
+            if len(pending) > 1:
+                data.extend(self._read_exactly(pending.pop(0)))
+        if cs_release:
+            cmd.extend(cs_release)
+            cmd.extend(self._cs_high)
+        if cmd:
+            self._ftdi.write_data(cmd)
+        for length in pending:
+            data.extend(self._read_exactly(length))
+        return data
+
+    def _read_stream(self, frequency, out, readlen, cs_cmd, cs_release,
+                     cpol, cpha):
+        # validate now rather than on first iteration of the generator
+        if not self._ftdi:
+            raise SpiIOError("FTDI controller not initialized")
+        if self._batch:
+            raise SpiIOError("Streams cannot be batched")
+        if len(out) > SpiController.PAYLOAD_MAX_LENGTH:
+            raise SpiIOError("Output payload is too large")
+        stream = self._do_read_stream(frequency, out, readlen, cs_cmd,
+                                      cs_release, cpol, cpha)
+        if not self._thread_safe:
+            return stream
+        return self._locked_stream(stream, cs_release)
+
+    def _do_read_stream(self, frequency, out, readlen, cs_cmd, cs_release,
+                        cpol, cpha):
+        """Send a command, then read out a payload of any size from the SPI
+           slave, as a generator of chunks.
+
+           Two chunks are in flight: the read command of the next chunk is
+           submitted before the current chunk is read back.
+
+           Arguments are validated by the caller, as a generator only runs
+           once it is first iterated.
+        """
+        if cpha:
+            # see _exchange()
+            frequency = (3*frequency)//2
+        self._set_clock(frequency, cpha)
+        rcmd = (cpol ^ cpha) and \
+            Ftdi.READ_BYTES_PVE_MSB or Ftdi.READ_BYTES_NVE_MSB
+        chunk_size = min(self._rx_size//2, SpiController.PAYLOAD_MAX_LENGTH)
+        cmd = cs_cmd and Array('B', cs_cmd) or Array('B')
+        cmd.extend(self._transfer_command(out, 0, cpol, cpha))
+        pending = []
+        remaining = readlen
+        try:
+            while remaining:
+                size = min(remaining, chunk_size)
+                remaining -= size
+                cmd.frombytes(self.HEADER.pack(rcmd, size-1))
+                cmd.extend(self._immediate)
+                if not remaining and cs_release:
+                    cmd.extend(cs_release)
+                    cmd.extend(self._cs_high)
+                    cs_release = None
+                self._ftdi.write_data(cmd)
+                cmd = Array('B')
+                pending.append(size)
+                if len(pending) > 1:
+                    yield self._read_exactly(pending.pop(0))
+            while pending:
+                yield self._read_exactly(pending.pop(0))
+        finally:
+            if pending or cs_release:
+                # the stream has been interrupted: discard the replies in
+                # flight, and move the /CS line back to the idle state
+                while pending:
+                    self._read_exactly(pending.pop(0))
+                if cs_release:
+                    cmd = Array('B', cs_release)
+                    cmd.extend(self._cs_high)
+                    self._ftdi.write_data(cmd)
+
+    def _write_stream(self, frequency, source, cs_cmd, cs_release, cpol,
+                      cpha):
+        if not self._thread_safe:
+            return self._do_write_stream(frequency, source, cs_cmd,
+                                         cs_release, cpol, cpha)
+        return self._schedule(self._do_write_stream,
+                              (frequency, source, cs_cmd, cs_release, cpol,
+                               cpha),
+                              cs_cmd, cs_release, None)
+
+    def _do_write_stream(self, frequency, source, cs_cmd, cs_release, cpol,
+                         cpha):
+        """Write a payload of any size to the SPI slave.
+
+           Chunks are handed over to the FTDI write pipeline, so that the
+           next chunk is retrieved from the source while the current one is
+           sent.
+        """
+        if not self._ftdi:
+            raise SpiIOError("FTDI controller not initialized")
+        if self._batch:
+            raise SpiIOError("Streams cannot be batched")
+        if cpha:
+            # see _exchange()
+            frequency = (3*frequency)//2
+        self._set_clock(frequency, cpha)
+        wcmd = (cpol ^ cpha) and \
+            Ftdi.WRITE_BYTES_PVE_MSB or Ftdi.WRITE_BYTES_NVE_MSB
+        pipelined = self._ftdi.is_write_pipelined
+        if not pipelined:
+            self._ftdi.start_write_pipeline()
+        futures = []
+        count = 0
+        try:
+            cmd = cs_cmd and Array('B', cs_cmd) or Array('B')
+            for chunk in self._iter_chunks(source,
+                                           SpiController.PAYLOAD_MAX_LENGTH):
+                cmd.frombytes(self.HEADER.pack(wcmd, len(chunk)-1))
+                cmd.extend(chunk)
+                futures.append(self._ftdi.write_data_async(cmd))
+                cmd = Array('B')
+                count += len(chunk)
+                # report USB errors as soon as possible
+                while futures and futures[0].done():
+                    futures.pop(0).result()
+            if cs_release:
+                cmd.extend(cs_release)
+                cmd.extend(self._cs_high)
+            if cmd:
+                futures.append(self._ftdi.write_data_async(cmd))
+            for future in futures:
+                future.result()
+        finally:
+            if not pipelined:
+                self._ftdi.stop_write_pipeline()
+        return count
+
+    @staticmethod
+    def _iter_chunks(source, size):
+        """Split a bytes-like object, a file-like object or an iterable of
+           byte buffers into chunks of at most size bytes"""
+        if hasattr(source, 'read'):
+            while True:
+                chunk = source.read(size)
+                if not chunk:
+                    return
+                yield chunk
+        if isinstance(source, (bytes, bytearray, Array, memoryview)):
+            for pos in range(0, len(source), size):
+                yield source[pos:pos+size]
+            return
+        buf = bytearray()
+        for data in source:
+            buf.extend(data)
+            while len(buf) >= size:
+                yield bytes(buf[:size])
+                del buf[:size]
+        if buf:
+            yield bytes(buf)
+
+    def _read_exactly(self, length):
+        """Read out a given count of bytes from the FTDI device"""
+        data = Array('B')
+        while len(data) < length:
+            buf = self._ftdi.read_data_bytes(length-len(data), 4)
+            if not buf:
+                raise SpiIOError('No answer from FTDI')
+            data.extend(buf)
+        return data
+
+    def _batch_exchange(self, frequency, transfer, readlen, cs_cmd,
+                        cs_release, cpha):
+        """Queue an exchange into the active batch
+
+           Clock changes are inserted into the command sequence, rather than
+           sent right away.
+        """
+        cmd = Array('B')
+        if self._frequency != frequency:
+            freq_cmd, _ = self._ftdi.build_frequency_command(frequency)
+            cmd.extend(freq_cmd)
+            self._frequency = frequency
+        if self._clock_phase != cpha:
+            cmd.append(cpha and Ftdi.ENABLE_CLK_3PHASE or
+                       Ftdi.DISABLE_CLK_3PHASE)
+            self._clock_phase = cpha
+        if cs_cmd:
+            cmd.extend(cs_cmd)
+        cmd.extend(transfer)
+        if cs_release:
+            cmd.extend(cs_release)
+            cmd.extend(self._cs_high)
+        return self._batch._append(cmd, readlen)
+
+    def _transfer_command(self, out, readlen, cpol, cpha):
+        """Build the MPSSE commands to shift data out, then in"""
+        cmd = Array('B')
+        writelen = len(out)
+        if writelen:
+            wcmd = (cpol ^ cpha) and \
+                Ftdi.WRITE_BYTES_PVE_MSB or Ftdi.WRITE_BYTES_NVE_MSB
+            cmd.frombytes(self.HEADER.pack(wcmd, writelen-1))
+            cmd.extend(out)
+        if readlen:
+            rcmd = (cpol ^ cpha) and \
+                Ftdi.READ_BYTES_PVE_MSB or Ftdi.READ_BYTES_NVE_MSB
+            cmd.frombytes(self.HEADER.pack(rcmd, readlen-1))
+        return cmd
+
+    def _set_clock(self, frequency, cpha):
+        if self._frequency != frequency:
+            self._ftdi.set_frequency(frequency)
+            # store the requested value, not the actual one (best effort)
+            self._frequency = frequency
+        if self._clock_phase != cpha:
+            self._ftdi.enable_3phase_clock(cpha)
+            self._clock_phase = cpha
+
+    def _start_batch(self, batch):
+        # the batch owns the bus until it completes
+        self._acquire()
+        if self._batch:
+            self._release()
+            raise SpiIOError("A batch is already active")
+        self._batch = batch
+
+    def _stop_batch(self):
+        self._batch = None
+        self._release()
+
+    def _save_state(self):
+        return self._frequency, self._clock_phase
+
+    def _restore_state(self, state):
+        self._frequency, self._clock_phase = state
+
     def _flush(self):
         """Flush the HW FIFOs"""
-        self._ftdi.write_data(self._immediate)
-        self._ftdi.purge_buffers()
+        self._acquire()
+        try:
+            self._ftdi.write_data(self._immediate)
+            self._ftdi.purge_buffers()
+        finally:
+            self._release()
+
+    def _acquire(self):
+        """Own the bus, in thread-safe mode"""
+        if self._thread_safe:
+            self._lock.acquire()
+            self._owner = get_ident()
+            self._holds += 1
+
+    def _release(self):
+        if self._thread_safe:
+            self._holds -= 1
+            if not self._holds:
+                self._owner = None
+            self._lock.release()
+
+    def _schedule(self, func, args, cs_cmd, cs_release, size):
+        """Execute an exchange in thread-safe mode.
+
+           A complete transaction, small enough to fit the FTDI FIFO, is
+           queued, so that it may be merged with the exchanges of other
+           threads. Other exchanges are executed right away, once the bus
+           is available.
+
+           :param size: the count of bytes the exchange shifts, or None if
+                        the exchange cannot be merged
+        """
+        if (cs_cmd and cs_release and size is not None and
+                size <= self._rx_size and self._owner != get_ident()):
+            return self._combine(SpiRequest(func, args))
+        self._acquire()
+        try:
+            result = func(*args)
+            self._track_transaction(cs_release)
+        finally:
+            self._release()
+        return result
+
+    def _track_transaction(self, cs_release):
+        """Keep the bus while the current thread's transaction is open,
+           i.e. until the /CS line is released"""
+        if not cs_release:
+            if not self._in_transaction:
+                self._acquire()
+                self._in_transaction = True
+        elif self._in_transaction:
+            self._in_transaction = False
+            self._release()
+
+    def _locked_stream(self, stream, cs_release):
+        """Own the bus while a stream is consumed"""
+        self._acquire()
+        try:
+            yield from stream
+        finally:
+            stream.close()
+            self._track_transaction(cs_release)
+            self._release()
+
+    def _combine(self, request):
+        """Queue an exchange, then either wait for another thread to execute
+           it, or execute all the queued exchanges on behalf of their
+           threads"""
+        with self._queue_lock:
+            self._queue.append(request)
+            self._queue_depth.record(len(self._queue))
+        self._acquire()
+        try:
+            if not request.done:
+                with self._queue_lock:
+                    requests = list(self._queue)
+                    self._queue.clear()
+                    self._batch_size.record(len(requests))
+                self._execute(requests)
+        finally:
+            self._release()
+        return request.outcome()
+
+    def _execute(self, requests):
+        """Execute queued exchanges, in as few USB transfers as possible"""
+        if len(requests) == 1:
+            request = requests[0]
+            try:
+                request.complete(request.func(*request.args))
+            except Exception as ex:
+                request.complete(error=ex)
+            return
+        futures = []
+        try:
+            with SpiBatch(self):
+                for request in requests:
+                    try:
+                        futures.append((request,
+                                        request.func(*request.args)))
+                    except Exception as ex:
+                        request.complete(error=ex)
+        except Exception:
+            # reported through the futures
+            pass
+        for request, future in futures:
+            error = future.exception()
+            request.complete(None if error else future.result(), error)
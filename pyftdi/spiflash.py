@@ -0,0 +1,307 @@
+# Copyright (c) 2010-2017, Emmanuel Blot <emmanuel.blot@free.fr>
+# Copyright (c) 2016, Emmanuel Bouaziz <ebouaziz@free.fr>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the Neotion nor the names of its contributors may
+#       be used to endorse or promote products derived from this software
+#       without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL NEOTION BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""SPI NOR flash devices"""
+
+from logging import getLogger
+from pyftdi.spi import SpiIOError
+from struct import unpack as sunpack
+from time import monotonic as now, sleep
+
+
+__all__ = ['SpiFlashError', 'SpiFlashDevice']
+
+
+class SpiFlashError(SpiIOError):
+    """SPI flash error"""
+
+
+class SpiFlashDevice(object):
+    """SPI NOR flash device, with 3-byte addresses.
+
+       The device geometry, i.e. its size, page size and erase units, is
+       retrieved from the JEDEC SFDP tables if the device supports them, or
+       guessed from its JEDEC identifier otherwise.
+
+       :Example:
+
+            ctrl = SpiController()
+            ctrl.configure('ftdi://ftdi:232h/1')
+            flash = SpiFlashDevice(ctrl, cs=0, freq=30E6)
+            # only the pages that differ are erased and programmed
+            flash.write(0x10000, firmware)
+            data = flash.read(0x10000, len(firmware))
+
+       :param controller: the SPI controller the flash device is wired to
+       :param int cs: chip select slot, starting from 0
+       :param int freq: SPI bus frequency for the flash device
+       :param int mode: SPI mode [0,3]
+    """
+
+    CMD_WRITE_ENABLE = 0x06
+    CMD_READ_STATUS = 0x05
+    CMD_READ_JEDEC_ID = 0x9f
+    CMD_READ_SFDP = 0x5a
+    CMD_FAST_READ = 0x0b
+    CMD_PAGE_PROGRAM = 0x02
+    CMD_ERASE_4K = 0x20
+    CMD_ERASE_32K = 0x52
+    CMD_ERASE_64K = 0xd8
+    STATUS_WIP = 0x01
+    STATUS_WEL = 0x02
+    SFDP_SIGNATURE = b'SFDP'
+    SFDP_BASIC_TABLE = 0x00
+    DEFAULT_PAGE_SIZE = 256
+    DEFAULT_ERASE_UNITS = {4 << 10: CMD_ERASE_4K,
+                           32 << 10: CMD_ERASE_32K,
+                           64 << 10: CMD_ERASE_64K}
+    ADDRESS_SPACE = 1 << 24
+    STATUS_POLL_COUNT = 32  # status bytes per poll request
+    PROGRAM_TIMEOUT = 0.1  # seconds
+    ERASE_TIMEOUT = 5.0  # seconds
+    ERASE_POLL_DELAY = 0.005  # seconds
+
+    def __init__(self, controller, cs=0, freq=None, mode=0):
+        self.log = getLogger('pyftdi.spiflash')
+        self._controller = controller
+        self._spi = controller.get_port(cs, freq, mode)
+        self._jedec_id = self._spi.exchange([self.CMD_READ_JEDEC_ID],
+                                            3).tobytes()
+        if self._jedec_id in (b'\x00'*3, b'\xff'*3):
+            raise SpiFlashError('No SPI flash device detected')
+        self._size = 0
+        self._page_size = self.DEFAULT_PAGE_SIZE
+        self._erase_units = {}
+        if not self._read_sfdp():
+            self.log.info('No SFDP support, use JEDEC ID')
+            self._size = 1 << self._jedec_id[2]
+            self._page_size = self.DEFAULT_PAGE_SIZE
+            self._erase_units = dict(self.DEFAULT_ERASE_UNITS)
+        if self._size > self.ADDRESS_SPACE:
+            self.log.warning('Only the first %d MiB are addressable',
+                             self.ADDRESS_SPACE >> 20)
+            self._size = self.ADDRESS_SPACE
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def jedec_id(self):
+        """Return the JEDEC identifier of the device"""
+        return self._jedec_id
+
+    @property
+    def page_size(self):
+        """Return the size of a program page, in bytes"""
+        return self._page_size
+
+    @property
+    def erase_units(self):
+        """Return the supported erase sizes, in bytes, smallest first"""
+        return tuple(sorted(self._erase_units))
+
+    def read(self, address, length):
+        """Read out data from the flash device, with the fast read command.
+
+           :param int address: the address of the first byte to read
+           :param int length: count of bytes to read
+           :return: the read out bytes
+        """
+        self._check_range(address, length)
+        if not length:
+            return b''
+        return b''.join(chunk.tobytes() for chunk in
+                        self._spi.read_stream(length,
+                                              self._command(
+                                                  self.CMD_FAST_READ,
+                                                  address, 1)))
+
+    def read_into(self, sink, address, length):
+        """Read out data from the flash device into a file-like object.
+
+           :param sink: an object with a write() method
+           :param int address: the address of the first byte to read
+           :param int length: count of bytes to read
+           :return: the count of read bytes
+        """
+        self._check_range(address, length)
+        return self._spi.read_into(sink, length,
+                                   self._command(self.CMD_FAST_READ,
+                                                 address, 1))
+
+    def erase(self, address, length):
+        """Erase a range of the flash device, using the largest erase units
+           the range alignment allows.
+
+           :param int address: the start of the range, which should be
+                               aligned on the smallest erase unit
+           :param int length: the size of the range, which should be a
+                              multiple of the smallest erase unit
+        """
+        self._check_range(address, length)
+        unit = min(self._erase_units)
+        if address % unit or length % unit:
+            raise SpiFlashError('Erase range is not aligned on %d bytes' %
+                                unit)
+        end = address+length
+        while address < end:
+            for size in sorted(self._erase_units, reverse=True):
+                if not address % size and address+size <= end:
+                    break
+            self.log.debug('Erase %d bytes @ 0x%06x', size, address)
+            self._execute(self._command(self._erase_units[size], address),
+                          self.ERASE_TIMEOUT, self.ERASE_POLL_DELAY)
+            address += size
+
+    def write(self, address, data, verify=True):
+        """Write data to the flash device.
+
+           The current content of the flash device is read out first, so
+           that pages which already hold the expected data are skipped,
+           and erase units are only erased when some bits need to be set
+           back to 1. Data surrounding the range within erased units is
+           preserved.
+
+           :param int address: the address of the first byte to write
+           :param data: the bytes to write
+           :param bool verify: whether to read back and compare the data
+        """
+        self._check_range(address, len(data))
+        if not data:
+            return
+        unit = min(self._erase_units)
+        start = address - address % unit
+        end = -(-(address+len(data)) // unit) * unit
+        current = self.read(start, end-start)
+        target = bytearray(current)
+        target[address-start:address-start+len(data)] = data
+        erase = []
+        program = []
+        for sector in range(0, end-start, unit):
+            old = current[sector:sector+unit]
+            new = target[sector:sector+unit]
+            if old == new:
+                continue
+            old_bits = int.from_bytes(old, 'big')
+            new_bits = int.from_bytes(new, 'big')
+            erased = (old_bits & new_bits) != new_bits
+            if erased:
+                erase.append(sector)
+            for page in range(sector, sector+unit, self._page_size):
+                content = target[page:page+self._page_size]
+                if erased:
+                    if content.count(0xff) != len(content):
+                        program.append(page)
+                elif content != current[page:page+self._page_size]:
+                    program.append(page)
+        self.log.info('Write %d bytes @ 0x%06x: %d units to erase, '
+                      '%d pages to program', len(data), address,
+                      len(erase), len(program))
+        # merge contiguous units so that larger erase units may be used
+        run_start = None
+        for pos, sector in enumerate(erase):
+            if run_start is None:
+                run_start = sector
+            if pos+1 == len(erase) or erase[pos+1] != sector+unit:
+                self.erase(start+run_start, sector+unit-run_start)
+                run_start = None
+        for page in program:
+            cmd = self._command(self.CMD_PAGE_PROGRAM, start+page)
+            cmd.extend(target[page:page+self._page_size])
+            self._execute(cmd, self.PROGRAM_TIMEOUT)
+        if verify:
+            if self.read(start, end-start) != bytes(target):
+                raise SpiFlashError('Verification failed @ 0x%06x' % address)
+
+    def _read_sfdp(self):
+        """Retrieve the device geometry from the SFDP basic flash parameter
+           table, if any"""
+        header = self._read_sfdp_data(0, 16)
+        if header[:4] != self.SFDP_SIGNATURE:
+            return False
+        # the first parameter header is the mandatory JEDEC basic table
+        if header[8] != self.SFDP_BASIC_TABLE:
+            return False
+        length = min(header[11], 16)
+        if length < 9:
+            return False
+        pointer = header[12] | (header[13] << 8) | (header[14] << 16)
+        dwords = sunpack('<%dI' % length,
+                         self._read_sfdp_data(pointer, 4*length))
+        density = dwords[1]
+        if density & (1 << 31):
+            bits = 1 << (density & ~(1 << 31))
+        else:
+            bits = density+1
+        self._size = bits >> 3
+        for dword in dwords[7:9]:
+            for shift in (0, 16):
+                exponent = (dword >> shift) & 0xff
+                if exponent:
+                    self._erase_units[1 << exponent] = \
+                        (dword >> (shift+8)) & 0xff
+        if length >= 11:
+            self._page_size = 1 << ((dwords[10] >> 4) & 0xf)
+        self.log.debug('SFDP: %d bytes, %d-byte pages, erase units %s',
+                       self._size, self._page_size, self.erase_units)
+        return bool(self._size and self._erase_units)
+
+    def _read_sfdp_data(self, address, length):
+        return self._spi.exchange(self._command(self.CMD_READ_SFDP,
+                                                address, 1),
+                                  length).tobytes()
+
+    def _execute(self, command, timeout, delay=0):
+        """Execute a write command, then wait for its completion.
+
+           Write enable, the command itself and a first burst of status
+           reads are sent within a single USB transfer.
+        """
+        with self._controller.batch():
+            self._spi.exchange([self.CMD_WRITE_ENABLE])
+            self._spi.exchange(command)
+            status = self._spi.exchange([self.CMD_READ_STATUS],
+                                        self.STATUS_POLL_COUNT)
+        status = status.result()
+        deadline = now()+timeout
+        while status[-1] & self.STATUS_WIP:
+            if now() > deadline:
+                raise SpiFlashError('Flash device is still busy')
+            if delay:
+                sleep(delay)
+            # the status register is output as long as /CS is active
+            status = self._spi.exchange([self.CMD_READ_STATUS],
+                                        self.STATUS_POLL_COUNT)
+
+    def _check_range(self, address, length):
+        if address < 0 or length < 0 or address+length > self._size:
+            raise SpiFlashError('Out of range access')
+
+    @staticmethod
+    def _command(opcode, address, dummy=0):
+        return bytearray((opcode, (address >> 16) & 0xff,
+                          (address >> 8) & 0xff, address & 0xff) +
+                         (0,)*dummy)
@@ -0,0 +1,205 @@
+# Copyright (c) 2010-2017, Emmanuel Blot <emmanuel.blot@free.fr>
+# Copyright (c) 2016, Emmanuel Bouaziz <ebouaziz@free.fr>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the Neotion nor the names of its contributors may
+#       be used to endorse or promote products derived from this software
+#       without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL NEOTION BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Statistics of the USB traffic of a FTDI device.
+
+   Statistics are collected once enabled with
+   :py:meth:`pyftdi.ftdi.Ftdi.enable_statistics`, and are otherwise not
+   maintained at all.
+"""
+
+from threading import Lock
+
+__all__ = ['Histogram', 'FtdiStatistics']
+
+
+class Histogram(object):
+    """Log-linear histogram of positive integer values, after HdrHistogram.
+
+       Values below ``2 << precision`` are recorded exactly; greater values
+       are recorded in buckets whose width is proportional to the value, so
+       that the relative error never exceeds ``1/(1 << precision)``, whatever
+       the dynamic range of the recorded values.
+
+       >>> hist = Histogram(precision=3)
+       >>> for value in range(1, 101):
+       ...     hist.record(value)
+       >>> hist.count, hist.min, hist.max
+       (100, 1, 100)
+       >>> hist.percentile(50)
+       51
+       >>> hist.percentile(100)
+       100
+
+       :param precision: the count of significant bits of the buckets
+    """
+
+    def __init__(self, precision=5):
+        self._precision = precision
+        self._subcount = 1 << precision
+        self._counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        """Record a value"""
+        value = max(0, int(value))
+        shift = max(0, value.bit_length()-self._precision-1)
+        index = shift*self._subcount + (value >> shift)
+        self._counts[index] = self._counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        """Return the mean of the recorded values, or None"""
+        return self.count and self.total/self.count or None
+
+    def percentile(self, percent):
+        """Return the value below which the given percentage of recorded
+           values fall, with the histogram precision.
+
+           :param percent: the percentage, in [0..100]
+           :return: the highest value of the matching bucket, or None if no
+                    value has been recorded
+        """
+        if not self.count:
+            return None
+        threshold = max(1, percent*self.count/100)
+        cumul = 0
+        for index in sorted(self._counts):
+            cumul += self._counts[index]
+            if cumul >= threshold:
+                return min(self._upper(index), self.max)
+        return self.max
+
+    def buckets(self):
+        """Return the non-empty buckets.
+
+           :return: a list of (lowest value, highest value, count) tuples
+        """
+        return [(self._lower(index), self._upper(index), self._counts[index])
+                for index in sorted(self._counts)]
+
+    def snapshot(self):
+        """Return the summary of the histogram as a dictionary"""
+        return {'count': self.count,
+                'min': self.min,
+                'max': self.max,
+                'mean': self.mean,
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'p999': self.percentile(99.9)}
+
+    def reset(self):
+        """Forget all recorded values"""
+        self._counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _split(self, index):
+        shift = max(0, index//self._subcount-1)
+        return shift, index-shift*self._subcount
+
+    def _lower(self, index):
+        shift, mantissa = self._split(index)
+        return mantissa << shift
+
+    def _upper(self, index):
+        shift, mantissa = self._split(index)
+        return ((mantissa+1) << shift)-1
+
+
+class FtdiStatistics(object):
+    """Counters and latency histograms of the USB traffic of a FTDI port.
+
+       Transfer durations are recorded in nanoseconds.
+    """
+
+    COUNTERS = ('bulk_out', 'bytes_out', 'bulk_in', 'bytes_in',
+                'empty_reads', 'read_retries', 'ctrl_out', 'ctrl_in',
+                'latency_changes')
+
+    def __init__(self):
+        self._lock = Lock()
+        self.read_latency = Histogram()
+        self.write_latency = Histogram()
+        self.reset()
+
+    def reset(self):
+        """Reset all counters and histograms"""
+        with self._lock:
+            self.counters = dict.fromkeys(self.COUNTERS, 0)
+            self.read_latency.reset()
+            self.write_latency.reset()
+
+    def add(self, name, value=1):
+        """Increment a counter"""
+        with self._lock:
+            self.counters[name] += value
+
+    def record_write(self, length, delay):
+        """Record a bulk OUT transfer.
+
+           :param length: the count of written bytes
+           :param delay: the transfer duration, in seconds
+        """
+        with self._lock:
+            self.counters['bulk_out'] += 1
+            self.counters['bytes_out'] += length
+            self.write_latency.record(delay*1E9)
+
+    def record_read(self, length, delay):
+        """Record a bulk IN transfer.
+
+           :param length: the count of received bytes, including the modem
+                          status bytes
+           :param delay: the transfer duration, in seconds
+        """
+        with self._lock:
+            self.counters['bulk_in'] += 1
+            self.counters['bytes_in'] += length
+            if length <= 2:
+                self.counters['empty_reads'] += 1
+            if delay is not None:
+                self.read_latency.record(delay*1E9)
+
+    def snapshot(self):
+        """Return a copy of the statistics as a dictionary"""
+        with self._lock:
+            stats = dict(self.counters)
+            stats['read_latency'] = self.read_latency.snapshot()
+            stats['write_latency'] = self.write_latency.snapshot()
+        return stats
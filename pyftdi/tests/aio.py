@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017, Emmanuel Blot <emmanuel.blot@free.fr>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the Neotion nor the names of its contributors may
+#       be used to endorse or promote products derived from this software
+#       without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL NEOTION BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import asyncio
+import unittest
+from doctest import testmod
+from logging import StreamHandler, DEBUG
+from pyftdi import FtdiLogger
+from pyftdi.aio import AsyncI2cController, AsyncSpiController
+from pyftdi.i2c import I2cNackError
+from pyftdi.tests.backend import usbvirt
+from pyftdi.tests.backend.mpsse import VirtualI2cBus, VirtualSpiBus
+from pyftdi.tests.i2c import VirtualI2cEeprom
+from pyftdi.tests.spi import VirtualSpiEeprom
+from pyftdi.usbtools import UsbTools
+from sys import modules, stdout
+from time import sleep
+
+
+class AsyncControllerTestCase(unittest.TestCase):
+    """asyncio controllers test case, on the virtual USB backend"""
+
+    def setUp(self):
+        self.backend = usbvirt.get_backend()
+        self.backend.clear()
+        UsbTools.set_backend(self.backend)
+        self.device = self.backend.add_device('ft232h')
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        self.backend.clear()
+        UsbTools.set_backend(None)
+
+    def test_spi(self):
+        eeproms = [VirtualSpiEeprom(), VirtualSpiEeprom()]
+        for pos, eeprom in enumerate(eeproms):
+            eeprom.memory[:] = bytes((pos*0x80+x) & 0xff for x in range(256))
+        self.device.ports[0].connect(VirtualSpiBus(dict(enumerate(eeproms))))
+
+        async def run():
+            spi = AsyncSpiController(cs_count=2)
+            await spi.configure('ftdi://ftdi:232h/1')
+            ftdi = spi.controller._ftdi
+            ftdi.enable_statistics()
+            ports = [await spi.get_port(cs, freq=6E6) for cs in range(2)]
+            requests = [ports[pos % 2].exchange([0x03, pos], 4)
+                        for pos in range(32)]
+            results = await asyncio.gather(*requests)
+            for pos, data in enumerate(results):
+                base = (pos % 2)*0x80+pos
+                self.assertEqual(data.tobytes(),
+                                 bytes(x & 0xff for x in range(base, base+4)))
+            # concurrent exchanges share USB transfers
+            self.assertLess(ftdi.get_statistics()['bulk_out'], 16)
+            await ports[1].write([0x02, 0x10, 0xaa])
+            self.assertEqual(eeproms[1].memory[0x10], 0xaa)
+            await spi.terminate()
+        self.loop.run_until_complete(run())
+
+    def test_i2c(self):
+        eeproms = [VirtualI2cEeprom(0x50), VirtualI2cEeprom(0x51)]
+        self.device.ports[0].connect(VirtualI2cBus(eeproms))
+
+        async def run():
+            i2c = AsyncI2cController()
+            i2c.controller.RETRY_COUNT = 1
+            await i2c.configure('ftdi://ftdi:232h/1')
+            ports = [await i2c.get_port(address) for address in (0x50, 0x51)]
+            missing = await i2c.get_port(0x52)
+            await asyncio.gather(ports[0].write_to(0x20, b'abcd'),
+                                 ports[1].write_to(0x20, b'efgh'))
+            self.assertEqual(eeproms[1].memory[0x20:0x24], b'efgh')
+            results = await asyncio.gather(ports[0].read_from(0x20, 4),
+                                           missing.read(2),
+                                           ports[1].read_from(0x21, 3),
+                                           return_exceptions=True)
+            self.assertEqual(results[0], b'abcd')
+            # only the request to the missing slave fails
+            self.assertIsInstance(results[1], I2cNackError)
+            self.assertEqual(results[2], b'fgh')
+            await i2c.terminate()
+        self.loop.run_until_complete(run())
+
+    def test_i2c_nack(self):
+        eeprom = VirtualI2cEeprom(0x50)
+        written = []
+        write = eeprom.write
+
+        def record(byte):
+            ack = write(byte)
+            if ack:
+                written.append(byte)
+            return ack
+        eeprom.write = record
+        self.device.ports[0].connect(VirtualI2cBus([eeprom]))
+
+        async def run():
+            i2c = AsyncI2cController()
+            i2c.controller.RETRY_COUNT = 1
+            await i2c.configure('ftdi://ftdi:232h/1')
+            port = await i2c.get_port(0x50)
+            missing = await i2c.get_port(0x52)
+            # keep the worker busy, so that the next requests are coalesced
+            results = await asyncio.gather(i2c._call(sleep, 0.05),
+                                           port.write_to(0x20, b'abcd'),
+                                           missing.write(b'\x00'),
+                                           port.read_from(0x20, 4),
+                                           return_exceptions=True)
+            self.assertIsInstance(results[2], I2cNackError)
+            self.assertEqual(results[3], b'abcd')
+            # the acknowledged write has been issued exactly once
+            self.assertEqual(bytes(written), b'\x20abcd\x20')
+            await i2c.terminate()
+        self.loop.run_until_complete(run())
+
+    def test_i2c_retries(self):
+        eeprom = VirtualI2cEeprom(0x50)
+        # this slave does not accept any data byte
+        busy = VirtualI2cEeprom(0x51, write_buffer=0)
+        starts = []
+        start = busy.start
+        busy.start = lambda: starts.append(start())
+        self.device.ports[0].connect(VirtualI2cBus([eeprom, busy]))
+
+        async def run():
+            i2c = AsyncI2cController()
+            i2c.controller.RETRY_COUNT = 2
+            await i2c.configure('ftdi://ftdi:232h/1')
+            ports = [await i2c.get_port(address) for address in (0x50, 0x51)]
+            results = await asyncio.gather(i2c._call(sleep, 0.05),
+                                           ports[0].write_to(0x20, b'ab'),
+                                           ports[1].write_to(0x20, b'cd'),
+                                           return_exceptions=True)
+            self.assertIsNone(results[1])
+            self.assertIsInstance(results[2], I2cNackError)
+            # the batched attempt counts as the first one
+            self.assertEqual(len(starts), 2)
+            await i2c.terminate()
+        self.loop.run_until_complete(run())
+
+
+def suite():
+    suite_ = unittest.TestSuite()
+    suite_.addTest(unittest.makeSuite(AsyncControllerTestCase, 'test'))
+    return suite_
+
+
+if __name__ == '__main__':
+    testmod(modules[__name__])
+    FtdiLogger.log.addHandler(StreamHandler(stdout))
+    FtdiLogger.set_level(DEBUG)
+    unittest.main(defaultTest='suite')
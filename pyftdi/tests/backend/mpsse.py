@@ -0,0 +1,493 @@
+# Copyright (c) 2017, Emmanuel Blot <emmanuel.blot@free.fr>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the Neotion nor the names of its contributors may
+#       be used to endorse or promote products derived from this software
+#       without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL NEOTION BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""MPSSE engine of the virtual FTDI device, and bus models.
+
+   The engine interprets the MPSSE command stream, and forwards the bus
+   activity to a bus model. Bus models route the data to peripheral models,
+   and report the bus time each command takes.
+"""
+
+from collections import Counter
+from pyftdi.ftdi import Ftdi
+from struct import unpack as sunpack
+
+
+class VirtualBus(object):
+    """Base bus model, where no peripheral is connected: TDO/MISO is pulled
+       up.
+
+       Sub-classes may either override the byte and bit oriented methods,
+       or only the clock() method which is called for each clock cycle.
+    """
+
+    def __init__(self):
+        self.pins = 0
+        self.direction = 0
+
+    def set_pins(self, pins, direction):
+        """Update the low GPIO port, i.e. the pins shared with the bus"""
+        self.pins = pins
+        self.direction = direction
+
+    def get_pins(self):
+        """Report the input level of the low GPIO port"""
+        return self.pins
+
+    def shift_bytes(self, out, length, lsb, read):
+        """Shift bytes on the bus.
+
+           :param out: the bytes to output, None to only read
+           :param length: the count of bytes to shift
+           :param lsb: whether bits are shifted LSB first
+           :param read: whether input bits should be returned
+           :return: the input bytes if read is set
+        """
+        data = bytearray()
+        for pos in range(length):
+            byte = out[pos] if out is not None else 0xff
+            value = 0
+            for bit in range(8):
+                shift = bit if lsb else 7-bit
+                tdo = self.clock((byte >> shift) & 1, None)
+                value |= tdo << shift
+            data.append(value)
+        return bytes(data) if read else None
+
+    def shift_bits(self, out, count, lsb, read):
+        """Shift up to 8 bits on the bus.
+
+           :param out: the byte to output, None to only read
+           :param count: the count of bits to shift
+           :param lsb: whether bits are shifted LSB first
+           :param read: whether input bits should be returned
+           :return: the input bits, as the FTDI device reports them
+        """
+        bits = []
+        for bit in range(count):
+            shift = bit if lsb else 7-bit
+            tdi = (out >> shift) & 1 if out is not None else 1
+            bits.append(self.clock(tdi, None))
+        return self.pack_bits(bits, lsb) if read else None
+
+    def shift_tms(self, tms, count, tdi, read):
+        """Shift bits on the TMS line, while TDI is held.
+
+           :param tms: the TMS bits, LSB first
+           :param count: the count of bits to shift
+           :param tdi: the TDI level
+           :param read: whether TDO bits should be returned
+        """
+        bits = [self.clock(tdi, (tms >> bit) & 1) for bit in range(count)]
+        return self.pack_bits(bits, True) if read else None
+
+    def clock(self, tdi, tms):
+        """Run a single clock cycle.
+
+           :param tdi: the output data bit
+           :param tms: the TMS level, or None if TMS is not driven by the
+                       command
+           :return: the input data bit
+        """
+        return 1
+
+    @staticmethod
+    def pack_bits(bits, lsb):
+        """Pack the bits read with a bit command, as the FTDI device does:
+           bits are shifted in a byte from the MSB in LSB mode, and from the
+           LSB in MSB mode"""
+        count = len(bits)
+        value = 0
+        for pos, bit in enumerate(bits):
+            value |= bit << ((8-count+pos) if lsb else (count-1-pos))
+        return value
+
+
+class VirtualSpiBus(VirtualBus):
+    """SPI bus model.
+
+       SPI slave models are selected with the /CS lines of the low GPIO
+       port, and should implement:
+
+       * ``select()``: called when the slave is selected
+       * ``write(data)``: receive bytes from the master
+       * ``read(length)``: return bytes to the master
+       * ``exchange(data)`` (optional): full-duplex transfer
+       * ``deselect()`` (optional): called when /CS is released
+
+       :param slaves: a dictionary of slave models, indexed by /CS line
+    """
+
+    CS_BIT = 0x08
+
+    def __init__(self, slaves):
+        super(VirtualSpiBus, self).__init__()
+        self.slaves = slaves
+        self._selected = None
+
+    @property
+    def selected(self):
+        """Return the /CS line of the selected slave, or None"""
+        return self._selected
+
+    def set_pins(self, pins, direction):
+        super(VirtualSpiBus, self).set_pins(pins, direction)
+        selected = None
+        for cs in self.slaves:
+            if not pins & (self.CS_BIT << cs):
+                selected = cs
+        if selected != self._selected:
+            if self._selected is not None:
+                deselect = getattr(self.slaves[self._selected], 'deselect',
+                                   None)
+                if deselect:
+                    deselect()
+            if selected is not None:
+                self.slaves[selected].select()
+        self._selected = selected
+
+    def shift_bytes(self, out, length, lsb, read):
+        if self._selected is None:
+            return b'\xff'*length if read else None
+        slave = self.slaves[self._selected]
+        if out is not None and read:
+            return slave.exchange(bytes(out))
+        if out is not None:
+            slave.write(bytes(out))
+            return None
+        return slave.read(length)
+
+
+class VirtualI2cBus(VirtualBus):
+    """I2C bus model.
+
+       START and STOP conditions are detected from the SCL and SDA lines of
+       the low GPIO port. I2C slave models should implement:
+
+       * ``address``: the 7-bit slave address
+       * ``start()``: called when the slave is addressed
+       * ``write(byte)``: receive a byte, return True to acknowledge it
+       * ``read()``: return a byte to the master
+
+       :param slaves: a sequence of slave models
+    """
+
+    SCL_BIT = 0x01
+    SDA_O_BIT = 0x02
+
+    def __init__(self, slaves):
+        super(VirtualI2cBus, self).__init__()
+        self.pins = self.SCL_BIT | self.SDA_O_BIT
+        self.slaves = {slave.address: slave for slave in slaves}
+        self._state = None
+        self._slave = None
+        self._acks = []
+
+    def set_pins(self, pins, direction):
+        scl, sda = self.SCL_BIT, self.SDA_O_BIT
+        if (self.pins & scl) and (pins & scl):
+            if (self.pins & sda) and not (pins & sda):
+                self._state = 'address'
+                self._acks = []
+            elif not (self.pins & sda) and (pins & sda):
+                self._state = None
+        super(VirtualI2cBus, self).set_pins(pins, direction)
+
+    def shift_bytes(self, out, length, lsb, read):
+        if out is not None:
+            for byte in out:
+                self._acks.append(self._write(byte))
+            return b'\xff'*length if read else None
+        if self._state != 'read':
+            return b'\xff'*length
+        return bytes(self._slave.read() for _ in range(length))
+
+    def shift_bits(self, out, count, lsb, read):
+        # ACK bit from the slave, or ACK/NACK bit from the master
+        if not read:
+            return None
+        ack = self._acks.pop(0) if self._acks else False
+        return 0x00 if ack else 0x01
+
+    def _write(self, byte):
+        if self._state == 'address':
+            self._slave = self.slaves.get(byte >> 1)
+            if not self._slave:
+                self._state = None
+                return False
+            self._slave.start()
+            self._state = 'read' if byte & 0x1 else 'write'
+            return True
+        if self._state == 'write':
+            return self._slave.write(byte)
+        return False
+
+
+class VirtualJtagBus(VirtualBus):
+    """JTAG bus model, with a single TAP controller.
+
+       :param tap: a TAP model, which implements ``clock(tdi, tms)``
+    """
+
+    TMS_BIT = 0x08
+
+    def __init__(self, tap):
+        super(VirtualJtagBus, self).__init__()
+        self.tap = tap
+
+    def clock(self, tdi, tms):
+        if tms is None:
+            tms = int(bool(self.pins & self.TMS_BIT))
+        return self.tap.clock(tdi, tms)
+
+
+class VirtualJtagTap(object):
+    """TAP controller model, with IDCODE and BYPASS instructions.
+
+       :param idcode: the 32-bit device identifier
+       :param ir_length: the length of the instruction register
+       :param idcode_ir: the IDCODE instruction
+    """
+
+    TRANSITIONS = {
+        'test_logic_reset': ('run_test_idle', 'test_logic_reset'),
+        'run_test_idle': ('run_test_idle', 'select_dr_scan'),
+        'select_dr_scan': ('capture_dr', 'select_ir_scan'),
+        'capture_dr': ('shift_dr', 'exit_1_dr'),
+        'shift_dr': ('shift_dr', 'exit_1_dr'),
+        'exit_1_dr': ('pause_dr', 'update_dr'),
+        'pause_dr': ('pause_dr', 'exit_2_dr'),
+        'exit_2_dr': ('shift_dr', 'update_dr'),
+        'update_dr': ('run_test_idle', 'select_dr_scan'),
+        'select_ir_scan': ('capture_ir', 'test_logic_reset'),
+        'capture_ir': ('shift_ir', 'exit_1_ir'),
+        'shift_ir': ('shift_ir', 'exit_1_ir'),
+        'exit_1_ir': ('pause_ir', 'update_ir'),
+        'pause_ir': ('pause_ir', 'exit_2_ir'),
+        'exit_2_ir': ('shift_ir', 'update_ir'),
+        'update_ir': ('run_test_idle', 'select_dr_scan')}
+
+    def __init__(self, idcode, ir_length=4, idcode_ir=0b0100):
+        self.idcode = idcode
+        self.ir_length = ir_length
+        self.idcode_ir = idcode_ir
+        self.state = 'test_logic_reset'
+        self.ir = idcode_ir
+        self._shift = 0
+        self._length = 0
+
+    def clock(self, tdi, tms):
+        tdo = 0
+        if self.state == 'test_logic_reset':
+            self.ir = self.idcode_ir
+        elif self.state == 'capture_ir':
+            self._shift, self._length = 0b01, self.ir_length
+        elif self.state == 'capture_dr':
+            if self.ir == self.idcode_ir:
+                self._shift, self._length = self.idcode, 32
+            else:
+                # BYPASS
+                self._shift, self._length = 0, 1
+        elif self.state in ('shift_ir', 'shift_dr'):
+            tdo = self._shift & 1
+            self._shift = (self._shift >> 1) | (tdi << (self._length-1))
+        next_state = self.TRANSITIONS[self.state][tms]
+        if next_state == 'update_ir' and self.state != 'update_ir':
+            self.ir = self._shift & ((1 << self.ir_length)-1)
+        self.state = next_state
+        return tdo
+
+
+class VirtualMpsseEngine(object):
+    """MPSSE command interpreter.
+
+       The count of executed commands is kept per opcode in ``opcodes``.
+
+       :param bus: the bus model the MPSSE pins are connected to
+       :param high_speed: whether the device is a -H series device
+    """
+
+    def __init__(self, bus=None, high_speed=True):
+        self.bus = bus or VirtualBus()
+        self.high_speed = high_speed
+        self.high_pins = 0
+        self.high_direction = 0
+        self.divisor = 0
+        self.div5 = True
+        self.three_phase = False
+        self.adaptive = False
+        self.drive_zero = 0
+        self.loopback = False
+        self.bus_time = 0.0
+        self.opcodes = Counter()
+        self._pending = bytearray()
+
+    @property
+    def frequency(self):
+        """Return the current clock frequency"""
+        base = self.div5 and Ftdi.BUS_CLOCK_BASE or Ftdi.BUS_CLOCK_HIGH
+        if not self.high_speed:
+            base = Ftdi.BUS_CLOCK_BASE
+        frequency = base/(self.divisor+1)
+        if self.three_phase:
+            frequency = (2*frequency)/3
+        return frequency
+
+    def execute(self, data):
+        """Execute a stream of MPSSE commands.
+
+           Commands split across USB transfers are completed with the
+           next transfer.
+
+           :return: a (reply, flush) tuple, where flush tells whether the
+                    reply should be sent to the host right away
+        """
+        self._pending.extend(data)
+        data = self._pending
+        reply = bytearray()
+        flush = False
+        pos = 0
+        while pos < len(data):
+            size = self._command_size(data, pos)
+            if not size or pos+size > len(data):
+                break
+            command = bytes(data[pos:pos+size])
+            pos += size
+            self.opcodes[command[0]] += 1
+            if command[0] == Ftdi.SEND_IMMEDIATE:
+                flush = True
+            self._execute(command, reply)
+        del data[:pos]
+        return bytes(reply), flush
+
+    def _command_size(self, data, pos):
+        opcode = data[pos]
+        if opcode & 0x80:
+            if opcode in (Ftdi.SET_BITS_LOW, Ftdi.SET_BITS_HIGH,
+                          Ftdi.TCK_DIVISOR, Ftdi.CLK_BYTES_NO_DATA,
+                          Ftdi.CLK_COUNT_WAIT_ON_HIGH,
+                          Ftdi.CLK_COUNT_WAIT_ON_LOW, Ftdi.DRIVE_ZERO):
+                return 3
+            if opcode == Ftdi.CLK_BITS_NO_DATA:
+                return 2
+            return 1
+        if opcode & 0x02:
+            # bit mode: length, then a data byte if any output
+            return 2 + int(bool(opcode & 0x50))
+        if pos+3 > len(data):
+            return 0
+        length, = sunpack('<H', data[pos+1:pos+3])
+        return 3 + (length+1 if opcode & 0x10 else 0)
+
+    def _execute(self, command, reply):
+        opcode = command[0]
+        if opcode & 0x80:
+            self._execute_control(command, reply)
+            return
+        lsb = bool(opcode & 0x08)
+        write = bool(opcode & 0x10)
+        read = bool(opcode & 0x20)
+        tms = bool(opcode & 0x40)
+        if (not write and not read and not tms) or (tms and not opcode & 0x02):
+            reply.extend((0xfa, opcode))
+            return
+        if opcode & 0x02:
+            count = command[1]+1
+            if count > 8:
+                reply.extend((0xfa, opcode))
+                return
+            out = command[2] if len(command) > 2 else None
+            if self.loopback:
+                value = self.bus.pack_bits(
+                    [(out >> (pos if lsb else 7-pos)) & 1
+                     for pos in range(count)], lsb) if out is not None \
+                    else 0
+            elif tms:
+                value = self.bus.shift_tms(out & 0x7f, count, out >> 7, read)
+            else:
+                value = self.bus.shift_bits(out if write else None, count,
+                                            lsb, read)
+            if read:
+                reply.append(value & 0xff)
+            self._tick(count)
+        else:
+            length, = sunpack('<H', command[1:3])
+            length += 1
+            out = command[3:] if write else None
+            if self.loopback:
+                data = bytes(out) if out is not None else b'\xff'*length
+            else:
+                data = self.bus.shift_bytes(out, length, lsb, read)
+            if read:
+                reply.extend(data)
+            self._tick(8*length)
+
+    def _execute_control(self, command, reply):
+        opcode = command[0]
+        if opcode == Ftdi.SET_BITS_LOW:
+            self.bus.set_pins(command[1], command[2])
+        elif opcode == Ftdi.SET_BITS_HIGH:
+            self.high_pins, self.high_direction = command[1], command[2]
+        elif opcode == Ftdi.GET_BITS_LOW:
+            reply.append(self.bus.get_pins())
+        elif opcode == Ftdi.GET_BITS_HIGH:
+            reply.append(self.high_pins)
+        elif opcode == Ftdi.LOOPBACK_START:
+            self.loopback = True
+        elif opcode == Ftdi.LOOPBACK_END:
+            self.loopback = False
+        elif opcode == Ftdi.TCK_DIVISOR:
+            self.divisor, = sunpack('<H', command[1:3])
+        elif opcode in (Ftdi.SEND_IMMEDIATE, Ftdi.WAIT_ON_HIGH,
+                        Ftdi.WAIT_ON_LOW):
+            pass
+        elif opcode in (Ftdi.DISABLE_CLK_DIV5, Ftdi.ENABLE_CLK_DIV5,
+                        Ftdi.ENABLE_CLK_3PHASE, Ftdi.DISABLE_CLK_3PHASE,
+                        Ftdi.ENABLE_CLK_ADAPTIVE, Ftdi.DISABLE_CLK_ADAPTIVE,
+                        Ftdi.DRIVE_ZERO) and self.high_speed:
+            if opcode == Ftdi.DISABLE_CLK_DIV5:
+                self.div5 = False
+            elif opcode == Ftdi.ENABLE_CLK_DIV5:
+                self.div5 = True
+            elif opcode == Ftdi.ENABLE_CLK_3PHASE:
+                self.three_phase = True
+            elif opcode == Ftdi.DISABLE_CLK_3PHASE:
+                self.three_phase = False
+            elif opcode == Ftdi.ENABLE_CLK_ADAPTIVE:
+                self.adaptive = True
+            elif opcode == Ftdi.DISABLE_CLK_ADAPTIVE:
+                self.adaptive = False
+            else:
+                self.drive_zero, = sunpack('<H', command[1:3])
+        elif opcode == Ftdi.CLK_BITS_NO_DATA:
+            self._tick(command[1]+1)
+        elif opcode == Ftdi.CLK_BYTES_NO_DATA:
+            length, = sunpack('<H', command[1:3])
+            self._tick(8*(length+1))
+        else:
+            reply.extend((0xfa, opcode))
+
+    def _tick(self, cycles):
+        self.bus_time += cycles/self.frequency
@@ -0,0 +1,475 @@
+# Copyright (c) 2017, Emmanuel Blot <emmanuel.blot@free.fr>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the Neotion nor the names of its contributors may
+#       be used to endorse or promote products derived from this software
+#       without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL NEOTION BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Virtual USB backend, which emulates FTDI devices.
+
+   The backend implements the PyUSB backend API, so that it can be selected
+   with the ``PYFTDI_BACKEND`` environment variable or with
+   :py:meth:`pyftdi.usbtools.UsbTools.set_backend`, e.g.::
+
+       PYFTDI_BACKEND=pyftdi.tests.backend.usbvirt
+
+   The emulated devices report the USB descriptors of actual FTDI devices,
+   handle the FTDI vendor control requests, prepend the modem status bytes to
+   every bulk IN packet, and only release the received data once a packet is
+   full, a SEND_IMMEDIATE command is received or the latency timer expires.
+
+   The time spent on the USB link, on the MPSSE bus and in the latency timer
+   is accounted on a :py:class:`VirtualClock`, so that benchmarks are
+   deterministic.
+"""
+
+import threading
+from array import array as Array
+from pyftdi.ftdi import Ftdi
+from pyftdi.tests.backend.mpsse import VirtualBus, VirtualMpsseEngine
+from time import sleep
+from usb.backend import IBackend
+
+__all__ = ['VirtualClock', 'VirtualFtdi', 'VirtualFtdiPort',
+           'VirtualBackend', 'get_backend']
+
+
+class VirtualClock(object):
+    """Simulated time source, in seconds"""
+
+    def __init__(self):
+        self._now = 0.0
+        self._lock = threading.Lock()
+
+    def time(self):
+        """Return the current simulated time"""
+        return self._now
+
+    def advance(self, delay):
+        """Advance the simulated time"""
+        with self._lock:
+            self._now += delay
+
+
+class VirtualDescriptor(object):
+    """Descriptor record, with the attributes PyUSB expects"""
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+        self.extra_descriptors = []
+
+
+class VirtualFtdiPort(object):
+    """A port (interface) of a virtual FTDI device.
+
+       The port counts its bulk transfers in ``writes`` and ``reads``, and
+       keeps the size of the largest OUT transfer in ``max_write`` and the
+       highest level of its RX FIFO in ``max_fifo``. The data of the OUT
+       transfers are appended to ``history``, if it is set to a bytearray.
+
+       Tests may also set ``bandwidth``, in bytes per second, so that OUT
+       transfers take real time as on a slow link, and ``write_error``, an
+       exception the next OUT transfers raise.
+
+       :param device: the parent device
+       :param ifnum: the interface number, starting from 0
+    """
+
+    STATUS = b'\x32\x60'
+    IDLE_WAIT = 0.001  # real time to wait for data on an empty read
+
+    def __init__(self, device, ifnum):
+        self.device = device
+        self.ifnum = ifnum
+        self.engine = VirtualMpsseEngine(VirtualBus(), device.high_speed)
+        self.bitmode = Ftdi.BITMODE_RESET
+        self.direction = 0
+        self.latency = 16
+        self.baudrate = None
+        self.echo = False
+        self.writes = 0
+        self.reads = 0
+        self.max_write = 0
+        self.max_fifo = 0
+        self.history = None
+        self.bandwidth = None
+        self.write_error = None
+        self._fifo = bytearray()
+        self._flush = False
+        self._event = threading.Event()
+        self._lock = threading.RLock()
+
+    @property
+    def bus(self):
+        """Return the bus model connected to the port"""
+        return self.engine.bus
+
+    def connect(self, bus):
+        """Connect a bus model to the port pins.
+
+           :param bus: a :py:class:`VirtualBus` instance
+        """
+        self.engine.bus = bus
+
+    def inject(self, data):
+        """Queue data to be received by the host, as if the device had
+           received them on its UART"""
+        with self._lock:
+            self._fifo.extend(data)
+            self._event.set()
+
+    def control(self, request, value, data):
+        """Handle a vendor control request.
+
+           :param request: the SIO request
+           :param value: the wValue field of the request
+           :param data: the length to return, or the data to send
+           :return: the reply of an IN request, or the count of written bytes
+        """
+        with self._lock:
+            if request == Ftdi.SIO_RESET:
+                if value in (Ftdi.SIO_RESET_SIO, Ftdi.SIO_RESET_PURGE_RX):
+                    del self._fifo[:]
+                    self._flush = False
+                if value in (Ftdi.SIO_RESET_SIO, Ftdi.SIO_RESET_PURGE_TX):
+                    del self.engine._pending[:]
+            elif request == Ftdi.SIO_SET_BITMODE:
+                self.bitmode = (value >> 8) & Ftdi.BITMODE_MASK
+                self.direction = value & 0xff
+                if self.bitmode == Ftdi.BITMODE_MPSSE:
+                    del self.engine._pending[:]
+                elif self.bitmode != Ftdi.BITMODE_RESET:
+                    self.bus.set_pins(self.bus.pins, self.direction)
+            elif request == Ftdi.SIO_SET_LATENCY_TIMER:
+                self.latency = value & 0xff
+            elif request == Ftdi.SIO_GET_LATENCY_TIMER:
+                return bytes([self.latency])
+            elif request == Ftdi.SIO_READ_PINS:
+                return bytes([self.bus.get_pins() & 0xff])
+            elif request == Ftdi.SIO_POLL_MODEM_STATUS:
+                return self.STATUS
+            elif request == Ftdi.SIO_SET_BAUDRATE:
+                self.baudrate = value
+            elif request == Ftdi.SIO_READ_EEPROM:
+                return b'\xff\xff'
+        if isinstance(data, int):
+            return bytes(data)
+        return len(data)
+
+    def write(self, data):
+        """Handle a bulk OUT transfer.
+
+           :return: the count of accepted bytes
+        """
+        if self.write_error:
+            raise self.write_error
+        if self.bandwidth:
+            sleep(len(data)/self.bandwidth)
+        with self._lock:
+            self.writes += 1
+            self.max_write = max(self.max_write, len(data))
+            if self.history is not None:
+                self.history.extend(data)
+            if self.bitmode == Ftdi.BITMODE_MPSSE:
+                bus_time = self.engine.bus_time
+                reply, flush = self.engine.execute(data)
+                self._fifo.extend(reply)
+                self._flush = self._flush or flush
+                self.device.clock.advance(self.engine.bus_time-bus_time)
+            elif self.bitmode in (Ftdi.BITMODE_BITBANG, Ftdi.BITMODE_SYNCBB):
+                sync = self.bitmode == Ftdi.BITMODE_SYNCBB
+                for byte in data:
+                    if sync:
+                        self._fifo.append(self.bus.get_pins() & 0xff)
+                    self.bus.set_pins(byte, self.direction)
+            elif self.echo:
+                self._fifo.extend(data)
+            self.max_fifo = max(self.max_fifo, len(self._fifo))
+            self._event.set()
+        self.device.transfer(len(data))
+        return len(data)
+
+    def read(self, buf):
+        """Handle a bulk IN transfer.
+
+           Each packet starts with the two modem status bytes. Data are only
+           released once a whole packet is available, or a SEND_IMMEDIATE
+           command has been received, or the latency timer expires.
+
+           :param buf: the buffer to fill in
+           :return: the count of bytes written into the buffer
+        """
+        packet_size = self.device.packet_size
+        payload = packet_size-2
+        count = max(1, len(buf)//packet_size)
+        if not self._fifo:
+            # let the other threads a chance to feed the device
+            self._event.wait(self.IDLE_WAIT)
+        with self._lock:
+            self.reads += 1
+            self._event.clear()
+            if self._flush:
+                length = min(len(self._fifo), count*payload)
+            else:
+                length = min(len(self._fifo)//payload, count)*payload
+                if not length:
+                    # nothing to send until the latency timer expires
+                    self.device.clock.advance(self.latency/1000)
+                    length = min(len(self._fifo), payload)
+            data = self._fifo[:length]
+            del self._fifo[:length]
+            if not self._fifo:
+                self._flush = False
+        view = memoryview(buf)
+        offset = 0
+        for pos in range(0, max(length, 1), payload):
+            chunk = data[pos:pos+payload]
+            view[offset:offset+2] = self.STATUS
+            view[offset+2:offset+2+len(chunk)] = chunk
+            offset += 2+len(chunk)
+        self.device.transfer(offset)
+        return offset
+
+
+class VirtualFtdi(object):
+    """A virtual FTDI device.
+
+       :param model: the device model, one of the ``MODELS`` keys
+       :param serial: the serial number string
+       :param clock: the clock to account the simulated time on
+    """
+
+    # model: (product, bcdDevice, interfaces, high speed, product string)
+    MODELS = {
+        'ft232r': (0x6001, 0x0600, 1, False, 'FT232R USB UART'),
+        'ft2232h': (0x6010, 0x0700, 2, True, 'Dual RS232-HS'),
+        'ft4232h': (0x6011, 0x0800, 4, True, 'Quad RS232-HS'),
+        'ft232h': (0x6014, 0x0900, 1, True, 'Single RS232-HS')}
+
+    MANUFACTURER = 'FTDI'
+    FRAME = {True: 125E-6, False: 1E-3}  # (micro)frame duration
+    BITRATE = {True: 480E6, False: 12E6}
+
+    def __init__(self, model='ft2232h', serial='VIRT0001', clock=None):
+        if model not in self.MODELS:
+            raise ValueError('Unknown FTDI model: %s' % model)
+        product, version, ifcount, high_speed, description = \
+            self.MODELS[model]
+        self.model = model
+        self.high_speed = high_speed
+        self.packet_size = high_speed and 512 or 64
+        self.clock = clock or VirtualClock()
+        self.bus = 1
+        self.address = 0
+        self.configuration = 1
+        self.strings = ['', self.MANUFACTURER, description, serial]
+        self.descriptor = VirtualDescriptor(
+            bLength=18, bDescriptorType=1, bcdUSB=0x200, bDeviceClass=0,
+            bDeviceSubClass=0, bDeviceProtocol=0, bMaxPacketSize0=64,
+            idVendor=Ftdi.FTDI_VENDOR, idProduct=product, bcdDevice=version,
+            iManufacturer=1, iProduct=2, iSerialNumber=3,
+            bNumConfigurations=1, address=None, bus=None, port_number=None,
+            port_numbers=None, speed=high_speed and 3 or 2)
+        self.config_descriptor = VirtualDescriptor(
+            bLength=9, bDescriptorType=2, wTotalLength=9+ifcount*(9+2*7),
+            bNumInterfaces=ifcount, bConfigurationValue=1, iConfiguration=0,
+            bmAttributes=0x80, bMaxPower=45)
+        self.ports = [VirtualFtdiPort(self, ifnum)
+                      for ifnum in range(ifcount)]
+
+    def __repr__(self):
+        return '<%s %s %s>' % (self.__class__.__name__, self.model,
+                               self.strings[3])
+
+    def set_location(self, bus, address):
+        """Assign the USB location of the device"""
+        self.bus = bus
+        self.address = address
+        self.descriptor.bus = bus
+        self.descriptor.address = address
+        self.descriptor.port_number = address
+        self.descriptor.port_numbers = (address, )
+
+    def interface_descriptor(self, ifnum):
+        return VirtualDescriptor(
+            bLength=9, bDescriptorType=4, bInterfaceNumber=ifnum,
+            bAlternateSetting=0, bNumEndpoints=2, bInterfaceClass=0xff,
+            bInterfaceSubClass=0xff, bInterfaceProtocol=0xff,
+            iInterface=2)
+
+    def endpoint_descriptor(self, ifnum, ep):
+        # IN endpoint first, then OUT endpoint
+        address = ep and (0x02+2*ifnum) or (0x81+2*ifnum)
+        return VirtualDescriptor(
+            bLength=7, bDescriptorType=5, bEndpointAddress=address,
+            bmAttributes=0x02, wMaxPacketSize=self.packet_size,
+            bInterval=0, bRefresh=0, bSynchAddress=0)
+
+    def port(self, endpoint):
+        """Return the port an endpoint belongs to"""
+        return self.ports[((endpoint & 0x7f)-1)//2]
+
+    def transfer(self, length):
+        """Account the USB time of a bulk transfer"""
+        self.clock.advance(self.FRAME[self.high_speed] +
+                           8*length/self.BITRATE[self.high_speed])
+
+    def control(self, reqtype, request, value, index, data):
+        """Handle a control transfer"""
+        if reqtype == 0x80 and request == 0x06:
+            # GET_DESCRIPTOR
+            if (value >> 8) != 0x03:
+                raise IOError('Unsupported descriptor')
+            strid = value & 0xff
+            if not strid:
+                desc = b'\x04\x03\x09\x04'
+            elif strid < len(self.strings):
+                text = self.strings[strid].encode('utf-16-le')
+                desc = bytes((2+len(text), 3)) + text
+            else:
+                raise IOError('No such string')
+            return desc[:data]
+        if (reqtype & 0x60) != 0x40:
+            return isinstance(data, int) and bytes(data) or len(data)
+        port = (index & 0xff) or 1
+        if port > len(self.ports):
+            raise IOError('No such port: %d' % port)
+        return self.ports[port-1].control(request, value, data)
+
+
+class VirtualBackend(IBackend):
+    """PyUSB backend that enumerates virtual FTDI devices"""
+
+    def __init__(self):
+        self.devices = []
+        self.clock = VirtualClock()
+        self._lock = threading.Lock()
+
+    def add_device(self, model='ft2232h', serial=None):
+        """Plug in a new virtual device.
+
+           :param model: the device model
+           :param serial: the serial number, built from the device count if
+                          omitted
+           :return: the new :py:class:`VirtualFtdi` device
+        """
+        with self._lock:
+            address = max([dev.address for dev in self.devices] or [0])+1
+            device = VirtualFtdi(model, serial or 'VIRT%04d' % address,
+                                 self.clock)
+            device.set_location(1, address)
+            self.devices.append(device)
+        return device
+
+    def remove_device(self, device):
+        """Unplug a virtual device"""
+        with self._lock:
+            self.devices.remove(device)
+
+    def clear(self):
+        """Unplug all virtual devices and reset the simulated time"""
+        with self._lock:
+            self.devices = []
+            self.clock = VirtualClock()
+
+    def enumerate_devices(self):
+        with self._lock:
+            devices = list(self.devices)
+        return iter(devices)
+
+    def get_device_descriptor(self, dev):
+        return dev.descriptor
+
+    def get_configuration_descriptor(self, dev, config):
+        if config:
+            raise IndexError('No such configuration')
+        return dev.config_descriptor
+
+    def get_interface_descriptor(self, dev, intf, alt, config):
+        if alt or intf >= len(dev.ports):
+            raise IndexError('No such interface')
+        return dev.interface_descriptor(intf)
+
+    def get_endpoint_descriptor(self, dev, ep, intf, alt, config):
+        if ep > 1:
+            raise IndexError('No such endpoint')
+        return dev.endpoint_descriptor(intf, ep)
+
+    def open_device(self, dev):
+        return dev
+
+    def close_device(self, dev_handle):
+        pass
+
+    def set_configuration(self, dev_handle, config_value):
+        dev_handle.configuration = config_value
+
+    def get_configuration(self, dev_handle):
+        return dev_handle.configuration
+
+    def set_interface_altsetting(self, dev_handle, intf, altsetting):
+        pass
+
+    def claim_interface(self, dev_handle, intf):
+        pass
+
+    def release_interface(self, dev_handle, intf):
+        pass
+
+    def is_kernel_driver_active(self, dev_handle, intf):
+        return False
+
+    def detach_kernel_driver(self, dev_handle, intf):
+        pass
+
+    def attach_kernel_driver(self, dev_handle, intf):
+        pass
+
+    def reset_device(self, dev_handle):
+        for port in dev_handle.ports:
+            port.control(Ftdi.SIO_RESET, Ftdi.SIO_RESET_SIO, b'')
+
+    def clear_halt(self, dev_handle, ep):
+        pass
+
+    def bulk_write(self, dev_handle, ep, intf, data, timeout):
+        return dev_handle.port(ep).write(data)
+
+    def bulk_read(self, dev_handle, ep, intf, buff, timeout):
+        return dev_handle.port(ep).read(buff)
+
+    def ctrl_transfer(self, dev_handle, bmRequestType, bRequest, wValue,
+                      wIndex, data, timeout):
+        if bmRequestType & 0x80:
+            reply = dev_handle.control(bmRequestType, bRequest, wValue,
+                                       wIndex, len(data))
+            data[:len(reply)] = Array('B', reply)
+            return len(reply)
+        return dev_handle.control(bmRequestType, bRequest, wValue, wIndex,
+                                  data)
+
+
+_BACKEND = VirtualBackend()
+
+
+def get_backend(*args, **kwargs):
+    """Return the virtual backend, as PyUSB backend modules do"""
+    return _BACKEND
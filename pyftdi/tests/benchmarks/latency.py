@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017, Emmanuel Blot <emmanuel.blot@free.fr>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the Neotion nor the names of its contributors may
+#       be used to endorse or promote products derived from this software
+#       without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL NEOTION BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Simulation of the latency timer policies.
+
+   A FTDI device sends a USB packet either when it is full, or when its
+   latency timer expires, in which case the packet may only contain the
+   modem status. The host reads packets back to back. Each workload below
+   is replayed against every policy, and the following figures are
+   reported:
+
+   * the mean and the 99th percentile of the delay between the reception
+     of a byte by the device and its delivery to the host,
+   * the count of USB transfers per second, i.e. the host wake-ups, which
+     is a proxy of the CPU load,
+   * the count of latency timer changes per second, i.e. control transfers.
+
+   The simulation runs on a virtual time base, and is deterministic.
+"""
+
+from argparse import ArgumentParser
+from collections import deque
+from pyftdi.latency import (BulkPolicy, InteractivePolicy, LatencyController,
+                            RequestResponsePolicy, ThresholdPolicy)
+from random import Random
+
+WRITE, DATA = range(2)
+
+
+class SimulatedFtdi(object):
+    """Bare minimum of a FTDI device for a latency controller"""
+
+    def __init__(self, latency, packet_size):
+        self.latency = latency
+        self.max_packet_size = packet_size
+
+    def set_latency_timer(self, latency):
+        self.latency = latency
+
+
+def interactive(rand, duration):
+    """A console: keystrokes, each one echoed back by the remote side"""
+    now = 0.0
+    while now < duration:
+        now += rand.expovariate(5.0)
+        yield now, WRITE, 1
+        yield now+0.001, DATA, 1
+
+
+def uart(baudrate, period):
+    """A logger which sends lines at baudrate, half of the time"""
+    def workload(rand, duration):
+        chunk = 16
+        step = 10*chunk/baudrate
+        now = 0.0
+        while now < duration:
+            end = now+period/2
+            while now < end:
+                yield now, DATA, chunk
+                now += step
+            now = end+period/2
+    return workload
+
+
+def mpsse(rand, duration):
+    """Bursts of MPSSE requests, each request being answered right away"""
+    now = 0.0
+    while now < duration:
+        for _ in range(50):
+            yield now, WRITE, 8
+            yield now+20E-6, DATA, 16
+            now += 0.002
+        now += rand.uniform(0.5, 1.5)
+
+
+def simulate(events, duration, packet_size, latency, policy, holdoff):
+    device = SimulatedFtdi(latency, packet_size)
+    now = 0.0
+    if policy:
+        controller = LatencyController(device, policy, holdoff,
+                                       clock=lambda: now)
+    else:
+        controller = None
+    payload = packet_size-2
+    fifo = deque()
+    buffered = 0
+    last_send = 0.0
+    reads = 0
+    delays = []
+    pos = 0
+    while now < duration:
+        deadline = last_send+device.latency/1000
+        if pos < len(events) and events[pos][0] <= deadline and \
+                buffered < payload:
+            now, kind, size = events[pos]
+            pos += 1
+            if kind == DATA:
+                fifo.append([now, size])
+                buffered += size
+            elif controller:
+                controller.on_write(size)
+            continue
+        if buffered < payload:
+            now = max(now, deadline)
+        length = min(buffered, payload)
+        remaining = length
+        while remaining:
+            arrival = fifo[0]
+            count = min(arrival[1], remaining)
+            delays.append((now-arrival[0], count))
+            arrival[1] -= count
+            remaining -= count
+            if not arrival[1]:
+                fifo.popleft()
+        buffered -= length
+        last_send = now
+        reads += 1
+        if controller:
+            controller.on_read(length)
+    changes = controller.changes if controller else 0
+    return delays, reads/duration, changes/duration
+
+
+def percentile(delays, ratio):
+    total = sum(count for _, count in delays)
+    threshold = ratio*total
+    for delay, count in sorted(delays):
+        threshold -= count
+        if threshold <= 0:
+            return delay
+    return 0.0
+
+
+POLICIES = (
+    ('fixed 1 ms', 1, lambda: None, 0),
+    ('fixed 16 ms', 16, lambda: None, 0),
+    ('threshold', 200, lambda: ThresholdPolicy(2, 200, 400), 0),
+    ('interactive', 16, InteractivePolicy, 0.05),
+    ('bulk', 16, BulkPolicy, 0.05),
+    ('request/response', 16, RequestResponsePolicy, 0.05),
+)
+
+WORKLOADS = (
+    ('console', interactive),
+    ('uart 115200', uart(115200, 2.0)),
+    ('uart 3M', uart(3000000, 2.0)),
+    ('mpsse', mpsse),
+)
+
+
+def main():
+    argparser = ArgumentParser(description=__doc__.split('\n')[0])
+    argparser.add_argument('-d', '--duration', type=float, default=10.0,
+                           help='simulated seconds per run (default: 10)')
+    argparser.add_argument('-s', '--size', type=int, default=512,
+                           help='USB packet size (default: 512)')
+    args = argparser.parse_args()
+    for wname, workload in WORKLOADS:
+        events = sorted(workload(Random(0), args.duration))
+        print(wname)
+        print('  %-18s %10s %10s %12s %10s' %
+              ('policy', 'mean ms', 'p99 ms', 'transfers/s', 'changes/s'))
+        for pname, latency, policy, holdoff in POLICIES:
+            delays, reads, changes = simulate(events, args.duration,
+                                              args.size, latency, policy(),
+                                              holdoff)
+            total = sum(count for _, count in delays) or 1
+            mean = sum(delay*count for delay, count in delays)/total
+            print('  %-18s %10.2f %10.2f %12.0f %10.1f' %
+                  (pname, 1000*mean, 1000*percentile(delays, 0.99), reads,
+                   changes))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017, Emmanuel Blot <emmanuel.blot@free.fr>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the Neotion nor the names of its contributors may
+#       be used to endorse or promote products derived from this software
+#       without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL NEOTION BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Performance suite of the PyFtdi hot paths, for pytest-benchmark.
+
+   Run it with::
+
+       pytest pyftdi/tests/benchmarks/perf.py
+
+   Each subsystem is measured with a minimal payload, i.e. the per-call
+   overhead, and with a large payload, i.e. the throughput; the payload size
+   is recorded in the ``bytes`` extra info of each benchmark. The controller
+   benchmarks also record, in the ``simulated_us`` extra info, the time a
+   call takes on the emulated USB link and serial bus.
+
+   Optimized paths are compared, in the same benchmark group, with the
+   implementation they replace, which is kept here as a reference.
+
+   The FTDI devices are emulated in-process with the virtual USB backend, so
+   the figures only reflect the Python-side cost of PyFtdi, and regressions
+   show up without any hardware.
+"""
+
+import asyncio
+import pytest
+from array import array as Array
+from binascii import hexlify
+from pyftdi.bits import BitSequence
+from pyftdi.ftdi import Ftdi
+from pyftdi.gpio import GpioController
+from pyftdi.i2c import I2cController
+from pyftdi.jtag import JtagEngine
+from pyftdi.misc import hexdump
+from pyftdi.serialext.aio import FtdiHub, open_serial_connection
+from pyftdi.spi import SpiController, SpiPort
+from pyftdi.tests.backend import usbvirt
+from pyftdi.tests.backend.mpsse import (VirtualI2cBus, VirtualJtagBus,
+                                        VirtualJtagTap, VirtualSpiBus)
+from pyftdi.tests.i2c import VirtualI2cEeprom
+from pyftdi.tests.spi import VirtualSpiLoopback
+from pyftdi.usbtools import UsbTools
+
+pytest.importorskip('pytest_benchmark')
+
+SMALL, LARGE = 1, 4096
+
+
+class LegacyFtdi(Ftdi):
+    """Ftdi with the former read path, which rebuilt the read buffer from
+       slices on every USB transfer"""
+
+    def _read(self):
+        data = self.usb_dev.read(self.out_ep, self.readbuffer_chunksize,
+                                 self.usb_read_timeout)
+        if data:
+            self.log.debug('< %s', hexlify(data).decode())
+        return data
+
+    def read_data_bytes(self, size, attempt=1):
+        packet_size = self.max_packet_size
+        length = 1
+        data = Array('B')
+        if size <= len(self.readbuffer)-self.readoffset:
+            data = self.readbuffer[self.readoffset:self.readoffset+size]
+            self.readoffset += size
+            return data
+        if len(self.readbuffer)-self.readoffset != 0:
+            data = self.readbuffer[self.readoffset:]
+            self.readoffset = len(self.readbuffer)
+        while (len(data) < size) and (length > 0):
+            while True:
+                tempbuf = self._read()
+                attempt -= 1
+                length = len(tempbuf)
+                if length > 2:
+                    chunks = (length+packet_size-1) // packet_size
+                    count = packet_size - 2
+                    self.readbuffer = Array('B')
+                    self.readoffset = 0
+                    srcoff = 2
+                    for i in range(chunks):
+                        self.readbuffer += tempbuf[srcoff:srcoff+count]
+                        srcoff += packet_size
+                    length = len(self.readbuffer)
+                    break
+                else:
+                    if attempt > 0:
+                        continue
+                    self.readbuffer = Array('B')
+                    self.readoffset = 0
+                    return data
+            if length > 0:
+                if (len(data) + length) <= size:
+                    data += self.readbuffer[self.readoffset:
+                                            self.readoffset+length]
+                    self.readoffset += length
+                    if len(data) == size:
+                        return data
+                else:
+                    part_size = min(size-len(data),
+                                    len(self.readbuffer)-self.readoffset)
+                    data += self.readbuffer[self.readoffset:
+                                            self.readoffset+part_size]
+                    self.readoffset += part_size
+                    return data
+
+
+class LegacySpiPort(SpiPort):
+    """SPI port without precompiled command templates"""
+
+    def _template(self, writelen, readlen, start, stop):
+        return None
+
+
+def simulated(benchmark, backend, func, *args):
+    """Record the simulated time of a single call, then benchmark it"""
+    start = backend.clock.time()
+    func(*args)
+    benchmark.extra_info['simulated_us'] = 1E6*(backend.clock.time()-start)
+    return benchmark(func, *args)
+
+
+@pytest.fixture
+def backend():
+    backend = usbvirt.get_backend()
+    backend.clear()
+    UsbTools.set_backend(backend)
+    yield backend
+    backend.clear()
+    UsbTools.set_backend(None)
+
+
+@pytest.fixture
+def ftdi(backend):
+    device = backend.add_device('ft2232h')
+    ftdi = Ftdi()
+    ftdi.open_from_url('ftdi://ftdi:2232h/2')
+    ftdi.port = device.ports[1]
+    yield ftdi
+    ftdi.close()
+
+
+@pytest.fixture(params=(Ftdi, LegacyFtdi), ids=('current', 'legacy'))
+def reader(request, backend):
+    device = backend.add_device('ft2232h')
+    ftdi = request.param()
+    ftdi.open_from_url('ftdi://ftdi:2232h/2')
+    ftdi.port = device.ports[1]
+    yield ftdi
+    ftdi.close()
+
+
+@pytest.fixture(params=(SpiPort, LegacySpiPort), ids=('template', 'legacy'))
+def spi(request, backend):
+    device = backend.add_device('ft2232h')
+    device.ports[0].connect(VirtualSpiBus({0: VirtualSpiLoopback()}))
+    spi = SpiController()
+    spi.configure('ftdi://ftdi:2232h/1')
+    port = spi.get_port(0, freq=30E6)
+    if request.param is not SpiPort:
+        # same /CS hold time as the port the controller has built
+        port = request.param(spi, 0, cs_hold=1+int(1E6/port.frequency))
+        port.set_frequency(30E6)
+    yield port
+    spi.terminate()
+
+
+@pytest.fixture
+def i2c(backend):
+    device = backend.add_device('ft232h')
+    eeprom = VirtualI2cEeprom(write_buffer=256)
+    device.ports[0].connect(VirtualI2cBus([eeprom]))
+    i2c = I2cController()
+    i2c.configure('ftdi://ftdi:232h/1')
+    yield i2c.get_port(eeprom.address)
+    i2c.terminate()
+
+
+@pytest.fixture
+def gpio(backend):
+    backend.add_device('ft4232h')
+    gpio = GpioController()
+    gpio.open_from_url('ftdi://ftdi:4232h/1', direction=0xff)
+    yield gpio
+    gpio.close()
+
+
+@pytest.fixture
+def jtag(backend):
+    device = backend.add_device('ft4232h')
+    device.ports[0].connect(VirtualJtagBus(VirtualJtagTap(0x4ba00477)))
+    jtag = JtagEngine(frequency=6E6)
+    jtag.configure('ftdi://ftdi:4232h/1')
+    jtag.reset()
+    jtag.change_state('shift_dr')
+    yield jtag
+    jtag.close()
+
+
+@pytest.mark.parametrize('count', (1, 128))
+def test_usb_find_all(benchmark, backend, count):
+    # a single device of interest, amongst many other USB devices
+    backend.add_device('ft4232h', 'FTTARGET')
+    for _ in range(count-1):
+        backend.add_device('ft232h')
+
+    def find():
+        UsbTools.flush_cache()
+        return Ftdi.get_identifiers('ftdi://ftdi:4232h:FTTARGET/1')
+    benchmark.extra_info['devices'] = count
+    assert benchmark(find)[3] == 'FTTARGET'
+
+
+@pytest.mark.parametrize('size', (SMALL, LARGE))
+def test_ftdi_write_data(benchmark, ftdi, size):
+    data = bytes(size)
+    benchmark.extra_info['bytes'] = size
+    assert benchmark(ftdi.write_data, data) == size
+
+
+@pytest.mark.parametrize('pipelined', (False, True),
+                         ids=('write_data', 'pipeline'))
+@pytest.mark.parametrize('size', (256, LARGE, 65536))
+def test_ftdi_write_pipeline(benchmark, ftdi, size, pipelined):
+    # the caller builds each block while the previous ones are sent over a
+    # 4 MB/s link, as a bitbang pattern generator would do
+    total = 256 << 10
+    ftdi.port.bandwidth = 4E6
+
+    def write():
+        if pipelined:
+            ftdi.start_write_pipeline()
+        for index in range(total//size):
+            block = bytes((index+x) & 0xff for x in range(size))
+            if pipelined:
+                ftdi.write_data_async(block)
+            else:
+                ftdi.write_data(block)
+        if pipelined:
+            ftdi.stop_write_pipeline()
+    benchmark.group = 'ftdi write %d-byte blocks' % size
+    benchmark.extra_info['bytes'] = total
+    benchmark.pedantic(write, rounds=5)
+
+
+@pytest.mark.parametrize('size', (SMALL, LARGE, 65536))
+def test_ftdi_read_data_bytes(benchmark, reader, size):
+    data = bytes(range(256))*(size//256) or bytes(size)
+
+    def read():
+        reader.port.inject(data)
+        return reader.read_data_bytes(size, 4)
+    benchmark.group = 'ftdi read_data_bytes %d' % size
+    benchmark.extra_info['bytes'] = size
+    assert benchmark(read).tobytes() == data
+
+
+@pytest.mark.parametrize('max_ports', (32, FtdiHub.MAX_PORTS),
+                         ids=('single_hub', 'shared_hubs'))
+@pytest.mark.parametrize('count', (4, 32))
+def test_serial_hub_echo(benchmark, backend, monkeypatch, count, max_ports):
+    # one port echoes, the other ones are idle: the response time grows with
+    # the count of ports a hub thread reads in turn
+    monkeypatch.setattr(FtdiHub, '_defaults', [])
+    monkeypatch.setattr(FtdiHub, 'MAX_PORTS', max_ports)
+    devices = [backend.add_device('ft4232h', 'FT%d' % serial)
+               for serial in range(count//4)]
+    devices[0].ports[0].echo = True
+    loop = asyncio.new_event_loop()
+
+    async def open_ports():
+        return await asyncio.gather(*[
+            open_serial_connection('ftdi://ftdi:4232h:FT%d/%d' %
+                                   (serial, ifn), loop=loop)
+            for serial in range(count//4) for ifn in range(1, 5)])
+    streams = loop.run_until_complete(open_ports())
+    reader, writer = streams[0]
+
+    def echo():
+        writer.write(b'x')
+        loop.run_until_complete(reader.readexactly(1))
+    benchmark.group = 'serial hub echo, %d ports' % count
+    benchmark.extra_info['hubs'] = len(FtdiHub._defaults)
+    try:
+        benchmark.pedantic(echo, rounds=20)
+    finally:
+        for _, writer_ in streams:
+            writer_.close()
+        while any(hub.ports for hub in FtdiHub._defaults):
+            loop.run_until_complete(asyncio.sleep(0.01))
+        loop.close()
+
+
+@pytest.mark.parametrize('size', (SMALL, 4, 16, LARGE))
+def test_spi_exchange(benchmark, backend, spi, size):
+    out = bytes(size)
+    benchmark.group = 'spi exchange %d' % size
+    benchmark.extra_info['bytes'] = 2*size
+    assert len(simulated(benchmark, backend, spi.exchange, out, size)) == size
+
+
+@pytest.mark.parametrize('size', (SMALL, 256))
+def test_i2c_read_from(benchmark, backend, i2c, size):
+    benchmark.extra_info['bytes'] = size
+    assert len(simulated(benchmark, backend, i2c.read_from, 0x00,
+                         size)) == size
+
+
+@pytest.mark.parametrize('size', (SMALL, 128))
+def test_i2c_write_to(benchmark, backend, i2c, size):
+    out = bytes(size)
+    benchmark.extra_info['bytes'] = size
+    simulated(benchmark, backend, i2c.write_to, 0x00, out)
+
+
+def test_gpio_write_port(benchmark, backend, gpio):
+    benchmark.extra_info['bytes'] = 1
+    simulated(benchmark, backend, gpio.write_port, 0xa5)
+
+
+@pytest.mark.parametrize('size', (SMALL, 128))
+def test_jtag_shift_register(benchmark, backend, jtag, size):
+    out = BitSequence(bytes_=bytes(range(size)))
+    benchmark.extra_info['bytes'] = size
+    assert len(simulated(benchmark, backend, jtag.shift_register,
+                         out)) == 8*size
+
+
+@pytest.mark.parametrize('size', (SMALL, LARGE))
+def test_bitsequence_from_bytes(benchmark, size):
+    data = bytes(range(256))*(size//256) or b'\xa5'
+    benchmark.extra_info['bytes'] = size
+    assert len(benchmark(BitSequence, bytes_=data)) == 8*size
+
+
+@pytest.mark.parametrize('size', (SMALL, LARGE))
+def test_bitsequence_tobytes(benchmark, size):
+    seq = BitSequence(bytes_=bytes(range(256))*(size//256) or b'\xa5')
+    benchmark.extra_info['bytes'] = size
+    assert len(benchmark(seq.tobytes)) == size
+
+
+def test_bitsequence_int(benchmark):
+    seq = BitSequence(0x4ba00477, length=32)
+    benchmark.extra_info['bytes'] = 4
+    assert benchmark(int, seq) == 0x4ba00477
+
+
+@pytest.mark.parametrize('size', (16, LARGE))
+def test_hexdump(benchmark, size):
+    data = bytes(range(256))*(size//256) or bytes(range(size))
+    benchmark.extra_info['bytes'] = size
+    assert benchmark(hexdump, data, full=True)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017, Emmanuel Blot <emmanuel.blot@free.fr>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the Neotion nor the names of its contributors may
+#       be used to endorse or promote products derived from this software
+#       without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL NEOTION BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import unittest
+from doctest import testmod
+from io import BytesIO
+from logging import StreamHandler, DEBUG
+from pyftdi import FtdiLogger
+from pyftdi.bits import BitSequence
+from pyftdi.capture import (CaptureError, CaptureReader, CaptureWriter,
+                            I2cDecoder, JtagDecoder, MpsseDecoder,
+                            SpiDecoder)
+from pyftdi.ftdi import Ftdi
+from pyftdi.i2c import I2cController, I2cNackError
+from pyftdi.jtag import JtagEngine
+from pyftdi.spi import SpiController
+from pyftdi.tests.backend import usbvirt
+from pyftdi.tests.backend.mpsse import (VirtualI2cBus, VirtualJtagBus,
+                                        VirtualJtagTap, VirtualSpiBus)
+from pyftdi.tests.i2c import VirtualI2cEeprom
+from pyftdi.tests.spi import VirtualSpiEeprom
+from pyftdi.trace import UsbTracer
+from pyftdi.usbtools import UsbTools
+from sys import modules, stdout
+
+
+class CaptureTestCase(unittest.TestCase):
+    """Capture USB traffic of virtual devices, and decode it"""
+
+    def setUp(self):
+        self.backend = usbvirt.get_backend()
+        self.backend.clear()
+        UsbTools.set_backend(self.backend)
+        self.stream = BytesIO()
+        self.capture = CaptureWriter(self.stream, buffer_size=64)
+
+    def tearDown(self):
+        self.capture.close()
+        self.backend.clear()
+        UsbTools.set_backend(None)
+
+    def _decode(self, packet_size=512):
+        self.capture.close()
+        self.stream.seek(0)
+        reader = CaptureReader(self.stream)
+        return list(MpsseDecoder(packet_size).decode(reader))
+
+    def test_records(self):
+        self.capture.trace(UsbTracer.BULK_OUT, 0x02, b'abc')
+        self.capture.trace(UsbTracer.BULK_IN, 0x81, b'\x32\x60' + bytes(100))
+        self.capture.close()
+        # further transfers are ignored
+        self.capture.trace(UsbTracer.BULK_OUT, 0x02, b'def')
+        self.stream.seek(0)
+        records = list(CaptureReader(self.stream))
+        self.assertEqual([(r.kind, r.endpoint, r.data) for r in records],
+                         [('>', 0x02, b'abc'),
+                          ('<', 0x81, b'\x32\x60' + bytes(100))])
+        self.assertLessEqual(records[0].timestamp, records[1].timestamp)
+        # truncated captures are decoded up to the last complete record
+        self.stream = BytesIO(self.stream.getvalue()[:-1])
+        self.assertEqual(len(list(CaptureReader(self.stream))), 1)
+        with self.assertRaises(CaptureError):
+            CaptureReader(BytesIO(b'not a capture file'))
+
+    def test_mpsse(self):
+        self.backend.add_device('ft232h')
+        ftdi = Ftdi()
+        ftdi.set_tracer(self.capture)
+        ftdi.open_mpsse_from_url('ftdi://ftdi:232h/1')
+        ftdi.write_data(bytes((Ftdi.SET_BITS_LOW, 0x01, 0x0b,
+                               Ftdi.READ_BYTES_PVE_MSB, 0x01)))
+        # command split across two USB transfers
+        ftdi.write_data(bytes((0x00, Ftdi.GET_BITS_LOW, 0xab,
+                               Ftdi.SEND_IMMEDIATE)))
+        self.assertEqual(len(ftdi.read_data(5)), 5)
+        ftdi.close()
+        commands = self._decode()
+        names = [command.name for command in commands]
+        index = names.index('READ_BYTES_PVE_MSB')
+        self.assertEqual(names[index-1:], ['SET_BITS_LOW',
+                                           'READ_BYTES_PVE_MSB',
+                                           'GET_BITS_LOW',
+                                           'BAD_COMMAND_AB',
+                                           'SEND_IMMEDIATE'])
+        self.assertEqual(commands[index-1].args, b'\x01\x0b')
+        self.assertEqual(commands[index].reply, b'\xff\xff')
+        self.assertEqual(commands[index+1].reply, b'\x01')
+        self.assertEqual(commands[index+2].reply, b'\xfa\xab')
+
+    def test_spi(self):
+        device = self.backend.add_device('ft2232h')
+        device.ports[0].connect(VirtualSpiBus({1: VirtualSpiEeprom()}))
+        spi = SpiController(cs_count=2)
+        spi._ftdi.set_tracer(self.capture)
+        spi.configure('ftdi://ftdi:2232h/1')
+        port = spi.get_port(1)
+        port.exchange(b'\x02\x10abc')
+        self.assertEqual(port.exchange(b'\x03\x10', 3).tobytes(), b'abc')
+        spi.terminate()
+        transactions = list(SpiDecoder().decode(self._decode()))
+        self.assertEqual([(t.cs, t.out, t.reply) for t in transactions],
+                         [(1, b'\x02\x10abc', b''),
+                          (1, b'\x03\x10', b'abc')])
+
+    def test_i2c(self):
+        device = self.backend.add_device('ft232h')
+        device.ports[0].connect(VirtualI2cBus([VirtualI2cEeprom()]))
+        i2c = I2cController()
+        i2c.RETRY_COUNT = 1
+        i2c._ftdi.set_tracer(self.capture)
+        i2c.configure('ftdi://ftdi:232h/1')
+        port = i2c.get_port(0x50)
+        port.write(b'\x10xyz')
+        self.assertEqual(port.exchange(b'\x10', 3), b'xyz')
+        with self.assertRaises(I2cNackError):
+            i2c.get_port(0x51).write(b'\x00')
+        i2c.terminate()
+        transactions = list(I2cDecoder().decode(self._decode(512)))
+        self.assertEqual([(t.address, t.read, t.data, t.nack)
+                          for t in transactions],
+                         [(0x50, False, b'\x10xyz', None),
+                          (0x50, False, b'\x10', None),
+                          (0x50, True, b'xyz', None),
+                          (0x51, False, b'', 0)])
+
+    def test_jtag(self):
+        device = self.backend.add_device('ft4232h')
+        device.ports[0].connect(VirtualJtagBus(VirtualJtagTap(0x4ba00477)))
+        jtag = JtagEngine()
+        jtag._ctrl._ftdi.set_tracer(self.capture)
+        jtag.configure('ftdi://ftdi:4232h/1')
+        jtag.reset()
+        jtag.write_ir(BitSequence('0100', msb=True, length=4))
+        self.assertEqual(int(jtag.read_dr(32)), 0x4ba00477)
+        jtag.go_idle()
+        jtag.close()
+        scans = list(JtagDecoder().decode(self._decode()))
+        self.assertEqual([(s.register, s.length, s.out) for s in scans],
+                         [('ir', 4, 0b0100), ('dr', 33, 0)])
+        # the last bit is shifted while leaving the Shift-DR state
+        self.assertEqual(scans[1].reply & 0xffffffff, 0x4ba00477)
+
+
+def suite():
+    suite_ = unittest.TestSuite()
+    suite_.addTest(unittest.makeSuite(CaptureTestCase, 'test'))
+    return suite_
+
+
+if __name__ == '__main__':
+    testmod(modules[__name__])
+    FtdiLogger.log.addHandler(StreamHandler(stdout))
+    FtdiLogger.set_level(DEBUG)
+    unittest.main(defaultTest='suite')
@@ -29,10 +29,19 @@
 import sys
 import unittest
 
+from array import array as Array
 from doctest import testmod
-from pyftdi.ftdi import Ftdi
+from io import StringIO
+from pyftdi.ftdi import Ftdi, FtdiError
+from pyftdi.stats import Histogram
+from pyftdi.tests.backend import usbvirt
+from pyftdi.trace import UsbTracer
+from pyftdi.usbtools import UsbTools
+from threading import Event, Thread
 from time import sleep
 
+import usb.core
+
 
 class FtdiTestCase(unittest.TestCase):
     """FTDI driver test case"""
@@ -52,8 +61,271 @@ class FtdiTestCase(unittest.TestCase):
         ftdi2.close()
 
 
+class VirtualFtdiTestCase(unittest.TestCase):
+    """Base test case for a FTDI port on the virtual USB backend"""
+
+    def setUp(self):
+        self.backend = usbvirt.get_backend()
+        self.backend.clear()
+        UsbTools.set_backend(self.backend)
+        self.device = self.backend.add_device('ft2232h')
+        self.ftdi = Ftdi()
+        self.ftdi.open_from_url('ftdi://ftdi:2232h/1')
+
+    def tearDown(self):
+        self.ftdi.close()
+        self.backend.clear()
+        UsbTools.set_backend(None)
+
+
+class FtdiReadTestCase(VirtualFtdiTestCase):
+    """FTDI read path test case, on the virtual USB backend"""
+
+    PAYLOAD = 510  # high speed packet, without the modem status bytes
+
+    @staticmethod
+    def _sequence(start, length):
+        return bytes((start+x) & 0xff for x in range(length))
+
+    def test_strip_packets(self):
+        # two full packets and a short one
+        data = self._sequence(0, 2*self.PAYLOAD+100)
+        self.device.ports[0].inject(data)
+        buf = self.ftdi.read_data_bytes(len(data), 4)
+        self.assertIsInstance(buf, Array)
+        self.assertEqual(buf.tobytes(), data)
+
+    def test_cached_data(self):
+        data = self._sequence(0, 2*self.PAYLOAD)
+        self.device.ports[0].inject(data)
+        self.assertEqual(self.ftdi.read_data(3), data[:3])
+        self.assertEqual(self.ftdi.read_data(1000), data[3:1003])
+        self.device.ports[0].inject(b'klm')
+        # request spans over the cached data and a new USB transfer
+        self.assertEqual(self.ftdi.read_data(20), data[1003:] + b'klm')
+        self.assertEqual(self.ftdi.read_data(5), b'')
+
+    def test_status_only(self):
+        # a single attempt gives up on the first status-only transfer
+        self.assertEqual(self.ftdi.read_data(2), b'')
+        self.device.ports[0].inject(b'ab')
+        self.assertEqual(self.ftdi.read_data_bytes(2, 4).tobytes(), b'ab')
+
+    def test_partial_read(self):
+        self.device.ports[0].inject(b'abc')
+        self.assertEqual(self.ftdi.read_data(8), b'abc')
+        self.assertEqual(self.ftdi.read_data(8), b'')
+
+    def _feed(self, rate, stop):
+        """Receive a counter sequence at a fixed rate, in bytes per second,
+           as a device receiving a continuous UART stream would do."""
+        counter = 0
+        while not stop.is_set():
+            self.device.ports[0].inject(self._sequence(counter, 64))
+            counter += 64
+            sleep(64/rate)
+
+    def _check_sequence(self, data):
+        self.assertEqual(data, self._sequence(0, len(data)))
+
+    def test_stream_queue(self):
+        stop = Event()
+        feeder = Thread(target=self._feed, args=(100000, stop))
+        feeder.start()
+        try:
+            self.ftdi.start_stream(depth=4)
+            self.assertTrue(self.ftdi.is_streaming)
+            self.assertRaises(FtdiError, self.ftdi.read_data_bytes, 1)
+            data = bytearray()
+            while len(data) < 8192:
+                chunk = self.ftdi.read_stream(timeout=1.0)
+                self.assertTrue(chunk)
+                data.extend(chunk)
+            self.ftdi.stop_stream()
+        finally:
+            stop.set()
+            feeder.join()
+        self.assertFalse(self.ftdi.is_streaming)
+        self._check_sequence(data)
+
+    def test_stream_callback(self):
+        stop = Event()
+        feeder = Thread(target=self._feed, args=(100000, stop))
+        feeder.start()
+        chunks = []
+        try:
+            self.ftdi.start_stream(callback=chunks.append)
+            sleep(0.1)
+            self.ftdi.stop_stream()
+        finally:
+            stop.set()
+            feeder.join()
+        data = b''.join(chunks)
+        self.assertGreater(len(data), 1000)
+        self._check_sequence(data)
+
+
+class FtdiWriteTestCase(VirtualFtdiTestCase):
+    """FTDI write pipeline test case, on the virtual USB backend"""
+
+    def setUp(self):
+        super(FtdiWriteTestCase, self).setUp()
+        self.ftdi.write_data_set_chunksize(4)
+        self.port = self.device.ports[0]
+        self.port.history = bytearray()
+        # a 4-byte transfer takes 1 ms
+        self.port.bandwidth = 4000
+
+    def test_pipeline(self):
+        ftdi = self.ftdi
+        writes = self.port.writes
+        ftdi.start_write_pipeline(depth=2)
+        buf = bytearray(b'abcdef')
+        futures = [ftdi.write_data_async(buf)]
+        # the caller is free to reuse its buffer
+        buf[:] = b'ghij'
+        futures.append(ftdi.write_data_async(buf))
+        # synchronous writes are ordered with the queued ones
+        self.assertEqual(ftdi.write_data(b'klm'), 3)
+        self.assertEqual([f.result() for f in futures], [6, 4])
+        self.assertEqual(ftdi.write_pending, 0)
+        ftdi.stop_write_pipeline()
+        self.assertEqual(bytes(self.port.history), b'abcdefghijklm')
+        self.assertEqual(self.port.writes-writes, 4)
+
+    def test_pipeline_stop(self):
+        ftdi = self.ftdi
+        writes = self.port.writes
+        ftdi.start_write_pipeline(depth=8)
+        futures = [ftdi.write_data_async(b'%04d' % x) for x in range(8)]
+        # pending buffers are flushed before the writer stops
+        ftdi.stop_write_pipeline()
+        self.assertTrue(all(f.done() for f in futures))
+        self.assertEqual(self.port.writes-writes, 8)
+        self.assertRaises(FtdiError, ftdi.write_data_async, b'x')
+
+    def test_pipeline_bypass(self):
+        ftdi = self.ftdi
+        ftdi.start_write_pipeline()
+        # a buffer smaller than a transfer is sent right away when idle
+        future = ftdi.write_data_async(b'ab')
+        self.assertTrue(future.done())
+        self.assertEqual(bytes(self.port.history), b'ab')
+        # but never overtakes the buffers in flight
+        futures = [ftdi.write_data_async(b'cdefgh'),
+                   ftdi.write_data_async(b'ij')]
+        self.assertEqual([f.result() for f in futures], [6, 2])
+        ftdi.stop_write_pipeline()
+        self.assertEqual(bytes(self.port.history), b'abcdefghij')
+
+    def test_pipeline_cancel(self):
+        ftdi = self.ftdi
+        self.assertEqual(ftdi.cancel_pending_writes(), 0)
+        ftdi.start_write_pipeline(depth=8)
+        futures = [ftdi.write_data_async(b'%04d' % x) for x in range(8)]
+        count = ftdi.cancel_pending_writes()
+        self.assertGreater(count, 0)
+        self.assertLessEqual(ftdi.write_pending, 8*4-count)
+        # the buffers not yet sent are cancelled, in order
+        cancelled = [f.cancelled() for f in futures]
+        self.assertEqual(sum(cancelled), count//4)
+        self.assertEqual(cancelled, sorted(cancelled))
+        ftdi.stop_write_pipeline()
+        self.assertEqual(ftdi.write_pending, 0)
+        self.assertEqual(len(self.port.history), 8*4-count)
+
+    def test_pipeline_error(self):
+        ftdi = self.ftdi
+        self.port.write_error = usb.core.USBError('Pipe error')
+        ftdi.start_write_pipeline()
+        future = ftdi.write_data_async(b'abcdef')
+        self.assertRaises(FtdiError, future.result)
+        self.assertEqual(ftdi.write_pending, 0)
+        ftdi.stop_write_pipeline()
+
+
+class FtdiStatisticsTestCase(VirtualFtdiTestCase):
+    """FTDI statistics test case, does not require any FTDI device"""
+
+    def test_disabled(self):
+        self.ftdi.write_data(b'abc')
+        self.assertIsNone(self.ftdi.statistics)
+        self.assertEqual(self.ftdi.get_statistics(), {})
+
+    def test_counters(self):
+        ftdi = self.ftdi
+        ftdi.enable_statistics()
+        ftdi.write_data(b'abcdef')
+        ftdi.write_data(b'gh')
+        # nothing to read: the two attempts only get the modem status
+        self.assertEqual(len(ftdi.read_data_bytes(4, attempt=2)), 0)
+        self.device.ports[0].inject(b'0123')
+        self.assertEqual(ftdi.read_data(4), b'0123')
+        ftdi.set_latency_timer(32)
+        self.assertEqual(ftdi.get_latency_timer(), 32)
+        stats = ftdi.get_statistics()
+        self.assertEqual(stats['bulk_out'], 2)
+        self.assertEqual(stats['bytes_out'], 8)
+        self.assertEqual(stats['bulk_in'], 3)
+        self.assertEqual(stats['bytes_in'], 2+2+6)
+        self.assertEqual(stats['empty_reads'], 2)
+        self.assertEqual(stats['read_retries'], 1)
+        self.assertEqual(stats['ctrl_out'], 1)
+        self.assertEqual(stats['ctrl_in'], 1)
+        self.assertEqual(stats['latency_changes'], 1)
+        self.assertEqual(stats['write_latency']['count'], 2)
+        self.assertEqual(stats['read_latency']['count'], 3)
+        ftdi.statistics.reset()
+        self.assertEqual(ftdi.get_statistics()['bulk_out'], 0)
+
+    def test_histogram(self):
+        hist = Histogram(precision=4)
+        for value in (0, 1, 17, 1000, 1000000):
+            hist.record(value)
+        self.assertEqual(hist.count, 5)
+        self.assertEqual(hist.min, 0)
+        self.assertEqual(hist.max, 1000000)
+        self.assertEqual(hist.percentile(50), 17)
+        for low, high, count in hist.buckets():
+            # bucket width never exceeds 1/16th of the recorded values
+            self.assertLessEqual(high-low, max(1, low >> 4))
+        # large values are approximated within the histogram precision
+        self.assertLess(abs(hist.percentile(80)-1000)/1000, 1/16)
+
+
+class FtdiTraceTestCase(VirtualFtdiTestCase):
+    """FTDI tracer test case, does not require any FTDI device"""
+
+    def test_ring(self):
+        ftdi = self.ftdi
+        tracer = UsbTracer(size=16)
+        ftdi.set_tracer(tracer)
+        self.assertIs(ftdi.tracer, tracer)
+        ftdi.write_data(b'0123456789')
+        self.device.ports[0].inject(b'abcd')
+        self.assertEqual(ftdi.read_data(4), b'abcd')
+        records = tracer.records()
+        self.assertEqual([(kind, ep, data) for _, kind, ep, data in records],
+                         [('>', 0x02, b'0123456789'),
+                          ('<', 0x81, b'\x32\x60abcd')])
+        # the oldest transfer is dropped once the ring is full
+        ftdi.write_data(b'ABCDEFGHIJ')
+        self.assertEqual([data for _, _, _, data in tracer.records()],
+                         [b'\x32\x60abcd', b'ABCDEFGHIJ'])
+        out = StringIO()
+        tracer.dump(out)
+        self.assertIn('> ep 0x02 10 bytes', out.getvalue())
+        ftdi.set_tracer(None)
+        ftdi.write_data(b'xyz')
+        self.assertEqual(len(tracer.records()), 2)
+
+
 def suite():
     suite_ = unittest.TestSuite()
+    suite_.addTest(unittest.makeSuite(FtdiReadTestCase, 'test'))
+    suite_.addTest(unittest.makeSuite(FtdiWriteTestCase, 'test'))
+    suite_.addTest(unittest.makeSuite(FtdiStatisticsTestCase, 'test'))
+    suite_.addTest(unittest.makeSuite(FtdiTraceTestCase, 'test'))
     suite_.addTest(unittest.makeSuite(FtdiTestCase, 'test'))
     return suite_
 
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017, Emmanuel Blot <emmanuel.blot@free.fr>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the Neotion nor the names of its contributors may
+#       be used to endorse or promote products derived from this software
+#       without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL NEOTION BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import unittest
+from ctypes import POINTER, c_int, c_void_p
+from doctest import testmod
+from logging import StreamHandler, DEBUG
+from pyftdi import FtdiLogger
+from pyftdi.ftdi import Ftdi
+from pyftdi.hotplug import HotplugMonitor, _LibUsbHotplug, _Timeval
+from pyftdi.tests.backend import usbvirt
+from pyftdi.usbtools import UsbTools
+from queue import Queue
+from sys import modules, stdout
+from unittest.mock import Mock
+
+
+class HotplugMonitorTestCase(unittest.TestCase):
+    """Hotplug monitor test case, on the virtual USB backend"""
+
+    def setUp(self):
+        self.backend = usbvirt.get_backend()
+        self.backend.clear()
+        UsbTools.set_backend(self.backend)
+        self.first = self.backend.add_device('ft2232h', 'FT000001')
+        self.monitor = HotplugMonitor(period=0.01)
+        self.events = Queue()
+        self.monitor.subscribe(lambda *event: self.events.put(event))
+
+    def tearDown(self):
+        self.monitor.stop()
+        self.backend.clear()
+        UsbTools.set_backend(None)
+
+    def test_events(self):
+        self.monitor.start()
+        # the virtual backend does not support hotplug events
+        self.assertFalse(self.monitor.is_event_driven)
+        self.assertEqual([dev.sn for dev in self.monitor.devices],
+                         ['FT000001'])
+        second = self.backend.add_device('ft232h', 'FT000002')
+        event, device = self.events.get(timeout=2)
+        self.assertEqual(event, HotplugMonitor.ARRIVED)
+        self.assertEqual((device.pid, device.sn), (0x6014, 'FT000002'))
+        self.backend.remove_device(second)
+        event, device = self.events.get(timeout=2)
+        self.assertEqual(event, HotplugMonitor.LEFT)
+        self.assertEqual(device.sn, 'FT000002')
+        self.assertTrue(self.events.empty())
+
+    def test_cache(self):
+        self.assertEqual(len(Ftdi.find_all([(0x403, 0x6010)])), 1)
+        self.monitor.start()
+        self.backend.remove_device(self.first)
+        # as a USB host, assign a new address to the new device
+        self.backend.add_device('ft2232h', 'FT000003').set_location(1, 2)
+        for _ in range(2):
+            self.events.get(timeout=2)
+        # the cache follows the devices, without being flushed
+        self.assertEqual(Ftdi.find_all([(0x403, 0x6010)]),
+                         [(0x403, 0x6010, 'FT000003', 2, 'Dual RS232-HS')])
+        ftdi = Ftdi.create_from_url('ftdi://ftdi:2232h:FT000003/2')
+        ftdi.close()
+
+    def test_scan(self):
+        self.monitor.scan(notify=False)
+        self.backend.add_device('ft4232h', 'FT000004')
+        self.monitor.scan()
+        self.assertEqual(self.events.get_nowait()[1].sn, 'FT000004')
+        self.monitor.unsubscribe(self.monitor._subscribers[0])
+        self.backend.clear()
+        self.monitor.scan()
+        self.assertTrue(self.events.empty())
+        self.assertEqual(self.monitor.devices, [])
+
+
+class LibUsbHotplugTestCase(unittest.TestCase):
+    """libusb hotplug callback test case, with a mocked libusb library"""
+
+    def test_prototypes(self):
+        lib = Mock()
+        lib.libusb_has_capability.return_value = 1
+        lib.libusb_hotplug_register_callback.return_value = 0
+        ctx = c_void_p(0x7fff00001000)
+        notify = Mock()
+        hotplug = _LibUsbHotplug.create(Mock(lib=lib, ctx=ctx), notify)
+        self.assertIsNotNone(hotplug)
+        # pointers and structures are not passed as C int arguments
+        handle_events = lib.libusb_handle_events_timeout_completed
+        self.assertEqual(handle_events.argtypes,
+                         [c_void_p, POINTER(_Timeval), POINTER(c_int)])
+        self.assertIs(handle_events.restype, c_int)
+        deregister = lib.libusb_hotplug_deregister_callback
+        self.assertEqual(deregister.argtypes, [c_void_p, c_int])
+        self.assertIsNone(deregister.restype)
+        register = lib.libusb_hotplug_register_callback
+        self.assertEqual(register.argtypes[0], c_void_p)
+        self.assertIs(register.restype, c_int)
+        hotplug.wait(1.25)
+        args = handle_events.call_args[0]
+        self.assertIs(args[0], ctx)
+        self.assertEqual((args[1]._obj.tv_sec, args[1]._obj.tv_usec),
+                         (1, 250000))
+        # the registered callback wakes up the monitor
+        callback = register.call_args[0][6]
+        self.assertEqual(callback(None, None, 1, None), 0)
+        notify.assert_called_once_with()
+        hotplug.close()
+        deregister.assert_called_once_with(ctx, hotplug._handle)
+
+    def test_no_hotplug(self):
+        lib = Mock()
+        lib.libusb_has_capability.return_value = 0
+        self.assertIsNone(_LibUsbHotplug.create(Mock(lib=lib, ctx=1), Mock()))
+        lib.libusb_hotplug_register_callback.assert_not_called()
+
+
+def suite():
+    suite_ = unittest.TestSuite()
+    suite_.addTest(unittest.makeSuite(HotplugMonitorTestCase, 'test'))
+    suite_.addTest(unittest.makeSuite(LibUsbHotplugTestCase, 'test'))
+    return suite_
+
+
+if __name__ == '__main__':
+    testmod(modules[__name__])
+    FtdiLogger.log.addHandler(StreamHandler(stdout))
+    FtdiLogger.set_level(DEBUG)
+    unittest.main(defaultTest='suite')
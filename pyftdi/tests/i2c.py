@@ -30,11 +30,88 @@ import unittest
 from doctest import testmod
 from logging import StreamHandler, DEBUG
 from pyftdi import FtdiLogger
-from pyftdi.i2c import I2cController, I2cIOError
+from pyftdi.i2c import I2cController, I2cNackError
+from pyftdi.tests.backend import usbvirt
+from pyftdi.tests.backend.mpsse import VirtualI2cBus
+from pyftdi.usbtools import UsbTools
 from sys import modules, stdout
 from time import sleep
 
 
+class VirtualI2cEeprom(object):
+    """I2C slave model: an EEPROM with a one-byte register pointer, which
+       NACKs written bytes beyond its write buffer"""
+
+    def __init__(self, address=0x50, size=256, write_buffer=16):
+        self.address = address
+        self.memory = bytearray(size)
+        self._write_buffer = write_buffer
+        self._pointer = 0
+        self._count = None
+
+    def start(self):
+        self._count = None
+
+    def write(self, byte):
+        """Receive a byte from the master, return True to ACK it"""
+        if self._count is None:
+            self._pointer = byte
+            self._count = 0
+            return True
+        if self._count >= self._write_buffer:
+            return False
+        self.memory[self._pointer] = byte
+        self._pointer = (self._pointer+1) % len(self.memory)
+        self._count += 1
+        return True
+
+    def read(self):
+        byte = self.memory[self._pointer]
+        self._pointer = (self._pointer+1) % len(self.memory)
+        return byte
+
+
+def make_virtual_controller(backend, slaves, model='ft232h', **kwargs):
+    """Plug a virtual FTDI device into the backend, connect I2C slave models
+       to its first port, and configure an I2C controller on this port.
+
+       :param backend: the virtual USB backend
+       :param slaves: a sequence of slave models
+       :param model: the virtual FTDI device model
+       :param kwargs: the options of the I2C controller
+       :return: the I2C controller and the virtual FTDI port
+    """
+    device = backend.add_device(model)
+    port = device.ports[0]
+    port.connect(VirtualI2cBus(slaves))
+    UsbTools.flush_cache()
+    ctrl = I2cController()
+    ctrl.configure('ftdi://ftdi:%s:%s/1' % (model[2:], device.strings[3]),
+                   **kwargs)
+    return ctrl, port
+
+
+class VirtualI2cTestCase(unittest.TestCase):
+    """Base test case for I2C controllers on the virtual USB backend"""
+
+    def setUp(self):
+        self.backend = usbvirt.get_backend()
+        self.backend.clear()
+        UsbTools.set_backend(self.backend)
+        self._controllers = []
+
+    def tearDown(self):
+        for ctrl in self._controllers:
+            ctrl.terminate()
+        self.backend.clear()
+        UsbTools.set_backend(None)
+
+    def make_controller(self, slaves, **kwargs):
+        ctrl, port = make_virtual_controller(self.backend, slaves, **kwargs)
+        self._controllers.append(ctrl)
+        return ctrl, port
+
+
 class I2cTest(object):
     """Simple test for a TCA9555 device on I2C bus @ address 0x21
     """
@@ -81,8 +158,70 @@ class I2cTestCase(unittest.TestCase):
         i2c.close()
 
 
+class I2cBatchTestCase(VirtualI2cTestCase):
+    """I2C batch mode test case, on the virtual USB backend"""
+
+    def test_write(self):
+        for batch in (False, True):
+            eeprom = VirtualI2cEeprom(write_buffer=256)
+            ctrl, vport = self.make_controller([eeprom], batch=batch)
+            port = ctrl.get_port(0x50)
+            writes = vport.writes
+            port.write_to(0x00, bytes(range(200)))
+            writes = vport.writes-writes
+            self.assertEqual(eeprom.memory[:200], bytes(range(200)))
+            self.assertEqual(port.read_from(0x10, 4), bytes(range(16, 20)))
+            if batch:
+                # one round-trip per FIFO-sized chunk, not one per byte
+                self.assertLess(writes, 10)
+            else:
+                self.assertGreater(writes, 200)
+
+    def test_nack(self):
+        eeprom = VirtualI2cEeprom(write_buffer=16)
+        ctrl, _ = self.make_controller([eeprom], batch=True)
+        ctrl.RETRY_COUNT = 1
+        port = ctrl.get_port(0x50)
+        with self.assertRaises(I2cNackError) as context:
+            port.write_to(0x00, bytes(32))
+        # register address is byte #0, the 17th data byte is NACKed
+        self.assertIn('byte 17', str(context.exception))
+        self.assertRaises(I2cNackError, ctrl.get_port(0x51).write, b'\x00')
+
+    def test_exchange(self):
+        eeprom = VirtualI2cEeprom()
+        eeprom.memory[:] = bytes(range(256))
+        ctrl, vport = self.make_controller([eeprom], batch=True)
+        port = ctrl.get_port(0x50)
+        self.assertEqual(port.exchange([0x20], 4), bytes(range(32, 36)))
+        data = port.exchange([0x00], 256)
+        self.assertEqual(data, bytes(range(256)))
+        writes, reads = vport.writes, vport.reads
+        trans = ctrl.transaction().write(0x50, [0x20]).read(0x50, 4)
+        self.assertEqual(trans.execute(), [bytes(range(32, 36))])
+        # a register read is a single USB round-trip
+        self.assertEqual(vport.writes-writes, 1)
+        self.assertEqual(vport.reads-reads, 1)
+
+    def test_transaction(self):
+        eeprom = VirtualI2cEeprom()
+        eeprom.memory[:] = bytes(range(256))
+        ctrl, vport = self.make_controller([eeprom])
+        writes = vport.writes
+        trans = ctrl.transaction()
+        trans.write(0x50, [0x10]).read(0x50, 2)
+        trans.write(0x50, [0x80, 0xaa, 0x55]).write(0x50, [0x80]).read(0x50, 3)
+        self.assertEqual(trans.execute(), [b'\x10\x11', b'\xaa\x55\x82'])
+        self.assertEqual(vport.writes-writes, 1)
+        trans = ctrl.transaction().write(0x50, [0x10]).read(0x51, 2)
+        with self.assertRaises(I2cNackError) as context:
+            trans.execute()
+        self.assertIn('address 0x51', str(context.exception))
+
+
 def suite():
     suite_ = unittest.TestSuite()
+    suite_.addTest(unittest.makeSuite(I2cBatchTestCase, 'test'))
     suite_.addTest(unittest.makeSuite(I2cTestCase, 'test'))
     return suite_
 
@@ -42,7 +42,7 @@ class JtagTestCase(unittest.TestCase):
 
     def setUp(self):
         self.jtag = JtagEngine(trst=True, frequency=3E6)
-        self.jtag.configure(vendor=0x403, product=0x6011, interface=1)
+        self.jtag.configure('ftdi://ftdi:4232h/1')
         self.jtag.reset()
         self.tool = JtagTool(self.jtag)
 
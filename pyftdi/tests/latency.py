@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017, Emmanuel Blot <emmanuel.blot@free.fr>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the Neotion nor the names of its contributors may
+#       be used to endorse or promote products derived from this software
+#       without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL NEOTION BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import unittest
+from doctest import testmod
+from logging import StreamHandler, DEBUG
+from pyftdi import FtdiLogger
+from pyftdi.latency import (BulkPolicy, InteractivePolicy, LatencyController,
+                            RequestResponsePolicy, ThresholdPolicy)
+from pyftdi.tests.ftdi import VirtualFtdiTestCase
+from sys import modules, stdout
+
+
+class FakeFtdi(object):
+
+    def __init__(self):
+        self.latency = 16
+        self.max_packet_size = 64
+        self.changes = []
+
+    def set_latency_timer(self, latency):
+        self.latency = latency
+        self.changes.append(latency)
+
+
+class LatencyPolicyTestCase(unittest.TestCase):
+    """Latency policy test case, does not require any FTDI device"""
+
+    def test_range(self):
+        self.assertRaises(ValueError, InteractivePolicy, 0, 16)
+        self.assertRaises(ValueError, InteractivePolicy, 1, 256)
+        self.assertRaises(ValueError, InteractivePolicy, 20, 10)
+
+    def test_average(self):
+        policy = BulkPolicy()
+        for pos in range(20):
+            policy.on_read(pos*0.001, 100)
+        self.assertAlmostEqual(policy.gap, 0.001)
+        self.assertAlmostEqual(policy.rate, 100000.0)
+
+    def test_threshold(self):
+        policy = ThresholdPolicy(2, 200, 3)
+        self.assertEqual(policy.on_read(0.0, 10), 2)
+        for _ in range(3):
+            self.assertIsNone(policy.on_read(0.0, 0))
+        self.assertEqual(policy.on_read(0.0, 0), 200)
+        self.assertEqual(policy.on_read(0.0, 1), 2)
+
+    def test_interactive(self):
+        policy = InteractivePolicy(1, 32, idle=0.5)
+        self.assertEqual(policy.on_read(0.0, 0), 32)
+        self.assertEqual(policy.on_read(0.1, 1), 1)
+        self.assertIsNone(policy.on_read(0.4, 0))
+        self.assertEqual(policy.on_read(0.7, 0), 32)
+
+    def test_bulk(self):
+        policy = BulkPolicy(2, 64, margin=1.0)
+        policy.reset(512)
+        # 510 bytes every 10 ms: the timer should match the fill time
+        for pos in range(10):
+            latency = policy.on_read(pos*0.01, 510)
+        self.assertAlmostEqual(latency, 10, delta=1)
+        # a fast stream fills the packets before the shortest timeout
+        for pos in range(50):
+            latency = policy.on_read(1.0+pos*0.0001, 510)
+        self.assertEqual(latency, 2)
+        self.assertEqual(policy.on_read(2.0, 0), 64)
+
+    def test_request_response(self):
+        policy = RequestResponsePolicy(1, 16, idle=0.2)
+        self.assertEqual(policy.on_read(0.0, 0), 16)
+        self.assertEqual(policy.on_write(1.0, 4), 1)
+        self.assertIsNone(policy.on_read(1.1, 2))
+        self.assertEqual(policy.on_read(1.3, 0), 16)
+
+    def test_holdoff(self):
+        now = [0.0]
+        ftdi = FakeFtdi()
+        policy = RequestResponsePolicy(1, 16, idle=0.2)
+        controller = LatencyController(ftdi, policy, holdoff=0.1,
+                                       clock=lambda: now[0])
+        self.assertEqual(policy.packet_size, 64)
+        controller.on_write(1)
+        self.assertEqual(ftdi.changes, [1])
+        now[0] = 0.3
+        controller.on_read(0)
+        self.assertEqual(ftdi.changes, [1, 16])
+        # too early: the change is deferred
+        now[0] = 0.35
+        controller.on_write(1)
+        self.assertEqual(ftdi.latency, 16)
+        now[0] = 0.45
+        controller.on_read(2)
+        self.assertEqual(ftdi.changes, [1, 16, 1])
+        # no control transfer when the latency does not change
+        now[0] = 0.6
+        controller.on_write(1)
+        self.assertEqual(controller.changes, 3)
+
+
+class FtdiLatencyTestCase(VirtualFtdiTestCase):
+    """Latency policies on a virtual FTDI device"""
+
+    def test_dynamic_latency(self):
+        port = self.device.ports[0]
+        self.ftdi.set_dynamic_latency(2, 20, 3)
+        self.assertEqual(port.latency, 20)
+        port.inject(b'abc')
+        self.assertEqual(self.ftdi.read_data_bytes(3).tobytes(), b'abc')
+        self.assertEqual(port.latency, 2)
+        self.assertEqual(self.ftdi.latency_count, 0)
+        for _ in range(4):
+            self.assertEqual(len(self.ftdi.read_data_bytes(3)), 0)
+        self.assertEqual(port.latency, 20)
+        self.assertEqual(self.ftdi.latency_count, 4)
+        self.ftdi.set_dynamic_latency(0, 0, 0)
+        self.assertIsNone(self.ftdi.latency_policy)
+        self.assertEqual(self.ftdi.latency_count, 0)
+
+    def test_policy(self):
+        port = self.device.ports[0]
+        self.ftdi.set_latency_timer(16)
+        policy = RequestResponsePolicy(1, 16)
+        self.ftdi.set_latency_policy(policy)
+        self.assertIs(self.ftdi.latency_policy, policy)
+        self.ftdi.write_data(b'\x00')
+        self.assertEqual(port.latency, 1)
+        self.assertEqual(self.ftdi.latency, 1)
+
+
+def suite():
+    suite_ = unittest.TestSuite()
+    suite_.addTest(unittest.makeSuite(LatencyPolicyTestCase, 'test'))
+    suite_.addTest(unittest.makeSuite(FtdiLatencyTestCase, 'test'))
+    return suite_
+
+
+if __name__ == '__main__':
+    testmod(modules[__name__])
+    FtdiLogger.log.addHandler(StreamHandler(stdout))
+    FtdiLogger.set_level(DEBUG)
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017, Emmanuel Blot <emmanuel.blot@free.fr>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the Neotion nor the names of its contributors may
+#       be used to endorse or promote products derived from this software
+#       without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL NEOTION BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import unittest
+from doctest import testmod
+from logging import StreamHandler, DEBUG
+from pyftdi import FtdiLogger
+from pyftdi.orchestrator import Orchestrator
+from pyftdi.tests.backend import usbvirt
+from pyftdi.tests.backend.mpsse import VirtualSpiBus
+from pyftdi.tests.spi import VirtualSpiEeprom
+from pyftdi.usbtools import UsbTools
+from sys import modules, stdout
+from threading import Lock
+from time import sleep
+
+
+def program(spi, serial, tracker=None):
+    """Write then read back the serial number of the device"""
+    if tracker:
+        tracker.enter()
+    try:
+        port = spi.get_port(0, freq=1E6)
+        data = serial.encode()
+        port.exchange(b'\x06')
+        port.exchange(b'\x02\x00' + data)
+        if tracker:
+            sleep(0.05)
+        return port.exchange(b'\x03\x00', len(data)).tobytes()
+    finally:
+        if tracker:
+            tracker.leave()
+
+
+def program_device(spi, tracker=None):
+    usb_dev = spi._ftdi.usb_dev
+    serial = UsbTools.get_string(usb_dev, usb_dev.iSerialNumber)
+    return program(spi, serial, tracker)
+
+
+class ConcurrencyTracker(object):
+    """Record the maximum count of concurrent jobs"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.count = 0
+        self.peak = 0
+
+    def enter(self):
+        with self._lock:
+            self.count += 1
+            self.peak = max(self.peak, self.count)
+
+    def leave(self):
+        with self._lock:
+            self.count -= 1
+
+
+class OrchestratorTestCase(unittest.TestCase):
+    """Parallel programming test case, on the virtual USB backend"""
+
+    SERIALS = ('FTA', 'FTB', 'FTC', 'FTD')
+
+    def setUp(self):
+        self.backend = usbvirt.get_backend()
+        self.backend.clear()
+        UsbTools.set_backend(self.backend)
+        self.eeproms = {}
+        for pos, serial in enumerate(self.SERIALS):
+            device = self.backend.add_device('ft2232h', serial)
+            # two devices per bus
+            device.set_location(1 + pos // 2, 2 + pos)
+            eeprom = VirtualSpiEeprom()
+            device.ports[0].connect(VirtualSpiBus({0: eeprom}))
+            self.eeproms[serial] = eeprom
+
+    def tearDown(self):
+        self.backend.clear()
+        UsbTools.set_backend(None)
+
+    def test_run(self):
+        orchestrator = Orchestrator(self.SERIALS, interface='spi')
+        self.assertEqual(orchestrator.locate(),
+                         {'FTA': 1, 'FTB': 1, 'FTC': 2, 'FTD': 2})
+        self.assertEqual(orchestrator.plan(), 4)
+        results = orchestrator.run(program_device)
+        self.assertEqual([r.serial for r in results], list(self.SERIALS))
+        for result in results:
+            self.assertTrue(result.ok, result.traceback)
+            self.assertEqual(result.result, result.serial.encode())
+            self.assertEqual(result.url,
+                             'ftdi://ftdi:2232h:%s/1' % result.serial)
+            self.assertGreaterEqual(result.open_time, 0)
+            self.assertGreaterEqual(result.run_time, 0)
+            eeprom = self.eeproms[result.serial]
+            self.assertEqual(eeprom.memory[:3], result.serial.encode())
+
+    def test_bus_bandwidth(self):
+        tracker = ConcurrencyTracker()
+        # a single job fits into the bandwidth of each bus
+        orchestrator = Orchestrator(self.SERIALS, interface='spi',
+                                    device_bandwidth=30E6,
+                                    bus_bandwidth=40E6)
+        self.assertEqual(orchestrator.bus_limit, 1)
+        self.assertEqual(orchestrator.plan(), 2)
+        results = orchestrator.run(program_device, tracker)
+        self.assertTrue(all(result.ok for result in results))
+        self.assertEqual(tracker.peak, 2)
+
+    def test_missing_device(self):
+        serials = list(self.SERIALS) + ['FTZ']
+        orchestrator = Orchestrator(serials, interface='spi')
+        self.assertIsNone(orchestrator.locate()['FTZ'])
+        results = orchestrator.run(program_device)
+        self.assertTrue(all(result.ok for result in results[:-1]))
+        self.assertFalse(results[-1].ok)
+        self.assertIsNone(results[-1].open_time)
+        self.assertIsNotNone(results[-1].traceback)
+
+    def test_job_error(self):
+        def fail(spi):
+            raise ValueError('Job failure')
+        results = Orchestrator(self.SERIALS[:1], interface='spi').run(fail)
+        self.assertIsInstance(results[0].error, ValueError)
+        self.assertIsNotNone(results[0].run_time)
+
+    def test_interface(self):
+        self.assertRaises(ValueError, Orchestrator, self.SERIALS,
+                          interface='uart')
+
+
+def suite():
+    suite_ = unittest.TestSuite()
+    suite_.addTest(unittest.makeSuite(OrchestratorTestCase, 'test'))
+    return suite_
+
+
+if __name__ == '__main__':
+    testmod(modules[__name__])
+    FtdiLogger.log.addHandler(StreamHandler(stdout))
+    FtdiLogger.set_level(DEBUG)
+    unittest.main(defaultTest='suite')
@@ -29,10 +29,126 @@
 import unittest
 from binascii import hexlify
 from doctest import testmod
+from io import BytesIO
 from logging import StreamHandler, DEBUG
 from pyftdi import FtdiLogger
-from pyftdi.spi import SpiController
+from pyftdi.ftdi import Ftdi
+from pyftdi.spi import SpiController, SpiIOError
+from pyftdi.tests.backend import usbvirt
+from pyftdi.tests.backend.mpsse import VirtualSpiBus
+from pyftdi.usbtools import UsbTools
 from sys import modules, stdout
+from threading import Thread
+from time import sleep
+
+
+class VirtualSpiEeprom(object):
+    """SPI slave model: a tiny EEPROM with read (0x03) and write (0x02)
+       commands, followed with a one-byte address"""
+
+    def __init__(self, size=256):
+        self.memory = bytearray(size)
+        self.select()
+
+    def select(self):
+        self._command = None
+        self._address = None
+
+    def write(self, data):
+        for byte in data:
+            if self._command is None:
+                self._command = byte
+            elif self._address is None:
+                self._address = byte
+            elif self._command == 0x02:
+                self.memory[self._address] = byte
+                self._address = (self._address+1) % len(self.memory)
+
+    def read(self, length):
+        if self._command != 0x03 or self._address is None:
+            return bytes([0xff]*length)
+        data = bytearray()
+        for _ in range(length):
+            data.append(self.memory[self._address])
+            self._address = (self._address+1) % len(self.memory)
+        return bytes(data)
+
+
+class VirtualSpiLoopback(object):
+    """SPI slave model: MISO is MOSI, inverted"""
+
+    def select(self):
+        pass
+
+    def write(self, data):
+        pass
+
+    def read(self, length):
+        return bytes([0xff]*length)
+
+    def exchange(self, data):
+        return bytes([~byte & 0xff for byte in data])
+
+
+class VirtualSpiRecorder(object):
+    """SPI slave model: records the data received in each transaction, and
+       replies with a counter sequence"""
+
+    def __init__(self):
+        self.transactions = []
+        self._counter = 0
+
+    def select(self):
+        self.transactions.append(bytearray())
+        self._counter = 0
+
+    def write(self, data):
+        self.transactions[-1].extend(data)
+
+    def read(self, length):
+        data = bytes([(self._counter+x) & 0xff for x in range(length)])
+        self._counter += length
+        return data
+
+
+def make_virtual_controller(backend, slaves, model='ft2232h', **kwargs):
+    """Plug a virtual FTDI device into the backend, connect SPI slave models
+       to its first port, and configure a SPI controller on this port.
+
+       :param backend: the virtual USB backend
+       :param slaves: a dictionary of slave models, indexed by /CS line
+       :param model: the virtual FTDI device model
+       :return: the SPI controller and the virtual FTDI port
+    """
+    device = backend.add_device(model)
+    port = device.ports[0]
+    port.connect(VirtualSpiBus(slaves))
+    UsbTools.flush_cache()
+    ctrl = SpiController(cs_count=max(slaves)+1, **kwargs)
+    ctrl.configure('ftdi://ftdi:%s:%s/1' % (model[2:], device.strings[3]))
+    return ctrl, port
+
+
+class VirtualSpiTestCase(unittest.TestCase):
+    """Base test case for SPI controllers on the virtual USB backend"""
+
+    def setUp(self):
+        self.backend = usbvirt.get_backend()
+        self.backend.clear()
+        UsbTools.set_backend(self.backend)
+        self._controllers = []
+
+    def tearDown(self):
+        for ctrl in self._controllers:
+            ctrl.terminate()
+        self.backend.clear()
+        UsbTools.set_backend(None)
+
+    def make_controller(self, slaves, model='ft2232h', **kwargs):
+        ctrl, port = make_virtual_controller(self.backend, slaves, model,
+                                             **kwargs)
+        self._controllers.append(ctrl)
+        return ctrl, port
 
 
 class SpiTest(object):
@@ -88,8 +204,332 @@ class SpiTestCase(unittest.TestCase):
         spi.close()
 
 
+class SpiBatchTestCase(VirtualSpiTestCase):
+    """SPI batch test case, on the virtual USB backend"""
+
+    def test_batch(self):
+        eeproms = {0: VirtualSpiEeprom(), 1: VirtualSpiEeprom()}
+        ctrl, vport = self.make_controller(eeproms)
+        port0 = ctrl.get_port(0)
+        port1 = ctrl.get_port(1, freq=1E6)
+        # apply the clock settings of the first port
+        port0.exchange([0x03, 0x00], 1)
+        writes = vport.writes
+        divisors = vport.engine.opcodes[Ftdi.TCK_DIVISOR]
+        with ctrl.batch() as batch:
+            port0.exchange([0x02, 0x10, 0xaa, 0xbb])
+            port1.exchange([0x02, 0x20, 0xcc])
+            first = port0.exchange([0x03, 0x10], 2)
+            second = port1.exchange([0x03, 0x20], 1)
+            self.assertFalse(first.done())
+        self.assertEqual(vport.writes-writes, 1)
+        self.assertEqual(first.result().tobytes(), b'\xaa\xbb')
+        self.assertEqual(second.result().tobytes(), b'\xcc')
+        self.assertEqual([bytes(r) for r in batch.results],
+                         [b'', b'', b'\xaa\xbb', b'\xcc'])
+        # port frequencies are interleaved into the command stream
+        self.assertEqual(vport.engine.opcodes[Ftdi.TCK_DIVISOR]-divisors, 3)
+        self.assertEqual(ctrl._frequency, port1.frequency)
+
+    def test_batch_segments(self):
+        eeprom = VirtualSpiEeprom()
+        eeprom.memory[:] = bytes(range(256))
+        # 1KiB RX FIFO
+        ctrl, vport = self.make_controller({0: eeprom}, 'ft232h')
+        port = ctrl.get_port(0)
+        writes = vport.writes
+        with ctrl.batch() as batch:
+            for _ in range(8):
+                port.exchange([0x03, 0x00], 256)
+        # replies do not fit into the RX FIFO at once
+        self.assertEqual(vport.writes-writes, 2)
+        self.assertLessEqual(vport.max_fifo, 1024)
+        self.assertEqual([bytes(r) for r in batch.results],
+                         [bytes(range(256))]*8)
+
+    def test_batch_overflow(self):
+        # 1KiB RX FIFO
+        ctrl, vport = self.make_controller({0: VirtualSpiEeprom()}, 'ft232h')
+        port = ctrl.get_port(0)
+        writes = vport.writes
+        with self.assertRaises(SpiIOError):
+            with ctrl.batch():
+                future = port.exchange([0x03, 0x00], 4)
+                port.exchange([0x03, 0x00], 1025)
+        self.assertRaises(SpiIOError, future.result)
+        self.assertEqual(vport.writes, writes)
+        with ctrl.batch():
+            future = port.exchange([0x03, 0x00], 1024)
+        self.assertEqual(len(future.result()), 1024)
+
+    def test_batch_abort(self):
+        ctrl, vport = self.make_controller({0: VirtualSpiEeprom()})
+        port = ctrl.get_port(0, freq=2E6)
+        frequency = ctrl._frequency
+        writes = vport.writes
+        try:
+            with ctrl.batch():
+                future = port.exchange([0x03, 0x00], 1)
+                self.assertRaises(SpiIOError, ctrl.batch)
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertRaises(SpiIOError, future.result)
+        self.assertEqual(vport.writes, writes)
+        self.assertEqual(ctrl._frequency, frequency)
+        # the controller is back to immediate mode
+        self.assertEqual(port.exchange([0x03, 0x00], 1).tobytes(), b'\x00')
+
+
+class SpiTemplateTestCase(VirtualSpiTestCase):
+    """SPI command template test case, on the virtual USB backend"""
+
+    def test_templates(self):
+        for mode in (0, 1, 3):
+            ctrl, vport = self.make_controller({0: VirtualSpiEeprom()})
+            port = ctrl.get_port(0, freq=1E6, mode=mode)
+            # apply the port clock settings
+            port.exchange([0x03, 0x00], 1)
+            vport.history = bytearray()
+            shapes = [([0x02, 0x10, 0xaa], 0, True, True),
+                      ([0x03, 0x10], 1, True, True),
+                      ([0x03, 0x10], 0, True, False),
+                      ([], 1, False, False),
+                      ([], 1, False, True)]
+            for out, readlen, start, stop in shapes:
+                del vport.history[:]
+                port.exchange(out, readlen, start, stop)
+                stream = bytes(vport.history)
+                # the legacy, uncached, command builder
+                del vport.history[:]
+                ctrl._exchange(port.frequency, out, readlen,
+                               start and port._cs_cmd,
+                               stop and port._cs_release,
+                               port._cpol, port._cpha)
+                self.assertEqual(stream, bytes(vport.history))
+            self.assertEqual(bytes(port.exchange([0x03, 0x10], 1)), b'\xaa')
+            self.assertEqual(len(port._templates), len(shapes))
+
+    def test_template_oversize(self):
+        ctrl, _ = self.make_controller({0: VirtualSpiEeprom()})
+        port = ctrl.get_port(0)
+        size = ctrl.PAYLOAD_MAX_LENGTH+1
+        with self.assertRaisesRegex(SpiIOError, 'Output payload is too large'):
+            port.exchange(bytes(size))
+        with self.assertRaisesRegex(SpiIOError, 'Input payload is too large'):
+            port.exchange([0x03, 0x00], size)
+        with self.assertRaisesRegex(SpiIOError, 'Input payload is too large'):
+            port.read(size)
+        with self.assertRaisesRegex(SpiIOError, 'Output payload is too large'):
+            port.write(bytes(size))
+        self.assertFalse(port._templates)
+
+    def test_template_eviction(self):
+        ctrl, _ = self.make_controller({0: VirtualSpiEeprom()})
+        port = ctrl.get_port(0)
+        port.TEMPLATE_CACHE_SIZE = 4
+        for readlen in range(1, 6):
+            port.exchange([0x03, 0x00], readlen)
+            # keep the first shape in use
+            port.exchange([0x03, 0x00], 1)
+        self.assertEqual(len(port._templates), 4)
+        self.assertIn((2, 1, True, True), port._templates)
+        self.assertNotIn((2, 2, True, True), port._templates)
+
+
+class SpiDuplexTestCase(VirtualSpiTestCase):
+    """SPI full duplex test case, on the virtual USB backend"""
+
+    def test_duplex(self):
+        for mode in (0, 1):
+            ctrl, vport = self.make_controller({0: VirtualSpiLoopback()})
+            port = ctrl.get_port(0, mode=mode)
+            out = bytes(range(16))
+            data = port.exchange_duplex(out)
+            self.assertEqual(data.tobytes(), bytes([~b & 0xff for b in out]))
+            opcode = mode and Ftdi.RW_BYTES_PVE_PVE_MSB or \
+                Ftdi.RW_BYTES_NVE_NVE_MSB
+            self.assertEqual(vport.engine.opcodes[opcode], 1)
+
+    def test_duplex_stream(self):
+        # 1KiB TX and RX FIFOs
+        ctrl, vport = self.make_controller({0: VirtualSpiLoopback()},
+                                           'ft232h')
+        port = ctrl.get_port(0)
+        out = bytes([x & 0xff for x in range(5000)])
+        data = port.exchange_duplex(out)
+        self.assertEqual(data.tobytes(), bytes([~b & 0xff for b in out]))
+        # payload is streamed through the FIFOs
+        self.assertEqual(vport.engine.opcodes[Ftdi.RW_BYTES_NVE_NVE_MSB], 10)
+        self.assertLessEqual(vport.max_fifo, 1024)
+        self.assertLessEqual(vport.max_write, 1024)
+
+    def test_duplex_batch(self):
+        eeprom = VirtualSpiEeprom()
+        ctrl, vport = self.make_controller({0: VirtualSpiLoopback(),
+                                            1: eeprom})
+        port0 = ctrl.get_port(0)
+        port1 = ctrl.get_port(1)
+        writes = vport.writes
+        with ctrl.batch():
+            port1.exchange([0x02, 0x00, 0x5a])
+            first = port0.exchange_duplex(b'\x01\x02')
+            second = port1.exchange([0x03, 0x00], 1)
+        self.assertEqual(vport.writes-writes, 1)
+        self.assertEqual(first.result().tobytes(), b'\xfe\xfd')
+        self.assertEqual(second.result().tobytes(), b'\x5a')
+
+
+class SpiStreamTestCase(VirtualSpiTestCase):
+    """SPI stream test case, on the virtual USB backend"""
+
+    def test_read_stream(self):
+        slave = VirtualSpiRecorder()
+        # 1KiB RX FIFO
+        ctrl, vport = self.make_controller({0: slave}, 'ft232h')
+        port = ctrl.get_port(0)
+        sink = BytesIO()
+        count = port.read_into(sink, 100000, b'\x0b\x00\x00\x00\x00')
+        self.assertEqual(count, 100000)
+        self.assertEqual(sink.getvalue(),
+                         bytes([x & 0xff for x in range(100000)]))
+        # a single transaction, whose replies never overflow the RX FIFO
+        self.assertEqual(slave.transactions, [b'\x0b\x00\x00\x00\x00'])
+        self.assertLessEqual(vport.max_fifo, 1024)
+        self.assertIsNone(vport.bus.selected)
+
+    def test_read_stream_close(self):
+        slave = VirtualSpiRecorder()
+        ctrl, vport = self.make_controller({0: slave}, 'ft232h')
+        port = ctrl.get_port(0)
+        stream = port.read_stream(10000, b'\x03')
+        self.assertEqual(len(next(stream)), 512)
+        stream.close()
+        # /CS is released, and no reply is left behind
+        self.assertIsNone(vport.bus.selected)
+        self.assertEqual(port.exchange([0x03], 4).tobytes(),
+                         b'\x00\x01\x02\x03')
+
+    def test_read_stream_errors(self):
+        slave = VirtualSpiRecorder()
+        ctrl, vport = self.make_controller({0: slave}, 'ft232h')
+        port = ctrl.get_port(0)
+        # errors are reported on the call, not on the first iteration
+        oversize = bytes(SpiController.PAYLOAD_MAX_LENGTH+1)
+        self.assertRaises(SpiIOError, port.read_stream, 100, oversize)
+        with ctrl.batch():
+            self.assertRaises(SpiIOError, port.read_stream, 100, b'\x03')
+        self.assertEqual(slave.transactions, [])
+
+    def test_write_stream(self):
+        slave = VirtualSpiRecorder()
+        ctrl, vport = self.make_controller({0: slave})
+        port = ctrl.get_port(0)
+        payload = bytes([x & 0xff for x in range(200000)])
+        count = port.write_stream(BytesIO(payload), b'\x02\x00')
+        self.assertEqual(count, len(payload))
+        generator = (payload[x:x+1000] for x in range(0, len(payload), 1000))
+        count = port.write_stream(generator, b'\x02\x00')
+        self.assertEqual(count, len(payload))
+        self.assertEqual([bytes(t) for t in slave.transactions],
+                         [b'\x02\x00' + payload]*2)
+        self.assertIsNone(vport.bus.selected)
+        self.assertFalse(ctrl._ftdi.is_write_pipelined)
+        # a pipeline started by the caller is left running
+        ctrl._ftdi.start_write_pipeline()
+        try:
+            port.write_stream(BytesIO(payload[:1000]), b'\x02\x00')
+            self.assertTrue(ctrl._ftdi.is_write_pipelined)
+        finally:
+            ctrl._ftdi.stop_write_pipeline()
+        self.assertEqual(bytes(slave.transactions[-1]),
+                         b'\x02\x00' + payload[:1000])
+
+
+class SpiThreadSafeTestCase(VirtualSpiTestCase):
+    """Thread-safe SPI controller test case, on the virtual USB backend"""
+
+    def setUp(self):
+        super(SpiThreadSafeTestCase, self).setUp()
+        self.eeproms = []
+        for cs in range(4):
+            eeprom = VirtualSpiEeprom()
+            eeprom.memory[:] = bytes((cs*0x40+x) & 0xff for x in range(256))
+            self.eeproms.append(eeprom)
+        self.ctrl, _ = self.make_controller(dict(enumerate(self.eeproms)),
+                                            'ft4232h', thread_safe=True)
+        self.errors = []
+
+    def test_threads(self):
+        threads = [Thread(target=self._read, args=(cs, 50))
+                   for cs in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.errors, [])
+        stats = self.ctrl.get_queue_statistics()
+        self.assertEqual(stats['queued'], 0)
+        self.assertEqual(stats['depth']['count'], 200)
+        batches = stats['batch']
+        self.assertEqual(round(batches['mean']*batches['count']), 200)
+
+    def test_transaction(self):
+        port = self.ctrl.get_port(0)
+        other = Thread(target=self._read, args=(1, 20))
+        port.exchange([0x03, 0x10], stop=False)
+        other.start()
+        # the other thread may not interleave with the open transaction
+        sleep(0.05)
+        data = port.exchange(readlen=4, start=False)
+        other.join()
+        self.assertEqual(data.tobytes(), bytes(range(0x10, 0x14)))
+        self.assertEqual(self.errors, [])
+
+    def test_merge(self):
+        port, _, _, _ = [self.ctrl.get_port(cs) for cs in range(4)]
+        # hold the bus, so that the exchanges of the other threads pile up
+        port.exchange([0x03, 0x00], stop=False)
+        threads = [Thread(target=self._read, args=(cs, 1))
+                   for cs in range(1, 4)]
+        for thread in threads:
+            thread.start()
+        for _ in range(100):
+            if self.ctrl.get_queue_statistics()['queued'] == 3:
+                break
+            sleep(0.01)
+        port.exchange(readlen=1, start=False)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.errors, [])
+        # a single thread has executed the three exchanges at once
+        self.assertEqual(self.ctrl.get_queue_statistics()['batch']['max'], 3)
+
+    def test_single_thread(self):
+        self.assertEqual(SpiController().get_queue_statistics(), {})
+        port = self.ctrl.get_port(2)
+        with self.ctrl.batch():
+            future = port.exchange([0x03, 0x00], 2)
+        self.assertEqual(future.result().tobytes(), b'\x80\x81')
+
+    def _read(self, cs, count):
+        port = self.ctrl.get_port(cs)
+        memory = self.eeproms[cs].memory
+        for pos in range(count):
+            address = (pos*7) & 0xff
+            data = port.exchange([0x03, address], 8).tobytes()
+            expect = (memory+memory)[address:address+8]
+            if data != expect:
+                self.errors.append((cs, address, data))
+
+
 def suite():
     suite_ = unittest.TestSuite()
+    suite_.addTest(unittest.makeSuite(SpiBatchTestCase, 'test'))
+    suite_.addTest(unittest.makeSuite(SpiTemplateTestCase, 'test'))
+    suite_.addTest(unittest.makeSuite(SpiDuplexTestCase, 'test'))
+    suite_.addTest(unittest.makeSuite(SpiStreamTestCase, 'test'))
+    suite_.addTest(unittest.makeSuite(SpiThreadSafeTestCase, 'test'))
     suite_.addTest(unittest.makeSuite(SpiTestCase, 'test'))
     return suite_
 
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017, Emmanuel Blot <emmanuel.blot@free.fr>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the Neotion nor the names of its contributors may
+#       be used to endorse or promote products derived from this software
+#       without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL NEOTION BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import unittest
+from doctest import testmod
+from logging import StreamHandler, DEBUG
+from pyftdi import FtdiLogger
+from pyftdi.spiflash import SpiFlashDevice, SpiFlashError
+from pyftdi.tests.spi import VirtualSpiTestCase
+from random import Random
+from struct import pack as spack
+from sys import modules, stdout
+
+
+class VirtualSpiFlash(object):
+    """SPI slave model: a NOR flash device, whose write commands execute
+       on /CS release"""
+
+    JEDEC_ID = b'\xc2\x20\x15'  # 2 MiB
+
+    def __init__(self, size=2 << 20, sfdp=True, busy=3):
+        self.memory = bytearray(b'\xff'*size)
+        self.erased = {}
+        self.programmed = 0
+        self._sfdp = sfdp and self._build_sfdp(size) or b''
+        self._busy_count = busy
+        self._busy = 0
+        self._wel = False
+        self._command = bytearray()
+        self._offset = 0
+
+    def select(self):
+        self._command = bytearray()
+        self._offset = 0
+
+    def deselect(self):
+        command = self._command
+        if not command or self._busy:
+            return
+        opcode = command[0]
+        if opcode == SpiFlashDevice.CMD_WRITE_ENABLE:
+            self._wel = True
+            return
+        if not self._wel or len(command) < 4:
+            return
+        address = int.from_bytes(command[1:4], 'big')
+        if opcode == SpiFlashDevice.CMD_PAGE_PROGRAM:
+            page = address & ~0xff
+            for pos, byte in enumerate(command[4:]):
+                # address wraps within the page
+                offset = page + ((address+pos) & 0xff)
+                self.memory[offset] &= byte
+            self.programmed += 1
+        else:
+            size = {SpiFlashDevice.CMD_ERASE_4K: 4 << 10,
+                    SpiFlashDevice.CMD_ERASE_32K: 32 << 10,
+                    SpiFlashDevice.CMD_ERASE_64K: 64 << 10}.get(opcode)
+            if not size:
+                return
+            address &= ~(size-1)
+            self.memory[address:address+size] = b'\xff'*size
+            self.erased[size] = self.erased.get(size, 0) + 1
+        self._wel = False
+        self._busy = self._busy_count
+
+    def write(self, data):
+        self._command.extend(data)
+
+    def read(self, length):
+        opcode = self._command and self._command[0]
+        if opcode == SpiFlashDevice.CMD_READ_JEDEC_ID:
+            data = self.JEDEC_ID
+        elif opcode == SpiFlashDevice.CMD_READ_STATUS:
+            data = bytearray()
+            for _ in range(length):
+                data.append((self._busy and SpiFlashDevice.STATUS_WIP) |
+                            (self._wel and SpiFlashDevice.STATUS_WEL))
+                self._busy = max(0, self._busy-1)
+            return bytes(data)
+        elif opcode == SpiFlashDevice.CMD_FAST_READ:
+            data = self.memory
+        elif opcode == SpiFlashDevice.CMD_READ_SFDP:
+            data = self._sfdp
+        else:
+            data = b''
+        address = (len(self._command) >= 4 and
+                   int.from_bytes(self._command[1:4], 'big') or 0)
+        start = address+self._offset
+        self._offset += length
+        chunk = bytes(data[start:start+length])
+        return chunk + b'\xff'*(length-len(chunk))
+
+    @staticmethod
+    def _build_sfdp(size):
+        header = b'SFDP' + bytes((0x06, 0x01, 0x00, 0xff))
+        param = bytes((0x00, 0x06, 0x01, 11)) + spack('<I', 0x30)[:3] + \
+            b'\xff'
+        dwords = [0] * 11
+        dwords[0] = 0xfff120e5
+        dwords[1] = size*8-1
+        # 4KiB/0x20, 32KiB/0x52, 64KiB/0xd8 erase units
+        dwords[7] = 0x520f200c
+        dwords[8] = 0x0000d810
+        # 256-byte pages
+        dwords[10] = 0x00000080
+        table = header + param
+        table += b'\xff' * (0x30-len(table))
+        return table + spack('<11I', *dwords)
+
+
+class SpiFlashTestCase(VirtualSpiTestCase):
+    """SPI flash test case, on the virtual USB backend"""
+
+    def make_flash(self, model):
+        ctrl, _ = self.make_controller({0: model})
+        return SpiFlashDevice(ctrl, 0)
+
+    def test_detect(self):
+        for sfdp in (True, False):
+            flash = self.make_flash(VirtualSpiFlash(sfdp=sfdp))
+            self.assertEqual(flash.jedec_id, VirtualSpiFlash.JEDEC_ID)
+            self.assertEqual(len(flash), 2 << 20)
+            self.assertEqual(flash.page_size, 256)
+            self.assertEqual(flash.erase_units,
+                             (4 << 10, 32 << 10, 64 << 10))
+
+    def test_read(self):
+        model = VirtualSpiFlash()
+        model.memory[:] = bytes([x & 0xff for x in range(len(model.memory))])
+        flash = self.make_flash(model)
+        self.assertEqual(flash.read(0x1234, 100000),
+                         bytes(model.memory[0x1234:0x1234+100000]))
+        self.assertRaises(SpiFlashError, flash.read, 0x1ff000, 0x2000)
+
+    def test_erase(self):
+        # busy for longer than the first status burst
+        model = VirtualSpiFlash(busy=40)
+        model.memory[:] = bytes(len(model.memory))
+        flash = self.make_flash(model)
+        # 4K up to 32K alignment, 32K up to 64K, then 64K, 32K and 4K
+        flash.erase(0x7000, 0x22000)
+        self.assertEqual(model.erased, {4 << 10: 2, 32 << 10: 2,
+                                        64 << 10: 1})
+        self.assertEqual(model.memory[0x7000:0x29000], b'\xff'*0x22000)
+        self.assertEqual(model.memory[0x6000:0x7000], bytes(0x1000))
+        self.assertEqual(model.memory[0x29000:0x2a000], bytes(0x1000))
+        self.assertRaises(SpiFlashError, flash.erase, 0x100, 0x1000)
+
+    def test_write(self):
+        model = VirtualSpiFlash()
+        flash = self.make_flash(model)
+        rand = Random(0)
+        image = bytes(rand.getrandbits(8) for _ in range(0x12345))
+        flash.write(0x10100, image)
+        self.assertEqual(model.memory[0x10100:0x10100+len(image)], image)
+        # blank device: no erase, every page programmed once
+        self.assertEqual(model.erased, {})
+        self.assertEqual(model.programmed, -(-len(image)//256))
+        # same image: nothing to do
+        model.programmed = 0
+        flash.write(0x10100, image)
+        self.assertEqual((model.erased, model.programmed), ({}, 0))
+        # one changed byte, which needs an erase: a single 4KiB unit is
+        # erased, its other pages are programmed back
+        patched = bytearray(image)
+        patched[0x2000] = image[0x2000] ^ 0xff
+        flash.write(0x10100, patched)
+        self.assertEqual(model.erased, {4 << 10: 1})
+        self.assertEqual(model.programmed, 16)
+        self.assertEqual(model.memory[0x10100:0x10100+len(image)], patched)
+
+    def test_write_preserve(self):
+        model = VirtualSpiFlash()
+        model.memory[:] = bytes([x & 0xff for x in range(len(model.memory))])
+        flash = self.make_flash(model)
+        reference = bytearray(model.memory)
+        flash.write(0x20010, b'\xff'*0x10000)
+        reference[0x20010:0x30010] = b'\xff'*0x10000
+        self.assertEqual(model.memory, reference)
+        self.assertEqual(model.erased, {4 << 10: 1, 64 << 10: 1})
+
+
+def suite():
+    suite_ = unittest.TestSuite()
+    suite_.addTest(unittest.makeSuite(SpiFlashTestCase, 'test'))
+    return suite_
+
+
+if __name__ == '__main__':
+    testmod(modules[__name__])
+    FtdiLogger.log.addHandler(StreamHandler(stdout))
+    FtdiLogger.set_level(DEBUG)
+    unittest.main(defaultTest='suite')
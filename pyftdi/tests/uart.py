@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017, Emmanuel Blot <emmanuel.blot@free.fr>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the Neotion nor the names of its contributors may
+#       be used to endorse or promote products derived from this software
+#       without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL NEOTION BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import asyncio
+import unittest
+from doctest import testmod
+from logging import StreamHandler, DEBUG
+from pyftdi import FtdiLogger
+from pyftdi.serialext import serial_for_url
+from pyftdi.serialext.aio import (FtdiHub, create_serial_connection,
+                                  open_serial_connection)
+from pyftdi.serialext.protocol_ftdi import RxRingBuffer
+from pyftdi.tests.backend import usbvirt
+from pyftdi.usbtools import UsbTools
+from serial import SerialException, SerialTimeoutException
+from sys import modules, stdout
+from time import monotonic as now, sleep
+from usb.core import USBError
+
+
+class RxRingBufferTestCase(unittest.TestCase):
+    """Receive buffer test case, does not require any FTDI device"""
+
+    def test_wrap(self):
+        ring = RxRingBuffer(8)
+        self.assertEqual(ring.push(b'abcdef'), 6)
+        self.assertEqual(ring.pop(4), b'abcd')
+        self.assertEqual(ring.push(b'ghijklmn'), 6)
+        self.assertEqual(ring.free, 0)
+        self.assertEqual(len(ring), 8)
+        self.assertEqual(ring.pop(10), b'efghijkl')
+        self.assertEqual(ring.pop(1), b'')
+        ring.push(b'xy')
+        ring.clear()
+        self.assertEqual(len(ring), 0)
+
+
+class UartTestCase(unittest.TestCase):
+    """Serial port test case, on the virtual USB backend"""
+
+    def setUp(self):
+        self.backend = usbvirt.get_backend()
+        self.backend.clear()
+        UsbTools.set_backend(self.backend)
+        self.device = self.backend.add_device('ft2232h')
+        self.port = self.device.ports[1]
+        self.serial = serial_for_url('ftdi://ftdi:2232h/2', baudrate=115200,
+                                     timeout=1.0)
+
+    def tearDown(self):
+        self.serial.close()
+        self.backend.clear()
+        UsbTools.set_backend(None)
+
+    def test_read(self):
+        self.port.inject(b'abc')
+        start = now()
+        # data are returned as soon as they are received
+        self.assertEqual(self.serial.read(10), b'abc')
+        self.assertLess(now()-start, 0.5)
+
+    def test_timeout(self):
+        self.serial.timeout = 0.1
+        start = now()
+        self.assertEqual(self.serial.read(4), b'')
+        self.assertGreaterEqual(now()-start, 0.1)
+        self.serial.timeout = 0
+        self.assertEqual(self.serial.read(4), b'')
+
+    def test_blocking(self):
+        self.serial.timeout = None
+        self.port.inject(b'ab')
+        self.port.inject(b'cd')
+        self.assertEqual(self.serial.read(4), b'abcd')
+
+    def test_in_waiting(self):
+        self.assertEqual(self.serial.in_waiting, 0)
+        self.port.inject(bytes(range(100)))
+        self._wait_input(100)
+        self.assertEqual(self.serial.read(60), bytes(range(60)))
+        self.assertEqual(self.serial.in_waiting, 40)
+        self.serial.reset_input_buffer()
+        self.assertEqual(self.serial.in_waiting, 0)
+
+    def test_write(self):
+        self.port.echo = True
+        # the data have been sent once write() returns
+        self.assertEqual(self.serial.write(b'hello'), 5)
+        self.assertEqual(self.serial.out_waiting, 0)
+        self.assertEqual(self.serial.read(5), b'hello')
+        self.serial.async_write = True
+        self.assertEqual(self.serial.write(b'world'), 5)
+        self.serial.flush()
+        self.assertEqual(self.serial.out_waiting, 0)
+        self.assertEqual(self.serial.read(5), b'world')
+
+    def test_write_timeout(self):
+        # a 64-byte write takes 20 ms, and goes through the pipeline
+        self.port.bandwidth = 3200
+        self.serial.udev.write_data_set_chunksize(64)
+        self.serial.write_timeout = 0.05
+        self.assertRaises(SerialTimeoutException, self.serial.write,
+                          bytes(640))
+        self.port.bandwidth = None
+        self.port.write_error = USBError('Pipe error')
+        self.serial.write_timeout = None
+        # the USB errors are reported by the failed write
+        self.assertRaises(SerialException, self.serial.write, bytes(64))
+
+    def test_reset_output(self):
+        self.port.history = bytearray()
+        # a 64-byte write takes 20 ms, and goes through the pipeline
+        self.port.bandwidth = 3200
+        self.serial.udev.write_data_set_chunksize(64)
+        self.serial.async_write = True
+        for _ in range(8):
+            self.serial.write(bytes(64))
+        self.serial.reset_output_buffer()
+        # at most the buffer in flight is still sent
+        self.assertLessEqual(self.serial.out_waiting, 64)
+        self.serial.flush()
+        # the queued writes are discarded, not sent after the purge
+        self.assertLess(len(self.port.history), 8*64)
+
+    def _wait_input(self, count):
+        deadline = now()+1.0
+        while self.serial.in_waiting < count:
+            self.assertLess(now(), deadline)
+            sleep(0.005)
+
+
+class RecordProtocol(asyncio.Protocol):
+
+    def __init__(self):
+        self.transport = None
+        self.data = bytearray()
+        self.lost = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.data.extend(data)
+
+    def connection_lost(self, exc):
+        self.lost = asyncio.get_event_loop().time()
+
+
+class AsyncUartTestCase(unittest.TestCase):
+    """asyncio serial port test case, on the virtual USB backend"""
+
+    def setUp(self):
+        self.backend = usbvirt.get_backend()
+        self.backend.clear()
+        UsbTools.set_backend(self.backend)
+        self.devices = [self.backend.add_device('ft4232h', 'FT%d' % pos)
+                        for pos in range(2)]
+        self.loop = asyncio.new_event_loop()
+        self.hub = FtdiHub()
+
+    def tearDown(self):
+        self.loop.close()
+        self.backend.clear()
+        UsbTools.set_backend(None)
+
+    def test_streams(self):
+        async def run():
+            streams = []
+            for serial, device in enumerate(self.devices):
+                for port in device.ports:
+                    port.echo = True
+                    url = 'ftdi://ftdi:4232h:FT%d/%d' % (serial,
+                                                         port.ifnum+1)
+                    streams.append(await open_serial_connection(
+                        url, loop=self.loop, hub=self.hub))
+            # all the ports are serviced by a single thread
+            self.assertEqual(self.hub.ports, 8)
+            for pos, (_, writer) in enumerate(streams):
+                writer.write(b'port %d\n' % pos)
+            for pos, (reader, _) in enumerate(streams):
+                line = await asyncio.wait_for(reader.readline(), 2.0)
+                self.assertEqual(line, b'port %d\n' % pos)
+            for _, writer in streams:
+                writer.close()
+            while self.hub.ports:
+                await asyncio.sleep(0.01)
+        self.loop.run_until_complete(run())
+
+    def test_shared_hubs(self):
+        self.addCleanup(setattr, FtdiHub, '_defaults', FtdiHub._defaults)
+        self.addCleanup(setattr, FtdiHub, 'MAX_PORTS', FtdiHub.MAX_PORTS)
+        FtdiHub._defaults = []
+        FtdiHub.MAX_PORTS = 4
+        urls = ['ftdi://ftdi:4232h:FT%d/%d' % (serial, port+1)
+                for serial in range(2) for port in range(4)]
+
+        async def run():
+            connections = await asyncio.gather(*[
+                create_serial_connection(self.loop, RecordProtocol, url)
+                for url in urls])
+            # ports opened concurrently are spread over the shared hubs
+            hubs = list(FtdiHub._defaults)
+            self.assertEqual(len(hubs), len(urls)//FtdiHub.MAX_PORTS)
+            self.assertTrue(all(hub.ports == hub.max_ports for hub in hubs))
+            for transport, _ in connections:
+                transport.close()
+            # empty shared hubs are discarded
+            while FtdiHub._defaults:
+                await asyncio.sleep(0.01)
+            self.assertTrue(all(not hub.ports for hub in hubs))
+            transport, _ = await create_serial_connection(
+                self.loop, RecordProtocol, urls[0])
+            self.assertEqual(len(FtdiHub._defaults), 1)
+            transport.close()
+            while FtdiHub._defaults:
+                await asyncio.sleep(0.01)
+        self.loop.run_until_complete(run())
+
+    def test_open_errors(self):
+        async def run():
+            for url, kwargs in (('ftdi://ftdi:4232h:FT9/1', {}),
+                                ('ftdi://ftdi:4232h:FT0/x', {}),
+                                ('ftdi://ftdi:4232h:FT0/1', {'baudrate': 1})):
+                with self.assertRaises(SerialException):
+                    await create_serial_connection(
+                        self.loop, RecordProtocol, url, hub=self.hub,
+                        **kwargs)
+            self.assertEqual(self.hub.ports, 0)
+        self.loop.run_until_complete(run())
+
+    def test_protocol(self):
+        port = self.devices[0].ports[0]
+
+        async def run():
+            transport, protocol = await create_serial_connection(
+                self.loop, RecordProtocol, 'ftdi://ftdi:4232h:FT0/1',
+                baudrate=57600, hub=self.hub)
+            self.assertIs(transport.get_protocol(), protocol)
+            self.assertIsNotNone(transport.get_extra_info('ftdi'))
+            port.inject(b'hello')
+            while len(protocol.data) < 5:
+                await asyncio.sleep(0.005)
+            self.assertEqual(protocol.data, b'hello')
+            self.assertEqual(port.latency, FtdiHub.LATENCY)
+            transport.close()
+            self.assertTrue(transport.is_closing())
+            while protocol.lost is None:
+                await asyncio.sleep(0.005)
+        self.loop.run_until_complete(run())
+
+
+def suite():
+    suite_ = unittest.TestSuite()
+    suite_.addTest(unittest.makeSuite(RxRingBufferTestCase, 'test'))
+    suite_.addTest(unittest.makeSuite(UartTestCase, 'test'))
+    suite_.addTest(unittest.makeSuite(AsyncUartTestCase, 'test'))
+    return suite_
+
+
+if __name__ == '__main__':
+    testmod(modules[__name__])
+    FtdiLogger.log.addHandler(StreamHandler(stdout))
+    FtdiLogger.set_level(DEBUG)
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2017, Emmanuel Blot <emmanuel.blot@free.fr>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the Neotion nor the names of its contributors may
+#       be used to endorse or promote products derived from this software
+#       without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL NEOTION BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import pickle
+import unittest
+from doctest import testmod
+from logging import StreamHandler, DEBUG
+from pyftdi import FtdiLogger
+from pyftdi.bits import BitSequence
+from pyftdi.ftdi import Ftdi, FtdiPortDescriptor
+from pyftdi.gpio import GpioController
+from pyftdi.i2c import I2cController, I2cNackError
+from pyftdi.jtag import JtagEngine
+from pyftdi.spi import SpiController
+from pyftdi.tests.backend import usbvirt
+from pyftdi.tests.backend.mpsse import (VirtualI2cBus, VirtualJtagBus,
+                                        VirtualJtagTap, VirtualSpiBus)
+from pyftdi.tests.i2c import VirtualI2cEeprom
+from pyftdi.tests.spi import VirtualSpiEeprom, VirtualSpiLoopback
+from pyftdi.usbtools import UsbDeviceDescriptor, UsbTools
+from sys import modules, stdout
+from usb.core import USBError
+
+
+class VirtualBackendTestCase(unittest.TestCase):
+    """Open FTDI devices and controllers from their URL, on the virtual USB
+       backend"""
+
+    def setUp(self):
+        self.backend = usbvirt.get_backend()
+        self.backend.clear()
+        UsbTools.set_backend(self.backend)
+
+    def tearDown(self):
+        self.backend.clear()
+        UsbTools.set_backend(None)
+
+    def test_backend_selection(self):
+        UsbTools.set_backend('pyftdi.tests.backend.usbvirt')
+        self.assertIs(UsbTools.get_backend(), self.backend)
+        self.assertEqual(Ftdi.find_all([(0x403, 0x6010)]), [])
+        self.backend.add_device('ft2232h', 'FT000001')
+        # enumeration is cached until the backend is selected again
+        self.assertEqual(Ftdi.find_all([(0x403, 0x6010)]), [])
+        self.assertEqual(Ftdi.find_all([(0x403, 0x6010)], nocache=True),
+                         [(0x403, 0x6010, 'FT000001', 2, 'Dual RS232-HS')])
+
+    def test_enumeration(self):
+        for pos in range(6):
+            self.backend.add_device(('ft2232h', 'ft232h')[pos & 1],
+                                    'FT%06d' % pos)
+        enumerate_devices = self.backend.enumerate_devices
+        calls = []
+
+        def count():
+            calls.append(None)
+            return enumerate_devices()
+        self.backend.enumerate_devices = count
+        try:
+            vps = sorted((0x403, pid) for pid in
+                         set(Ftdi.PRODUCT_IDS[0x403].values()))
+            # all the vendor/product pairs are looked up in a single pass
+            devices = UsbTools.find_all(vps)
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(sorted(dev[:3] for dev in devices), [
+                (0x403, 0x6010, 'FT000000'), (0x403, 0x6010, 'FT000002'),
+                (0x403, 0x6010, 'FT000004'), (0x403, 0x6014, 'FT000001'),
+                (0x403, 0x6014, 'FT000003'), (0x403, 0x6014, 'FT000005')])
+            # and are cached, even if no device matches
+            UsbTools.find_all(vps)
+            Ftdi.get_identifiers('ftdi://ftdi:232h:FT000003/1')
+            self.assertEqual(len(calls), 1)
+            UsbTools.find_all(vps[:1], nocache=True)
+            self.assertEqual(len(calls), 2)
+        finally:
+            del self.backend.enumerate_devices
+
+    def test_string_cache(self):
+        devices = [self.backend.add_device('ft2232h', 'FT%06d' % pos)
+                   for pos in range(8)]
+        ctrl_transfer = self.backend.ctrl_transfer
+        requests = []
+
+        def count(dev_handle, reqtype, request, *args):
+            if request == 0x06:
+                # GET_DESCRIPTOR
+                requests.append(dev_handle.strings[3])
+            return ctrl_transfer(dev_handle, reqtype, request, *args)
+        self.backend.ctrl_transfer = count
+        try:
+            url = 'ftdi://ftdi:2232h:FT000005/1'
+            Ftdi.create_from_url(url).close()
+            self.assertTrue(requests)
+            # strings are only retrieved once per device, but the ones of
+            # a released device, whose location may be reused
+            self.assertFalse([key for key in UsbTools.UsbStrings
+                              if key[1] == devices[5].address])
+            del requests[:]
+            Ftdi.create_from_url(url).close()
+            UsbTools.find_all([(0x403, 0x6010)])
+            self.assertEqual(set(requests), {'FT000005'})
+            del requests[:]
+            UsbTools.find_all([(0x403, 0x6010)])
+            self.assertEqual(requests, [])
+            # but not kept once the device is disconnected
+            self.backend.remove_device(devices[5])
+            self.backend.add_device('ft2232h', 'FT000099')
+            found = UsbTools.find_all([(0x403, 0x6010)], nocache=True)
+            self.assertIn('FT000099', [dev[2] for dev in found])
+            self.assertNotIn('FT000005', [dev[2] for dev in found])
+            self.assertEqual(set(requests), {'FT000099'})
+            self.assertNotIn(devices[5].address,
+                             [key[1] for key in UsbTools.UsbStrings])
+        finally:
+            del self.backend.ctrl_transfer
+
+    def test_string_error(self):
+        device = self.backend.add_device('ft2232h', 'FT000001')
+        UsbTools.find_all([(0x403, 0x6010)])
+        self.assertTrue([key for key in UsbTools.UsbStrings
+                         if key[1] == device.address])
+        dev = UsbTools._find_device_at(0x403, 0x6010, 1, device.address)
+
+        def fail(*args):
+            raise USBError('No such device')
+        self.backend.ctrl_transfer = fail
+        try:
+            self.assertRaises(USBError, UsbTools.get_string, dev, 0x10)
+        finally:
+            del self.backend.ctrl_transfer
+        # the strings of an unreachable location are not trusted anymore
+        self.assertFalse([key for key in UsbTools.UsbStrings
+                          if key[1] == device.address])
+
+    def test_device_locks(self):
+        for pos in range(2):
+            self.backend.add_device('ft2232h', 'FT%06d' % pos)
+        locks = dict(UsbTools.DeviceLocks)
+        ftdis = [Ftdi.create_from_url(url) for url in (
+            'ftdi://ftdi:2232h:FT000000/1', 'ftdi://ftdi:2232h:FT000000/2',
+            'ftdi://ftdi:2232h:FT000001/1')]
+        self.assertEqual(len(UsbTools.DeviceLocks), len(locks)+2)
+        ftdis.pop(0).close()
+        self.assertEqual(len(UsbTools.DeviceLocks), len(locks)+2)
+        # locks are discarded along with the devices
+        for ftdi in ftdis:
+            ftdi.close()
+        self.assertEqual(UsbTools.DeviceLocks, locks)
+
+    def test_open(self):
+        device = self.backend.add_device('ft4232h')
+        ftdi = Ftdi()
+        ftdi.open_from_url('ftdi://ftdi:4232h/3')
+        self.assertEqual(ftdi.max_packet_size, 512)
+        self.assertEqual(ftdi.fifo_sizes, (2048, 2048))
+        self.assertEqual(ftdi.get_latency_timer(), Ftdi.LATENCY_MIN)
+        self.assertEqual(device.ports[2].latency, Ftdi.LATENCY_MIN)
+        device.ports[2].inject(b'\x55'*1000)
+        self.assertEqual(ftdi.read_data(1000), b'\x55'*1000)
+        ftdi.close()
+        with self.assertRaises(IOError):
+            ftdi.open_from_url('ftdi://ftdi:2232h/1')
+
+    def test_latency(self):
+        device = self.backend.add_device('ft232h')
+        ftdi = Ftdi()
+        ftdi.open_mpsse_from_url('ftdi://ftdi:232h/1', latency=16)
+        clock = self.backend.clock
+        # a partial packet is only sent once the latency timer expires
+        ftdi.write_data(bytes((Ftdi.GET_BITS_LOW,)))
+        start = clock.time()
+        self.assertEqual(len(ftdi.read_data_bytes(1, 4)), 1)
+        self.assertGreaterEqual(clock.time()-start, 0.016)
+        # unless SEND_IMMEDIATE is used
+        ftdi.write_data(bytes((Ftdi.GET_BITS_LOW, Ftdi.SEND_IMMEDIATE)))
+        start = clock.time()
+        self.assertEqual(len(ftdi.read_data_bytes(1, 4)), 1)
+        self.assertLess(clock.time()-start, 0.001)
+        self.assertEqual(device.ports[0].bitmode, Ftdi.BITMODE_MPSSE)
+        ftdi.close()
+
+    def test_spi(self):
+        device = self.backend.add_device('ft2232h')
+        eeprom = VirtualSpiEeprom()
+        device.ports[0].connect(VirtualSpiBus({0: eeprom,
+                                               1: VirtualSpiLoopback()}))
+        spi = SpiController(cs_count=2)
+        spi.configure('ftdi://ftdi:2232h/1')
+        port = spi.get_port(0, freq=6E6)
+        port.exchange(b'\x02\x10hello')
+        self.assertEqual(eeprom.memory[0x10:0x15], b'hello')
+        self.assertEqual(port.exchange(b'\x03\x10', 5).tobytes(), b'hello')
+        self.assertEqual(
+            spi.get_port(1).exchange_duplex(b'\x01\x02').tobytes(),
+            b'\xfe\xfd')
+        spi.terminate()
+
+    def test_i2c(self):
+        device = self.backend.add_device('ft232h')
+        eeprom = VirtualI2cEeprom()
+        device.ports[0].connect(VirtualI2cBus([eeprom]))
+        i2c = I2cController()
+        i2c.configure('ftdi://ftdi:232h/1')
+        port = i2c.get_port(0x50)
+        port.write(b'\x20abc')
+        self.assertEqual(eeprom.memory[0x20:0x23], b'abc')
+        self.assertEqual(port.exchange(b'\x20', 3), b'abc')
+        with self.assertRaises(I2cNackError):
+            i2c.get_port(0x51).write(b'\x00')
+        i2c.terminate()
+
+    def test_gpio(self):
+        device = self.backend.add_device('ft4232h')
+        gpio = GpioController()
+        gpio.open_from_url('ftdi://ftdi:4232h/2', direction=0xf0)
+        gpio.write_port(0xa0)
+        self.assertEqual(device.ports[1].bus.pins, 0xa0)
+        self.assertEqual(gpio.read_port(), 0xa0)
+        gpio.close()
+
+    def test_descriptor(self):
+        self.backend.add_device('ft2232h', 'FT000001').set_location(1, 4)
+        device = self.backend.add_device('ft2232h', 'FT000002')
+        device.set_location(2, 7)
+        eeprom = VirtualSpiEeprom()
+        device.ports[1].connect(VirtualSpiBus({0: eeprom}))
+        found = UsbTools.find_all([(0x403, 0x6010)], descriptors=True)
+        self.assertEqual(sorted(found), [
+            (UsbDeviceDescriptor(0x403, 0x6010, 1, 4, 'FT000001', 0,
+                                 'Dual RS232-HS'), 2),
+            (UsbDeviceDescriptor(0x403, 0x6010, 2, 7, 'FT000002', 0,
+                                 'Dual RS232-HS'), 2)])
+        desc = Ftdi.get_descriptor('ftdi://ftdi:2232h:FT000002/2')
+        self.assertEqual(desc, FtdiPortDescriptor(
+            UsbDeviceDescriptor(0x403, 0x6010, 2, 7, 'FT000002', 0,
+                                'Dual RS232-HS'), 2))
+        desc = pickle.loads(pickle.dumps(desc))
+        # a descriptor is opened without enumerating the devices again
+        UsbTools.flush_cache()
+        spi = SpiController()
+        spi.configure(desc)
+        spi.get_port(0).exchange(b'\x02\x00abc')
+        self.assertEqual(eeprom.memory[:3], b'abc')
+        spi.terminate()
+        self.assertEqual(UsbTools.UsbDevices, {})
+        # a descriptor does not match another device at the same location
+        stale = FtdiPortDescriptor(desc.device._replace(sn='FT000003'), 2)
+        with self.assertRaises(IOError):
+            Ftdi.create_from_url(stale)
+
+    def test_device_index(self):
+        # identical devices, plugged in so that their location does not
+        # follow the enumeration order
+        for pos, address in enumerate((5, 2, 7, 1, 3)):
+            device = self.backend.add_device('ft232h', 'FT%06d' % pos)
+            device.set_location(1, address)
+        UsbTools.flush_cache()
+        for index in range(1, 6):
+            url = 'ftdi://ftdi:232h:%d/1' % index
+            desc = Ftdi.get_descriptor(url)
+            ftdi = Ftdi.create_from_url(url)
+            try:
+                # both lookups designate the same device, by location
+                self.assertEqual((ftdi.usb_dev.bus, ftdi.usb_dev.address),
+                                 (desc.device.bus, desc.device.address))
+                self.assertEqual(desc.device.address, (1, 2, 3, 5, 7)[index-1])
+            finally:
+                ftdi.close()
+
+    def test_jtag(self):
+        device = self.backend.add_device('ft4232h')
+        device.ports[0].connect(VirtualJtagBus(VirtualJtagTap(0x4ba00477)))
+        jtag = JtagEngine(frequency=3E6)
+        jtag.configure('ftdi://ftdi:4232h/1')
+        jtag.reset()
+        # IDCODE is selected on TAP reset
+        self.assertEqual(int(jtag.read_dr(32)), 0x4ba00477)
+        jtag.go_idle()
+        jtag.write_ir(BitSequence('1111', msb=True, length=4))
+        self.assertEqual(int(jtag.read_dr(1)), 0)
+        jtag.go_idle()
+        jtag.close()
+
+
+def suite():
+    suite_ = unittest.TestSuite()
+    suite_.addTest(unittest.makeSuite(VirtualBackendTestCase, 'test'))
+    return suite_
+
+
+if __name__ == '__main__':
+    testmod(modules[__name__])
+    FtdiLogger.log.addHandler(StreamHandler(stdout))
+    FtdiLogger.set_level(DEBUG)
+    unittest.main(defaultTest='suite')
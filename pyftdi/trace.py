@@ -0,0 +1,110 @@
+# Copyright (c) 2010-2017, Emmanuel Blot <emmanuel.blot@free.fr>
+# Copyright (c) 2016, Emmanuel Bouaziz <ebouaziz@free.fr>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the Neotion nor the names of its contributors may
+#       be used to endorse or promote products derived from this software
+#       without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL NEOTION BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Tracing of the USB transfers of a FTDI device.
+
+   A tracer is attached to a :py:class:`pyftdi.ftdi.Ftdi` instance with
+   :py:meth:`pyftdi.ftdi.Ftdi.set_tracer`, and is called with the raw content
+   of each USB transfer. The content of a control transfer starts with its
+   8-byte setup packet. No formatting takes place while tracing, so that
+   tracing can be left enabled without slowing down the transfers.
+"""
+
+from collections import deque
+from pyftdi.misc import hexdump
+from sys import stdout
+from threading import Lock
+from time import perf_counter
+
+__all__ = ['UsbTracer']
+
+
+class UsbTracer(object):
+    """Ring-buffer tracer, which keeps the most recent USB transfers in
+       memory, and only formats them on demand.
+
+       >>> tracer = UsbTracer(size=8)
+       >>> tracer.trace(UsbTracer.BULK_OUT, 0x02, b'abcdef')
+       >>> tracer.trace(UsbTracer.BULK_IN, 0x81, b'\\x32\\x60ghi')
+       >>> [(kind, ep, data) for _, kind, ep, data in tracer.records()]
+       [('<', 129, b'2`ghi')]
+
+       :param size: the maximum count of payload bytes to keep. The oldest
+                    transfers are discarded first
+    """
+
+    BULK_OUT = '>'
+    BULK_IN = '<'
+    CTRL_OUT = '}'
+    CTRL_IN = '{'
+
+    def __init__(self, size=64 << 10):
+        self._size = size
+        self._length = 0
+        self._records = deque()
+        self._lock = Lock()
+        self._start = perf_counter()
+
+    def trace(self, kind, endpoint, data):
+        """Record a USB transfer.
+
+           :param kind: the kind of transfer
+           :param endpoint: the USB endpoint
+           :param data: the transfer content, which is copied
+        """
+        data = bytes(data)
+        with self._lock:
+            self._records.append((perf_counter(), kind, endpoint, data))
+            self._length += len(data)
+            while self._length > self._size and len(self._records) > 1:
+                self._length -= len(self._records.popleft()[3])
+
+    def records(self):
+        """Return the recorded transfers, oldest first.
+
+           :return: a list of (timestamp, kind, endpoint, data) tuples, where
+                    timestamp is in seconds since the tracer creation
+        """
+        with self._lock:
+            return [(ts-self._start, kind, ep, data)
+                    for ts, kind, ep, data in self._records]
+
+    def clear(self):
+        """Discard all recorded transfers"""
+        with self._lock:
+            self._records.clear()
+            self._length = 0
+
+    def dump(self, out=None):
+        """Print the recorded transfers.
+
+           :param out: the output stream, default to stdout
+        """
+        out = out or stdout
+        for ts, kind, endpoint, data in self.records():
+            print('%12.6f %s ep 0x%02x %d bytes' %
+                  (ts, kind, endpoint, len(data)), file=out)
+            out.write(hexdump(data))
@@ -19,12 +19,25 @@
 import threading
 import usb.core
 import usb.util
+from collections import namedtuple
+from importlib import import_module
+from os import environ
 from pyftdi.misc import to_int
 from string import printable as printablechars
 from sys import stdout
 from urllib.parse import urlsplit
 
-__all__ = ['UsbTools']
+__all__ = ['UsbDeviceDescriptor', 'UsbTools']
+
+
+UsbDeviceDescriptor = namedtuple('UsbDeviceDescriptor',
+                                 'vid pid bus address sn index description')
+"""Picklable location of an USB device, which can be re-opened from another
+   process without enumerating the USB devices again.
+
+   ``bus`` and ``address`` are None with backends that do not report the
+   location of the devices. ``index`` tells apart the devices with the same
+   vendor and product identifiers and serial number."""
 
 
 class UsbToolsError(Exception):
@@ -40,100 +53,219 @@ class UsbTools(object):
     # to track (device, refcount) pairs
     Devices = {}
     Lock = threading.RLock()
+    # Per-device locks, which serialize the initialization of a device, so
+    # that several devices may be initialized concurrently. A lock is
+    # discarded once its device is released
+    DeviceLocks = {}
     UsbDevices = {}
+    # String descriptors of the enumerated devices, keyed by bus, address,
+    # vendor, product and string index; entries are dropped whenever the
+    # device is no longer found when the USB devices are enumerated again,
+    # when the device is released, or cannot be accessed, as its location
+    # may be reused by another device
+    UsbStrings = {}
     UsbApi = None
+    UsbBackend = None
+
+    # PyUSB backend modules, in order of preference. The PYFTDI_BACKEND
+    # environment variable may override this list, with a comma-separated
+    # list of module names
+    BACKENDS = ('usb.backend.libusb1', 'usb.backend.libusb0',
+                'usb.backend.openusb')
 
     @staticmethod
-    def find_all(vps, nocache=False):
+    def find_all(vps, nocache=False, descriptors=False):
         """Find all devices that match the vendor/product pairs of the vps
-           list."""
-        devs = set()
-        for v, p in vps:
-            devs.update(UsbTools._find_devices(v, p, nocache))
-        devices = set()
-        for dev in devs:
+           list.
+
+           :param vps: a sequence of (vendor, product) pairs
+           :param nocache: bypass the cache of the enumerated devices
+           :param descriptors: report the devices as
+                               (:py:class:`UsbDeviceDescriptor`, ifcount)
+                               pairs, rather than as (vendor, product, serial,
+                               ifcount, description) tuples
+           :return: a list of devices
+        """
+        devs = UsbTools._find_all_devices(vps, nocache)
+        devices = []
+        for dev in UsbTools._sort_devices(devs):
             ifcount = max([cfg.bNumInterfaces for cfg in dev])
             sernum = UsbTools.get_string(dev, dev.iSerialNumber)
             description = UsbTools.get_string(dev, dev.iProduct)
-            devices.add((dev.idVendor, dev.idProduct, sernum, ifcount,
-                         description))
-        return list(devices)
+            if descriptors:
+                bus = getattr(dev, 'bus', None)
+                address = getattr(dev, 'address', None)
+                device = (dev.idVendor, dev.idProduct, bus, address,
+                          sernum, ifcount, description)
+            else:
+                device = (dev.idVendor, dev.idProduct, sernum, ifcount,
+                          description)
+            if device not in devices:
+                devices.append(device)
+        if not descriptors:
+            return devices
+        indices = {}
+        found = []
+        # number the devices that only differ with their location
+        for (vid, pid, bus, address, sernum, ifcount, description) in \
+                devices:
+            ikey = (vid, pid, sernum)
+            index = indices.get(ikey, 0)
+            indices[ikey] = index+1
+            found.append((UsbDeviceDescriptor(vid, pid, bus, address, sernum,
+                                              index, description), ifcount))
+        return found
 
     @classmethod
     def flush_cache(cls):
         cls.Lock.acquire()
         cls.UsbDevices = {}
+        cls.UsbStrings = {}
         cls.Lock.release()
 
     @classmethod
-    def get_device(cls, vendor, product, index=0, serial=None,
-                   description=None):
-        """Find a previously open device with the same vendor/product
-           or initialize a new one, and return it"""
+    def set_backend(cls, backend):
+        """Select the PyUSB backend to enumerate and access devices with.
+
+           Devices enumerated with the previous backend are forgotten.
+
+           :param backend: a backend instance, a backend module name, or
+                           None to restore the default backend selection
+        """
+        cls.Lock.acquire()
+        try:
+            if isinstance(backend, str):
+                backend = cls._load_backend((backend,))
+            cls.UsbBackend = backend
+            cls.UsbDevices = {}
+            cls.UsbStrings = {}
+        finally:
+            cls.Lock.release()
+
+    @classmethod
+    def get_backend(cls):
+        """Return the PyUSB backend in use, loading it if required"""
         cls.Lock.acquire()
         try:
-            if index or serial or description:
+            if not cls.UsbBackend:
+                names = environ.get('PYFTDI_BACKEND')
+                candidates = names and names.split(',') or cls.BACKENDS
+                cls.UsbBackend = cls._load_backend(candidates)
+            return cls.UsbBackend
+        finally:
+            cls.Lock.release()
+
+    @staticmethod
+    def _load_backend(candidates):
+        """Return the first available backend of the candidate modules"""
+        for name in candidates:
+            try:
+                module = import_module(name.strip())
+            except ImportError:
+                continue
+            backend = module.get_backend()
+            if backend is not None:
+                return backend
+        raise ValueError('No backend available')
+
+    @classmethod
+    def get_device(cls, vendor, product, index=0, serial=None,
+                   description=None, bus=None, address=None):
+        """Find a previously open device with the same vendor/product
+           or initialize a new one, and return it.
+
+           The global lock is only held to look up and update the registry
+           of open devices: string descriptors are retrieved, and new devices
+           initialized, without it, so that several threads may open
+           distinct devices concurrently.
+
+           When the bus and the address of the device are known, e.g. from
+           a :py:class:`UsbDeviceDescriptor`, the device is looked up
+           directly, and only its own serial number is checked."""
+        if bus is not None and address is not None:
+            dev = cls._find_device_at(vendor, product, bus, address)
+            if dev and serial and \
+                    UsbTools.get_string(dev, dev.iSerialNumber) != serial:
                 dev = None
-                if not vendor:
-                    raise ValueError('Vendor identifier is required')
-                devs = cls._find_devices(vendor, product)
-                if description:
-                    devs = [dev for dev in devs if
-                            UsbTools.get_string(dev, dev.iProduct) ==
-                            description]
-                if serial:
-                    devs = [dev for dev in devs if
-                            UsbTools.get_string(dev, dev.iSerialNumber) ==
-                            serial]
-                if isinstance(devs, set):
-                    # there is no guarantee the same index with lead to the
-                    # same device. Indexing should be reworked
-                    devs = list(devs)
+        elif index or serial or description:
+            dev = None
+            if not vendor:
+                raise ValueError('Vendor identifier is required')
+            devs = cls._find_devices(vendor, product)
+            if description:
+                devs = [dev for dev in devs if
+                        UsbTools.get_string(dev, dev.iProduct) ==
+                        description]
+            if serial:
+                devs = [dev for dev in devs if
+                        UsbTools.get_string(dev, dev.iSerialNumber) ==
+                        serial]
+            # index the devices in the same order as find_all()
+            devs = cls._sort_devices(devs)
+            try:
+                dev = devs[index]
+            except IndexError:
+                raise IOError("No such device")
+        else:
+            devs = cls._find_devices(vendor, product)
+            dev = devs and cls._sort_devices(devs)[0] or None
+        if not dev:
+            raise IOError('Device not found')
+        try:
+            devkey = (dev.bus, dev.address, vendor, product)
+            if None in devkey[0:2]:
+                raise AttributeError('USB backend does not support bus '
+                                     'enumeration')
+        except AttributeError:
+            devkey = (vendor, product)
+        while True:
+            with cls.Lock:
+                devlock = cls.DeviceLocks.setdefault(devkey,
+                                                     threading.Lock())
+            with devlock:
+                with cls.Lock:
+                    if cls.DeviceLocks.get(devkey) is not devlock:
+                        # the device has been released meanwhile, and its
+                        # lock discarded
+                        continue
+                    if devkey in cls.Devices:
+                        cls.Devices[devkey][1] += 1
+                        return cls.Devices[devkey][0]
                 try:
-                    dev = devs[index]
-                except IndexError:
-                    raise IOError("No such device")
-            else:
-                devs = cls._find_devices(vendor, product)
-                dev = devs and list(devs)[0] or None
-            if not dev:
-                raise IOError('Device not found')
+                    cls._init_device(dev)
+                except Exception:
+                    with cls.Lock:
+                        del cls.DeviceLocks[devkey]
+                    raise
+                with cls.Lock:
+                    cls.Devices[devkey] = [dev, 1]
+                return dev
+
+    @staticmethod
+    def _init_device(dev):
+        """Claim a new device from the kernel, and configure it"""
+        for configuration in dev:
+            # we need to detach any kernel driver from the device
+            # be greedy: reclaim all device interfaces from the kernel
+            for interface in configuration:
+                ifnum = interface.bInterfaceNumber
+                try:
+                    if not dev.is_kernel_driver_active(ifnum):
+                        continue
+                    dev.detach_kernel_driver(ifnum)
+                except NotImplementedError:
+                    # only libusb 1.x backend implements this method
+                    break
+                except usb.core.USBError:
+                    pass
+        # only change the active configuration if the active one is
+        # not the first. This allows other libusb sessions running
+        # with the same device to run seamlessly.
+        if dev.get_active_configuration().bConfigurationValue != 1:
             try:
-                devkey = (dev.bus, dev.address, vendor, product)
-                if None in devkey[0:2]:
-                    raise AttributeError('USB backend does not support bus '
-                                         'enumeration')
-            except AttributeError:
-                devkey = (vendor, product)
-            if devkey not in cls.Devices:
-                for configuration in dev:
-                    # we need to detach any kernel driver from the device
-                    # be greedy: reclaim all device interfaces from the kernel
-                    for interface in configuration:
-                        ifnum = interface.bInterfaceNumber
-                        try:
-                            if not dev.is_kernel_driver_active(ifnum):
-                                continue
-                            dev.detach_kernel_driver(ifnum)
-                        except NotImplementedError:
-                            # only libusb 1.x backend implements this method
-                            break
-                        except usb.core.USBError:
-                            pass
-                # only change the active configuration if the active one is
-                # not the first. This allows other libusb sessions running
-                # with the same device to run seamlessly.
-                if dev.get_active_configuration().bConfigurationValue != 1:
-                    try:
-                        dev.set_configuration()
-                    except usb.core.USBError:
-                        pass
-                cls.Devices[devkey] = [dev, 1]
-            else:
-                cls.Devices[devkey][1] += 1
-            return cls.Devices[devkey][0]
-        finally:
-            cls.Lock.release()
+                dev.set_configuration()
+            except usb.core.USBError:
+                pass
 
     @classmethod
     def release_device(cls, usb_dev):
@@ -152,10 +284,45 @@ class UsbTools(object):
                         # last interface in use, release
                         usb.util.dispose_resources(cls.Devices[devkey][0])
                         del cls.Devices[devkey]
+                        cls.DeviceLocks.pop(devkey, None)
+                        if len(devkey) > 2:
+                            cls._forget_location(*devkey[:2])
                     break
         finally:
             cls.Lock.release()
 
+    @staticmethod
+    def _sort_devices(devs):
+        """Sort USB devices by vendor, product and location, so that a
+           device index always designates the same device, whatever the
+           way it is looked up."""
+        return sorted(devs, key=lambda dev: (
+            dev.idVendor, dev.idProduct, getattr(dev, 'bus', None) or 0,
+            getattr(dev, 'address', None) or 0))
+
+    @classmethod
+    def _find_device_at(cls, vendor, product, bus, address):
+        """Find an USB device from its location, without enumerating the
+           string descriptors of the other devices."""
+        devkey = (bus, address, vendor, product)
+        with cls.Lock:
+            if devkey in cls.Devices:
+                return cls.Devices[devkey][0]
+            devs = cls.UsbDevices.get((vendor, product))
+            if devs is not None:
+                for dev in devs:
+                    if (dev.bus, dev.address) == (bus, address):
+                        return dev
+                return None
+            backend = cls.get_backend()
+            for dev in backend.enumerate_devices():
+                desc = backend.get_device_descriptor(dev)
+                if (desc.bus, desc.address) != (bus, address):
+                    continue
+                if (desc.idVendor, desc.idProduct) == (vendor, product):
+                    return usb.core.Device(dev, backend)
+        return None
+
     @classmethod
     def _find_devices(cls, vendor, product, nocache=False):
         """Find an USB device and return it.
@@ -168,46 +335,84 @@ class UsbTools(object):
            Hopefully, this kludge is temporary and replaced with a better
            implementation from PyUSB at some point.
         """
-        cls.Lock.acquire()
-        try:
-            backend = None
-            candidates = ('libusb1', 'libusb10', 'libusb0', 'libusb01',
-                          'openusb')
-            um = __import__('usb.backend', globals(), locals(),
-                            candidates, 0)
-            for c in candidates:
-                try:
-                    m = getattr(um, c)
-                except AttributeError:
-                    continue
-                backend = m.get_backend()
-                if backend is not None:
-                    break
-            else:
-                raise ValueError('No backend available')
-            vp = (vendor, product)
-            if nocache or (vp not in cls.UsbDevices):
-                # not freed until Python runtime completion
-                # enumerate_devices returns a generator, so back up the
-                # generated device into a list. To save memory, we only
-                # back up the supported devices
-                devs = set()
-                vpdict = {}
-                vpdict.setdefault(vendor, [])
-                vpdict[vendor].append(product)
+        return cls._find_all_devices(((vendor, product), ), nocache)
+
+    @classmethod
+    def _find_all_devices(cls, vps, nocache=False):
+        """Find the USB devices that match any of the vendor/product pairs,
+           enumerating the USB devices at most once.
+
+           The raw device descriptors are matched before any
+           ``usb.core.Device`` is built, so that the cost of the enumeration
+           is not driven by the count of unrelated USB devices.
+        """
+        vps = set(vps)
+        with cls.Lock:
+            missing = vps if nocache else \
+                {vp for vp in vps if vp not in cls.UsbDevices}
+            if missing:
+                backend = cls.get_backend()
+                # not freed until Python runtime completion. To save memory,
+                # we only back up the supported devices
+                found = {vp: set() for vp in missing}
+                present = set()
                 for dev in backend.enumerate_devices():
-                    device = usb.core.Device(dev, backend)
-                    vendor = device.idVendor
-                    product = device.idProduct
-                    if vendor in vpdict:
-                        products = vpdict[vendor]
-                        if products and (product not in products):
-                            continue
-                        devs.add(device)
-                cls.UsbDevices[vp] = devs
-            return cls.UsbDevices[vp]
-        finally:
-            cls.Lock.release()
+                    desc = backend.get_device_descriptor(dev)
+                    present.add((desc.bus, desc.address, desc.idVendor,
+                                 desc.idProduct))
+                    devs = found.get((desc.idVendor, desc.idProduct))
+                    if devs is not None:
+                        devs.add(usb.core.Device(dev, backend))
+                cls.UsbDevices.update(found)
+                cls._forget_strings(present)
+            devices = set()
+            for vp in vps:
+                devices.update(cls.UsbDevices[vp])
+            return devices
+
+    @classmethod
+    def _refresh_devices(cls):
+        """Update the cache of the enumerated devices, with a single pass
+           over the USB devices.
+
+           Devices still present are kept as is, devices that have been
+           disconnected are removed, and devices that have been connected
+           are added to the vendor/product pairs already cached.
+        """
+        with cls.Lock:
+            backend = cls.get_backend()
+            present = {}
+            for dev in backend.enumerate_devices():
+                desc = backend.get_device_descriptor(dev)
+                present[(desc.bus, desc.address, desc.idVendor,
+                         desc.idProduct)] = dev
+            for vp, devs in cls.UsbDevices.items():
+                known = set()
+                for device in list(devs):
+                    location = (device.bus, device.address, device.idVendor,
+                                device.idProduct)
+                    if location in present:
+                        known.add(location)
+                    else:
+                        devs.discard(device)
+                for location, dev in present.items():
+                    if location[2:] == vp and location not in known:
+                        devs.add(usb.core.Device(dev, backend))
+            cls._forget_strings(present)
+
+    @classmethod
+    def _forget_location(cls, bus, address):
+        """Forget the strings of the device at a location"""
+        with cls.Lock:
+            cls.UsbStrings = {key: string for key, string
+                              in cls.UsbStrings.items()
+                              if key[:2] != (bus, address)}
+
+    @classmethod
+    def _forget_strings(cls, present):
+        """Forget the strings of the devices that are no longer present"""
+        cls.UsbStrings = {key: string for key, string
+                          in cls.UsbStrings.items() if key[:4] in present}
 
     @staticmethod
     def parse_url(urlstr, devclass, scheme, vdict, pdict, default_vendor):
@@ -273,6 +478,9 @@ class UsbTools(object):
             for v in vendors:
                 products = pdict.get(v, [])
                 for p in products:
+                    # only retrieve the strings of the devices that may match
+                    if product and product != products[p]:
+                        continue
                     vps.add((v, products[p]))
             devices = devclass.find_all(vps)
             candidates = []
@@ -388,7 +596,32 @@ class UsbTools(object):
     @classmethod
     def get_string(cls, device, strname):
         """Retrieve a string from the USB device, dealing with PyUSB API breaks
+
+           Strings are cached per device location, so that they are only
+           retrieved once from each device, until it is released, it cannot
+           be accessed, or it is no longer found when the USB devices are
+           enumerated again.
         """
+        bus = getattr(device, 'bus', None)
+        address = getattr(device, 'address', None)
+        if bus is None or address is None:
+            return cls._read_string(device, strname)
+        key = (bus, address, device.idVendor, device.idProduct, strname)
+        with cls.Lock:
+            if key in cls.UsbStrings:
+                return cls.UsbStrings[key]
+        try:
+            string = cls._read_string(device, strname)
+        except usb.core.USBError:
+            # the device may have been replaced with another one
+            cls._forget_location(bus, address)
+            raise
+        with cls.Lock:
+            cls.UsbStrings[key] = string
+        return string
+
+    @classmethod
+    def _read_string(cls, device, strname):
         if cls.UsbApi is None:
             import inspect
             args, varargs, varkw, defaults = \